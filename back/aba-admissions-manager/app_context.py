@@ -0,0 +1,533 @@
+import threading
+import time
+from typing import Dict, List
+from connectors.interface_connection import InterfaceConnection
+from connectors.postgresql_connection import PostgreSQLConnection
+from connectors.snowflake_connection import SnowflakeConnection
+from controller.eiv_controller import EIVController
+from services.eiv_services import EIVService
+from repository.query_cache import QueryResultCache
+from services.prediction_cache import PredictionCache
+from services.prediction_writer import PredictionWriter
+from services.reference_index import ReferenceIndex
+from services.reference_refresher import ReferenceRefresher
+from services.reference_snapshot import ReferenceSnapshot
+from services.startup import StartupInitializer
+from util.pickle_manager import PickleManager
+from util.yaml_config_loader import YAMLConfigLoader
+
+
+class AppContext:
+    """
+    Hold the process-lifetime state of the container (config, connectors,
+    models and reference data) so warm invocations reuse it.
+
+    Variables:
+        pickle_folder (str): Folder where the model pickles are stored.
+        reference_ttl (float): Seconds the reference data (and its local
+        snapshot) is reused before Snowflake is checked for changes.
+        reference_version (str): snapshot_version of the reference data in
+        use; cached predictions of older versions are not reused.
+        prediction_cache_size (int): Feature vectors kept by the
+        PredictionCache.
+
+    Interactions:
+        - Builds the PostgreSQLConnection, SnowflakeConnection and
+          EIVController instances shared by every request.
+    """
+
+    # Models and preprocessors used by the pipeline
+    MODEL_FILES = {
+        'scaler': 'EIV_Scaler.pkl',
+        'model_pt': 'EIV_PT_Model.pkl',
+        'model_proba': 'xgb_model.pkl'
+    }
+
+    def __init__(self, pickle_folder: str = 'pickle/',
+                 reference_ttl: float = 3600.0,
+                 prediction_cache_size: int = 10000):
+        """
+        Initializes the AppContext object.
+
+        Parameters:
+            pickle_folder (str): Folder where the model pickles are stored.
+            reference_ttl (float): Seconds the reference data is reused.
+            prediction_cache_size (int): Feature vectors kept by the
+            PredictionCache.
+
+        Returns:
+            None
+
+        Process:
+            - Saves the settings; every resource is built lazily on first use.
+        """
+        self.pickle_folder = pickle_folder
+        self.reference_ttl = reference_ttl
+        self.prediction_cache_size = prediction_cache_size
+        self._lock = threading.RLock()
+        # Serializes the loads of the reference data; taken before _lock
+        self._reference_lock = threading.Lock()
+        self._reference_refresher = None
+        # Age past which the data is reloaded on the request path even
+        # while the refresher runs, set when it is started
+        self._reference_max_age = None
+        # One lock per model file, so they are unpickled at the same time
+        self._model_locks = {name: threading.Lock() for name in self.MODEL_FILES}
+        self.startup_report = None
+        self._clear()
+
+    def _clear(self):
+        self._config = None
+        self._credentials = None
+        self._connectors = None
+        self._models = None
+        self._model_objects = {}
+        self._reference_index = None
+        self._reference_loaded_at = None
+        self._reference_manifest = None
+        self._reference_pushdowns = 0
+        self._reference_snapshot = None
+        self.reference_version = None
+        self._prediction_cache = None
+        self._query_cache = None
+        self._prediction_writer = None
+        self._controller = None
+
+    def get_config(self) -> dict:
+        """
+        Return the configuration, loading 'config.yaml' only once.
+        """
+        if self._config is None:
+            with self._lock:
+                if self._config is None:
+                    self._config = YAMLConfigLoader().load_config()
+        return self._config
+
+    def get_credentials(self) -> dict:
+        """
+        Return the credentials, loading 'credentials.yaml' only once.
+        """
+        if self._credentials is None:
+            with self._lock:
+                if self._credentials is None:
+                    self._credentials = YAMLConfigLoader().load_credentials()
+        return self._credentials
+
+    def get_connectors(self) -> List[InterfaceConnection]:
+        """
+        Return the RDS and Snowflake connectors shared by every request.
+
+        Returns:
+            List[InterfaceConnection]: [PostgreSQLConnection, SnowflakeConnection]
+        """
+        if self._connectors is None:
+            with self._lock:
+                if self._connectors is None:
+                    config = self.get_config()
+                    credentials = self.get_credentials()
+
+                    db_rds = PostgreSQLConnection(config['rds']['host'],
+                                                  config['rds']['port'],
+                                                  config['rds']['database'],
+                                                  credentials['rds']['user'],
+                                                  credentials['rds']['password'],
+                                                  int(config['rds'].get('pool_min_size', 1)),
+                                                  int(config['rds'].get('pool_max_size', 4)),
+                                                  float(config['rds'].get('checkout_timeout', 10)),
+                                                  int(config['rds'].get('statement_timeout', 30000)))
+                    db_snowflake = SnowflakeConnection(config['snowflake']['account'],
+                                                       credentials['snowflake']['user'],
+                                                       credentials['snowflake']['password'],
+                                                       config['snowflake']['database'],
+                                                       config['snowflake']['schema'],
+                                                       config['snowflake']['warehouse'],
+                                                       config['snowflake']['role'],
+                                                       int(config['snowflake'].get('fetch_workers', 4)))
+                    self._connectors = [db_rds, db_snowflake]
+        return self._connectors
+
+    def get_models(self) -> Dict[str, object]:
+        """
+        Return the models and preprocessors, unpickling them only once.
+
+        Returns:
+            Dict[str, object]: Loaded objects keyed as in MODEL_FILES.
+        """
+        if self._models is None:
+            models = {name: self.load_model(name) for name in self.MODEL_FILES}
+            with self._lock:
+                if self._models is None:
+                    self._models = models
+        return self._models
+
+    def load_model(self, name: str):
+        """
+        Return one of the models of MODEL_FILES, unpickling it only once.
+        """
+        with self._model_locks[name]:
+            if name not in self._model_objects:
+                self._model_objects[name] = PickleManager(self.pickle_folder).load_pickle(self.MODEL_FILES[name])
+            return self._model_objects[name]
+
+    def warm_up(self, reference: bool = True, max_workers: int = 8,
+                timeout: float = None) -> Dict[str, dict]:
+        """
+        Build everything a request needs (config, credentials, models,
+        connectors with their sessions, controller and reference data) at
+        the same time with a StartupInitializer, so a cold start takes about
+        as long as its slowest step instead of the sum of them.
+
+        Parameters:
+            reference (bool): Load the reference data too.
+            max_workers (int): Steps run at the same time.
+            timeout (float, optional): Seconds to wait; the steps still
+            running go on in the background.
+
+        Returns:
+            Dict[str, dict]: The report of StartupInitializer.run, also kept
+            in startup_report. Failed steps don't raise; they are built
+            again by the first request that needs them.
+        """
+        initializer = StartupInitializer(max_workers)
+        initializer.add('config', self.get_config)
+        initializer.add('credentials', self.get_credentials)
+        for name in self.MODEL_FILES:
+            initializer.add(f'model:{name}', lambda name=name: self.load_model(name))
+        initializer.add('models', self.get_models, [f'model:{name}' for name in self.MODEL_FILES])
+        initializer.add('connectors', self.get_connectors, ['config', 'credentials'])
+        # Logins, kept open by the connectors for the requests
+        initializer.add('snowflake', lambda: self._get_connector(SnowflakeConnection).get_connection(),
+                        ['connectors'])
+        initializer.add('rds', lambda: self._get_connector(PostgreSQLConnection).connect(),
+                        ['connectors'])
+        initializer.add('controller', self.get_controller, ['connectors'])
+        if reference:
+            initializer.add('reference', lambda: self.get_reference_index(self.get_controller().eiv_services),
+                            ['controller'])
+
+        self.startup_report = initializer.run(timeout)
+        return self.startup_report
+
+    def _get_connector(self, connection_type: type) -> InterfaceConnection:
+        for connector in self.get_connectors():
+            if isinstance(connector, connection_type):
+                return connector
+        raise Exception(f"No {connection_type.__name__} found in the list of connectors.")
+
+    def get_reference_index(self, source: EIVService) -> ReferenceIndex:
+        """
+        Return the ReferenceIndex of the EIV reference data, loading the data
+        from Snowflake only when there is no copy yet or the current copy is
+        older than reference_ttl and the table changed. The index is built
+        once per version of the data.
+
+        The data is kept in memory and in the local snapshot (see
+        get_reference_snapshot), shared with the other processes of the
+        container; its version is kept in reference_version.
+
+        Parameters:
+            source (EIVService): Service that loads the data.
+
+        Returns:
+            ReferenceIndex: The index, with the data and its version. Callers
+            must not modify the data.
+        """
+        if not self._reference_is_usable():
+            with self._reference_lock:
+                if not self._reference_is_usable():
+                    return self._load_reference(source)
+        return self._reference_index
+
+    def refresh_reference(self, source: EIVService) -> ReferenceIndex:
+        """
+        Load the reference data again if its snapshot expired (see
+        ReferenceSnapshot.load) and publish it, off the request path.
+
+        Parameters:
+            source (EIVService): Service that loads the data.
+
+        Returns:
+            ReferenceIndex: The index published.
+
+        Process:
+            - Builds the new ReferenceIndex while requests keep using the
+              current one, and swaps it in with a single assignment once it
+              is complete, so readers never block nor see a partial index.
+        """
+        with self._reference_lock:
+            return self._load_reference(source)
+
+    def _load_reference(self, source: EIVService) -> ReferenceIndex:
+        # Called with _reference_lock held
+        current = self._reference_index
+        data, manifest = self.get_reference_snapshot().load(
+            source, self.reference_version,
+            current.data if current is not None else None)
+
+        index = current
+        if current is None or current.version != manifest['version']:
+            # The first process to build the index of a snapshot shares its
+            # arrays with the others
+            snapshot = self.get_reference_snapshot()
+            arrays = snapshot.read_index(manifest)
+            index = ReferenceIndex(data, manifest['version'], arrays)
+            if arrays is None:
+                snapshot.write_index(manifest, index.arrays())
+
+        # The copy expires with the snapshot it was read from
+        age = max(time.time() - manifest['created_at'], 0.0)
+        self._reference_manifest = manifest
+        self._reference_loaded_at = time.monotonic() - age
+        if manifest['version'] != self.reference_version and self._prediction_cache is not None:
+            self._prediction_cache.clear()
+        self.reference_version = manifest['version']
+        self._reference_index = index
+        return index
+
+    def _reference_is_usable(self) -> bool:
+        if self._reference_index is None:
+            return False
+        age = time.monotonic() - self._reference_loaded_at
+        # While the refresher runs, the data is refreshed off the request
+        # path, unless its refreshes failed for longer than max_age
+        if self._reference_refresher is not None and self._reference_refresher.is_alive():
+            return age < self._reference_max_age
+        return age < self.reference_ttl
+
+    def start_reference_refresher(self, source: EIVService,
+                                  interval: float = None) -> ReferenceRefresher:
+        """
+        Start the background thread that refreshes the reference data, for
+        long-running processes (see server.py); Lambda containers are
+        frozen between invocations and refresh on the request path.
+
+        While it runs, requests keep using the data it last loaded, until
+        it is older than 'reference: max_age' in config.yaml (by default
+        four times reference_ttl) because the refreshes fail; the requests
+        then load it again themselves.
+
+        Parameters:
+            source (EIVService): Service that loads the data.
+            interval (float, optional): Seconds between refreshes, by default
+            'reference: refresh_interval' in config.yaml, or a quarter of
+            reference_ttl.
+
+        Returns:
+            ReferenceRefresher: The running refresher.
+        """
+        with self._reference_lock:
+            if self._reference_refresher is None or not self._reference_refresher.is_alive():
+                reference_config = self.get_config().get('reference') or {}
+                if interval is None:
+                    interval = float(reference_config.get('refresh_interval') or self.reference_ttl / 4)
+                self._reference_max_age = float(reference_config.get('max_age') or self.reference_ttl * 4)
+                # Built before the thread starts, as it takes _lock
+                self.get_reference_snapshot()
+                self._reference_refresher = ReferenceRefresher(lambda: self.refresh_reference(source),
+                                                               interval)
+                self._reference_refresher.start()
+        return self._reference_refresher
+
+    def get_reference_status(self) -> dict:
+        """
+        Return the version of the reference data in use, its age (seconds
+        since its snapshot was created), how it was last refreshed, whether
+        it is older than the max_age of the refresher (see
+        start_reference_refresher) and the stats of the refresher, if any.
+        """
+        manifest = self._reference_manifest
+        refresher = self._reference_refresher
+        age = time.time() - manifest['created_at'] if manifest is not None else None
+        return {'version': self.reference_version,
+                'age': age,
+                'refresh': manifest.get('refresh') if manifest is not None else None,
+                'stale': (age is not None and self._reference_max_age is not None
+                          and age >= self._reference_max_age),
+                'refresher': refresher.stats() if refresher is not None else None}
+
+    def get_reference_snapshot(self) -> ReferenceSnapshot:
+        """
+        Return the local snapshot of the reference data, set by the
+        'reference' section of config.yaml: snapshot_dir, and the table,
+        watermark_column and full_refresh_interval of the incremental
+        refresh.
+        """
+        if self._reference_snapshot is None:
+            with self._lock:
+                if self._reference_snapshot is None:
+                    reference_config = self.get_config().get('reference') or {}
+                    self._reference_snapshot = ReferenceSnapshot(
+                        reference_config.get('snapshot_dir', '/tmp/eiv_reference'),
+                        self.reference_ttl,
+                        reference_config.get('table'),
+                        reference_config.get('watermark_column'),
+                        float(reference_config.get('full_refresh_interval') or 86400))
+        return self._reference_snapshot
+
+    def use_reference_pushdown(self, vobs: int) -> bool:
+        """
+        Tell whether a request should load only the reference rows of its
+        VOBs (see EIVService.load_reference_rows) instead of the whole data.
+
+        Set by 'reference: pushdown_max_vobs' (default 25, 0 to disable) and
+        'reference: pushdown_requests' (default 20) in config.yaml.
+
+        Parameters:
+            vobs (int): VOBs in the request.
+
+        Returns:
+            bool: True while the container is cold (no reference data in
+            memory nor a fresh local snapshot), the request has at most
+            pushdown_max_vobs VOBs and fewer than pushdown_requests requests
+            were served this way; after that the whole data is loaded once
+            and reused.
+        """
+        if self._reference_index is not None:
+            return False
+
+        reference_config = self.get_config().get('reference') or {}
+        max_vobs = int(reference_config.get('pushdown_max_vobs', 25))
+        max_requests = int(reference_config.get('pushdown_requests', 20))
+        if vobs > max_vobs:
+            return False
+
+        manifest = self.get_reference_snapshot().read_manifest()
+        if manifest is not None and time.time() - manifest['created_at'] < self.reference_ttl:
+            return False
+
+        with self._lock:
+            if self._reference_pushdowns >= max_requests:
+                return False
+            self._reference_pushdowns += 1
+        return True
+
+    def get_reference_manifest(self) -> dict:
+        """
+        Return the manifest of the reference data in use (see
+        ReferenceSnapshot.load), or None if it isn't loaded yet.
+        """
+        return self._reference_manifest
+
+    def get_prediction_cache(self) -> PredictionCache:
+        """
+        Return the cache of the model outputs shared by every request. Its
+        entries live as long as the reference data they were computed from.
+        """
+        if self._prediction_cache is None:
+            with self._lock:
+                if self._prediction_cache is None:
+                    self._prediction_cache = PredictionCache(self.prediction_cache_size,
+                                                             self.reference_ttl)
+        return self._prediction_cache
+
+    def get_query_cache(self) -> QueryResultCache:
+        """
+        Return the cache of the results of the read queries shared by every
+        repository, set by the 'query_cache' section of config.yaml: ttl,
+        max_bytes, and the directory and max_disk_bytes of its disk tier.
+        """
+        if self._query_cache is None:
+            with self._lock:
+                if self._query_cache is None:
+                    cache_config = self.get_config().get('query_cache') or {}
+                    self._query_cache = QueryResultCache(
+                        int(cache_config.get('max_bytes') or 64 * 1024 * 1024),
+                        float(cache_config.get('ttl') or 0),
+                        cache_config.get('directory') or None,
+                        int(cache_config.get('max_disk_bytes') or 256 * 1024 * 1024))
+        return self._query_cache
+
+    def get_prediction_writer(self) -> PredictionWriter:
+        """
+        Return the write-behind queue saving the predictions into RDS, set by
+        the 'prediction_writer' section of config.yaml.
+        """
+        if self._prediction_writer is None:
+            with self._lock:
+                if self._prediction_writer is None:
+                    writer_config = self.get_config().get('prediction_writer') or {}
+                    eiv_services = self.get_controller().eiv_services
+                    self._prediction_writer = PredictionWriter(
+                        eiv_services.save_data_with_cashrepository,
+                        int(writer_config.get('max_pending_rows', 50000)),
+                        int(writer_config.get('batch_rows', 1000)),
+                        float(writer_config.get('flush_interval', 1)),
+                        int(writer_config.get('max_retries', 5)),
+                        spill_dir=writer_config.get('spill_dir') or '/tmp/eiv_spill')
+        return self._prediction_writer
+
+    def flush_predictions(self, timeout: float = None) -> bool:
+        """
+        Save the predictions queued by the PredictionWriter before the Lambda
+        container is frozen, waiting for RDS up to timeout seconds; the ones
+        left are spilled to disk and saved after the container is thawed
+        (see PredictionWriter.spill_pending).
+
+        Parameters:
+            timeout (float, optional): Seconds to wait, by default
+            'prediction_writer: lambda_flush_timeout' in config.yaml.
+
+        Returns:
+            bool: True if every prediction was saved.
+        """
+        if self._prediction_writer is None:
+            return True
+
+        if timeout is None:
+            writer_config = self.get_config().get('prediction_writer') or {}
+            timeout = float(writer_config.get('lambda_flush_timeout', 2))
+        if self._prediction_writer.flush(timeout):
+            return True
+        self._prediction_writer.spill_pending()
+        return False
+
+    def get_controller(self) -> EIVController:
+        """
+        Return the EIVController bound to the shared connectors and to this
+        context.
+        """
+        if self._controller is None:
+            with self._lock:
+                if self._controller is None:
+                    self._controller = EIVController(self.get_connectors(),
+                                                     app_context=self)
+        return self._controller
+
+    def reset(self):
+        """
+        Save the queued predictions, close the connectors and drop every
+        cached resource, so the next call builds them again. Used on
+        shutdown and by tests.
+        """
+        if self._reference_refresher is not None:
+            self._reference_refresher.stop()
+            self._reference_refresher = None
+
+        # Save the queued predictions before the connectors are closed
+        if self._prediction_writer is not None:
+            self._prediction_writer.close()
+
+        with self._lock:
+            for connector in self._connectors or []:
+                try:
+                    connector.disconnect()
+                except Exception:
+                    pass
+            self._clear()
+
+
+_app_context = AppContext()
+
+
+def get_app_context() -> AppContext:
+    """
+    Return the AppContext of the current process.
+    """
+    return _app_context
+
+
+def reset():
+    """
+    Reset the AppContext of the current process.
+    """
+    _app_context.reset()
@@ -0,0 +1,281 @@
+import argparse
+import json
+import multiprocessing
+import os
+import warnings
+from collections import deque
+from typing import Dict, Iterator, List, Tuple
+import pandas as pd
+import pyarrow.parquet as pq
+from app_context import AppContext
+from controller.eiv_controller import EIVController, SCENARIOS
+from services.eiv_services import EIVService
+from services.reference_index import ReferenceIndex
+from services.reference_snapshot import ReferenceSnapshot
+from services.vob_validator import VOB_SCHEMA, VOB_VALIDATOR
+
+# Fields read as text from CSV files, so ids like '00123' are kept as sent
+TEXT_FIELDS = [field for field, rule in VOB_SCHEMA.items()
+               if rule in ('id', 'name', 'funding', 'text')]
+
+PROGRESS_FILE = '_progress.json'
+
+# Worker state, set once per process by _init_worker
+_worker_controller = None
+_worker_models = None
+_worker_reference_index = None
+
+
+class BatchScorer:
+    """
+    Score a CSV or Parquet file of VOBs offline, chunk by chunk, with a pool
+    of worker processes, writing the predictions to Parquet.
+
+    Variables:
+        input_path (str): CSV or Parquet file with one VOB per row, with the
+        same fields as the Lambda request.
+        output_dir (str): Folder of the Parquet part files and the progress
+        manifest.
+        chunk_size (int): VOBs scored by a worker at a time.
+        workers (int): Number of worker processes.
+        scenario (str): Branches scored for every VOB, see
+        controller.eiv_controller.SCENARIOS; None for the branch of its SCA
+        value.
+
+    Interactions:
+        - Loads the models and the reference data (with its ReferenceIndex)
+          once with an AppContext and hands the models to every worker when
+          the pool starts. Workers map the reference snapshot written by the
+          AppContext (see ReferenceSnapshot) instead of getting a copy of
+          it, unless it couldn't be written.
+        - Workers validate with VOB_VALIDATOR and score with
+          EIVController.score; nothing is saved into RDS.
+    """
+
+    def __init__(self, input_path: str, output_dir: str,
+                 chunk_size: int = 5000, workers: int = None,
+                 scenario: str = 'both'):
+        """
+        Initializes the BatchScorer object.
+
+        Parameters:
+            input_path (str): CSV or Parquet file of VOBs.
+            output_dir (str): Folder for the results, created if needed.
+            chunk_size (int): VOBs per chunk.
+            workers (int): Worker processes, by default one per CPU.
+            scenario (str): Branches scored, both by default.
+
+        Returns:
+            None
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size should be positive")
+
+        self.input_path = os.path.abspath(input_path)
+        self.output_dir = os.path.abspath(output_dir)
+        self.chunk_size = chunk_size
+        self.workers = workers or os.cpu_count() or 1
+        self.scenario = scenario
+
+    def run(self, app_context: AppContext = None) -> dict:
+        """
+        Score every chunk of the input file not scored by a previous run.
+
+        Parameters:
+            app_context (AppContext, optional): Context used to load the
+            models and the reference data.
+
+        Returns:
+            dict: The progress manifest, with the rows, scored and failed
+            VOBs of every completed chunk.
+
+        Process:
+            - Reads the input in chunks; chunks already in the manifest are
+              skipped, so an interrupted run resumes where it stopped.
+            - Keeps at most two chunks per worker in flight.
+            - Every worker writes 'part-<chunk>.parquet' with the predictions
+              and 'errors-<chunk>.parquet' with the failed VOBs of its chunk.
+            - The manifest is updated after each chunk.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        progress = self.load_progress()
+        completed = progress['completed']
+
+        app_context = app_context or AppContext()
+        models = app_context.get_models()
+        eiv_services = EIVService(app_context.get_connectors(), app_context.get_query_cache())
+        reference_index = app_context.get_reference_index(eiv_services)
+
+        # Workers read the snapshot files themselves when they exist
+        snapshot = app_context.get_reference_snapshot()
+        manifest = app_context.get_reference_manifest()
+        if snapshot.read(manifest) is not None and snapshot.read_index(manifest) is not None:
+            reference_index = None
+
+        try:
+            with multiprocessing.Pool(self.workers, initializer=_init_worker,
+                                      initargs=(models, snapshot.directory, manifest,
+                                                reference_index)) as pool:
+                pending = deque()
+                for chunk_id, offset, records in self.read_chunks():
+                    if str(chunk_id) in completed:
+                        continue
+
+                    pending.append(pool.apply_async(_score_chunk,
+                                                    ((chunk_id, offset, records, self.output_dir,
+                                                      self.scenario),)))
+                    while len(pending) >= 2 * self.workers:
+                        self._complete(pending.popleft().get(), progress)
+
+                while pending:
+                    self._complete(pending.popleft().get(), progress)
+        except Exception as e:
+            raise Exception(f"Error scoring '{self.input_path}': {str(e)}")
+
+        return progress
+
+    def read_chunks(self) -> Iterator[Tuple[int, int, List[dict]]]:
+        """
+        Read the input file in chunks of chunk_size VOBs.
+
+        Returns:
+            Iterator[Tuple[int, int, List[dict]]]: Chunk number, row of the
+            file of its first VOB, and its VOBs as dicts of Python values
+            (missing values as None).
+        """
+        if self.input_path.endswith('.parquet'):
+            frames = (batch.to_pandas() for batch in
+                      pq.ParquetFile(self.input_path).iter_batches(batch_size=self.chunk_size))
+        elif self.input_path.endswith('.csv'):
+            frames = pd.read_csv(self.input_path, chunksize=self.chunk_size,
+                                 dtype={field: str for field in TEXT_FIELDS})
+        else:
+            raise ValueError(f"Unsupported input file '{self.input_path}', expected .csv or .parquet")
+
+        offset = 0
+        for chunk_id, frame in enumerate(frames):
+            records = frame.astype(object).where(frame.notna(), None).to_dict('records')
+            yield chunk_id, offset, records
+            offset += len(records)
+
+    def load_progress(self) -> dict:
+        """
+        Load the progress manifest of the output folder, or start a new one.
+
+        Returns:
+            dict: 'input', 'chunk_size', 'scenario' and 'completed'
+            {chunk: summary}.
+
+        Raises:
+            ValueError: If the folder holds the results of another input
+            file, chunk size or scenario, which can't be resumed.
+        """
+        path = os.path.join(self.output_dir, PROGRESS_FILE)
+        if not os.path.exists(path):
+            return {'input': self.input_path, 'chunk_size': self.chunk_size,
+                    'scenario': self.scenario, 'completed': {}}
+
+        with open(path, 'r') as file:
+            progress = json.load(file)
+
+        if (progress['input'], progress['chunk_size'], progress.get('scenario')) != \
+                (self.input_path, self.chunk_size, self.scenario):
+            raise ValueError(f"'{self.output_dir}' has the results of '{progress['input']}' "
+                             f"with chunk size {progress['chunk_size']} and scenario "
+                             f"{progress.get('scenario')}; use another output folder")
+        return progress
+
+    def _complete(self, summary: dict, progress: dict):
+        # Record a finished chunk; the manifest is replaced atomically so an
+        # interruption never leaves it half written
+        progress['completed'][str(summary.pop('chunk'))] = summary
+        _write_atomic(os.path.join(self.output_dir, PROGRESS_FILE),
+                      lambda path: _dump_json(progress, path))
+
+
+def _init_worker(models: dict, snapshot_directory: str, manifest: dict,
+                 reference_index: ReferenceIndex = None):
+    global _worker_controller, _worker_models, _worker_reference_index
+    warnings.filterwarnings("ignore")
+    _worker_controller = EIVController([])
+    _worker_models = models
+    _worker_reference_index = reference_index
+    if reference_index is None:
+        # Memory-mapped, so the pages are shared with the other workers
+        snapshot = ReferenceSnapshot(snapshot_directory)
+        data = snapshot.read(manifest)
+        arrays = snapshot.read_index(manifest)
+        if data is not None and arrays is not None:
+            _worker_reference_index = ReferenceIndex(data, manifest['version'], arrays)
+
+
+def _score_chunk(task: Tuple[int, int, List[dict], str, str]) -> dict:
+    chunk_id, offset, records, output_dir, scenario = task
+    if _worker_reference_index is None:
+        # An exception in _init_worker would restart the worker forever
+        raise Exception("Reference snapshot not found; it was removed while scoring")
+
+    body, errors = VOB_VALIDATOR.validate(records)
+    if body.empty:
+        df_eiv = pd.DataFrame()
+    else:
+        df_eiv, category_errors = _worker_controller.score(body, _worker_models,
+                                                           _worker_reference_index,
+                                                           scenario=scenario)
+        errors.update(category_errors)
+
+    # Row of the input file of every VOB
+    df_eiv.insert(0, 'ROW_NUMBER', df_eiv.index + offset)
+    df_errors = pd.DataFrame([{'ROW_NUMBER': row + offset, 'FIELD': failure['field'],
+                               'TYPE': failure['type'], 'ERROR': failure['error']}
+                              for row, failures in sorted(errors.items())
+                              for failure in failures],
+                             columns=['ROW_NUMBER', 'FIELD', 'TYPE', 'ERROR'])
+
+    for name, frame in (('errors', df_errors), ('part', df_eiv)):
+        _write_atomic(os.path.join(output_dir, f'{name}-{chunk_id:06d}.parquet'),
+                      lambda path: frame.to_parquet(path, index=False))
+
+    return {'chunk': chunk_id, 'rows': len(records), 'scored': len(df_eiv),
+            'failed': len(errors)}
+
+
+def _write_atomic(path: str, write):
+    temporary_path = path + '.tmp'
+    write(temporary_path)
+    os.replace(temporary_path, path)
+
+
+def _dump_json(data: dict, path: str):
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=1)
+
+
+def main(argv: List[str] = None) -> Dict[str, dict]:
+    parser = argparse.ArgumentParser(description="Score a CSV or Parquet file of VOBs into Parquet files.")
+    parser.add_argument('input', help="CSV or Parquet file with one VOB per row")
+    parser.add_argument('output_dir', help="folder for the results and the progress manifest; "
+                                           "running again with the same folder resumes")
+    parser.add_argument('--chunk-size', type=int, default=5000, help="VOBs per chunk (default: 5000)")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument('--scenario', choices=[*SCENARIOS, 'auto'], default='both',
+                        help="branches to score; auto scores the one of the SCA value of each VOB (default: both)")
+    args = parser.parse_args(argv)
+
+    warnings.filterwarnings("ignore")
+    scorer = BatchScorer(args.input, args.output_dir, args.chunk_size, args.workers,
+                         None if args.scenario == 'auto' else args.scenario)
+
+    # The pickles, SQL and YAML files are read relative to the app folder
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    progress = scorer.run()
+
+    summaries = progress['completed'].values()
+    print(f"{sum(summary['scored'] for summary in summaries)} VOBs scored, "
+          f"{sum(summary['failed'] for summary in summaries)} failed, "
+          f"results in '{scorer.output_dir}'")
+    return progress
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-from typing import Union
+from typing import Iterator, Union
 import pandas as pd
 
 class InterfaceConnection:
@@ -53,12 +53,14 @@ class InterfaceConnection:
         """
         raise NotImplementedError("disconnect() method must be implemented in the child class.")
 
-    def execute_query(self, query: str) -> Union[pd.DataFrame, None]:
+    def execute_query(self, query: str, params: dict = None) -> Union[pd.DataFrame, None]:
         """
         Executes a SQL query on the connected database and returns the results as a DataFrame.
 
         Parameters:
             query (str): SQL query to execute.
+            params (dict, optional): Values bound to the placeholders of the
+            query.
 
         Returns:
             Union[pd.DataFrame, None]: A DataFrame containing the results of the query.
@@ -71,3 +73,27 @@ class InterfaceConnection:
             it should return None.
         """
         raise NotImplementedError("execute_query() method must be implemented in the child class.")
+
+    def iter_query(self, query: str, chunk_rows: int = 50000,
+                   params: dict = None) -> Iterator[pd.DataFrame]:
+        """
+        Executes a SQL query and yields its results in chunks, so they are
+        never held in memory at once.
+
+        Parameters:
+            query (str): SQL query to execute.
+            chunk_rows (int): Rows of every chunk; the last one may have
+            fewer.
+            params (dict, optional): Values bound to the placeholders of the
+            query.
+
+        Returns:
+            Iterator[pd.DataFrame]: The results, chunk by chunk. Nothing is
+            yielded when the query returns no rows.
+
+        Process:
+            This is an abstract method that should be implemented in the child classes.
+            The results must be read from the database as the chunks are consumed, and
+            the resources of the query released when the iterator is exhausted or closed.
+        """
+        raise NotImplementedError("iter_query() method must be implemented in the child class.")
@@ -1,14 +1,27 @@
 import psycopg2
 import pandas as pd
-from typing import Union
+from psycopg2.extras import execute_values
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from typing import Iterable, Iterator, List, Sequence, Union
 from connectors.interface_connection import InterfaceConnection
 
 class PostgreSQLConnection(InterfaceConnection):
     """
     Connects to PostgreSQL, executes queries, and returns dataframes.
+
+    Keeps a pool of connections shared by the threads of the process: every
+    query borrows one (the most recently used, so the others can be closed
+    by the server when idle) and gives it back when it ends.
     """
 
-    def __init__(self, host: str, port: str, database: str, user: str, password: str):
+    def __init__(self, host: str, port: str, database: str, user: str, password: str,
+                 min_size: int = 1, max_size: int = 4, checkout_timeout: float = 10.0,
+                 statement_timeout: int = 30000, health_check_after: float = 30.0):
         """
         Initializes the PostgreSQLConnection object.
 
@@ -18,6 +31,16 @@ class PostgreSQLConnection(InterfaceConnection):
             database (str): PostgreSQL database name.
             user (str): PostgreSQL username.
             password (str): PostgreSQL password.
+            min_size (int): Connections opened by connect and kept idle.
+            max_size (int): Connections open at most; queries wait for a
+            free one beyond that.
+            checkout_timeout (float): Seconds a query waits for a free
+            connection before failing.
+            statement_timeout (int): Milliseconds a statement may run before
+            PostgreSQL cancels it, 0 for no limit.
+            health_check_after (float): Connections idle for longer are
+            checked with 'select 1' before they are used; 0 checks them
+            always.
 
         Returns:
             None
@@ -25,12 +48,30 @@ class PostgreSQLConnection(InterfaceConnection):
         Process:
             - Saves the provided connection details as class attributes.
         """
+        if max_size < 1 or not 0 <= min_size <= max_size:
+            raise ValueError("Pool sizes should be 0 <= min_size <= max_size and max_size >= 1")
+
         self.host = host
         self.port = port
         self.database = database
         self.user = user
         self.password = password
-        self.connection = None
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.statement_timeout = statement_timeout
+        self.health_check_after = health_check_after
+        # Idle connections with the time they were given back
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self.created = 0
+        self.discarded = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+        self.health_check_failures = 0
 
     def connect(self):
         """
@@ -43,21 +84,30 @@ class PostgreSQLConnection(InterfaceConnection):
             None
 
         Process:
-            - Uses psycopg2 library to establish a connection to PostgreSQL using
-              the provided host, port, database, user, and password.
-            - Assigns the connection to the 'self.connection' attribute.
+            - Uses psycopg2 library to open connections to PostgreSQL using
+              the provided host, port, database, user, and password, until
+              min_size are idle in the pool.
         """
+        while self._idle.qsize() < self.min_size:
+            self._idle.put((self._open(), time.monotonic()))
+
+    def _open(self):
         try:
-            self.connection = psycopg2.connect(
+            connection = psycopg2.connect(
                 host=self.host,
                 port=self.port,
                 database=self.database,
                 user=self.user,
-                password=self.password
+                password=self.password,
+                options=f'-c statement_timeout={int(self.statement_timeout)}'
             )
         except Exception as e:
             raise Exception(f"Error connecting to PostgreSQL: {str(e)}")
 
+        with self._lock:
+            self.created += 1
+        return connection
+
     def disconnect(self):
         """
         Disconnects from the PostgreSQL database.
@@ -69,53 +119,173 @@ class PostgreSQLConnection(InterfaceConnection):
             None
 
         Process:
-            - Closes the active PostgreSQL connection.
+            - Closes the idle connections of the pool; the ones in use are
+              given back to it when their query ends.
         """
-        if self.connection is not None:
-            self.connection.close()
-            self.connection = None
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(connection)
 
-    def execute_query(self, query: str) -> Union[pd.DataFrame, None]:
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._lock:
+            self.discarded += 1
+
+    def acquire(self):
+        """
+        Borrow a connection of the pool; give it back with release.
+
+        Returns:
+            connection: An open psycopg2 connection, not in a transaction.
+
+        Raises:
+            TimeoutError: If max_size connections are in use for longer than
+            checkout_timeout seconds.
+
+        Process:
+            - Takes the most recently given back idle connection, checking
+              it first when it was idle for more than health_check_after
+              seconds, or opens a new one if there are none.
+        """
+        started_at = time.monotonic()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise TimeoutError(f"No PostgreSQL connection free after {self.checkout_timeout} seconds")
+
+        waited = time.monotonic() - started_at
+        try:
+            while True:
+                try:
+                    connection, idle_since = self._idle.get_nowait()
+                except queue.Empty:
+                    connection = self._open()
+                    break
+                if self._is_healthy(connection, idle_since):
+                    break
+                self._close(connection)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self.checkouts += 1
+            if waited > 0.001:
+                self.waits += 1
+                self.wait_seconds += waited
+        return connection
+
+    def _is_healthy(self, connection, idle_since: float) -> bool:
+        if connection.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_after:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('select 1')
+            connection.rollback()
+            return True
+        except Exception:
+            with self._lock:
+                self.health_check_failures += 1
+            return False
+
+    def release(self, connection):
+        """
+        Give a connection back to the pool, rolling back its open
+        transaction if any; broken connections are closed.
+        """
+        try:
+            if connection.closed:
+                self._close(connection)
+                return
+            try:
+                if connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+            except Exception:
+                self._close(connection)
+                return
+            self._idle.put((connection, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def borrow(self):
+        """
+        Borrow a connection of the pool for the block of a with statement.
+        """
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def stats(self) -> dict:
+        """
+        Return the connections open, idle and in use, created and closed,
+        the checkouts, how many of them waited for a free connection (and
+        for how long in total), the checkouts that timed out and the failed
+        health checks.
+        """
+        with self._lock:
+            open_connections = self.created - self.discarded
+            idle = self._idle.qsize()
+            return {'open': open_connections,
+                    'idle': idle,
+                    'in_use': open_connections - idle,
+                    'min_size': self.min_size,
+                    'max_size': self.max_size,
+                    'created': self.created,
+                    'discarded': self.discarded,
+                    'checkouts': self.checkouts,
+                    'waits': self.waits,
+                    'wait_seconds': self.wait_seconds,
+                    'timeouts': self.timeouts,
+                    'health_check_failures': self.health_check_failures}
+
+    def execute_query(self, query: str, params: dict = None) -> Union[pd.DataFrame, None]:
         """
         Executes a SQL query on the connected PostgreSQL database and returns the results as a DataFrame.
 
         Parameters:
             query (str): SQL query to execute.
+            params (dict, optional): Values bound to the %(name)s
+            placeholders of the query.
 
         Returns:
             Union[pd.DataFrame, None]: A DataFrame containing the results of the query.
                                        Returns None if the connection is not established.
 
         Process:
-            - Executes the provided SQL query on the PostgreSQL database using the
-              active connection.
+            - Executes the provided SQL query on the PostgreSQL database using a
+              connection borrowed from the pool.
             - Fetches the results and converts them into a pandas DataFrame.
             - Returns the DataFrame or None if the connection is not established.
         """
         try:
-            # Connect to the database if not connected already
-            if self.connection is None:
-                self.connect()
-                
             # Remove leading comments, if any
             clean_query = query.strip().lstrip('-')
-                
-            with self.connection.cursor() as cursor:
-                # Execute the query without parameters
-                cursor.execute(clean_query)
-                
-                
+
+            with self.borrow() as connection, connection.cursor() as cursor:
+                cursor.execute(clean_query, params)
+
+
                 if query.strip().lower().startswith("insert") | query.strip().lower().startswith("update"):
                     # For other queries (e.g., INSERT, UPDATE), commit the transaction
-                    self.connection.commit()
-                    
+                    connection.commit()
+
                     # No result to return for non-SELECT queries
                     return None
                 else:
                     # If it's a SELECT query, fetch the result and construct a DataFrame
+                    # (the transaction is rolled back when the connection is released)
                     result = cursor.fetchall()
-                    cursor.close()
-                    self.disconnect()
 
                     if result:
                         columns = [desc[0] for desc in cursor.description]
@@ -123,6 +293,97 @@ class PostgreSQLConnection(InterfaceConnection):
                         return df
                     else:
                         return pd.DataFrame()
-            
+
+        except Exception as e:
+            raise Exception(f"Error executing query: {str(e)}")
+
+    def execute_batches(self, query: str, rows: Iterable[Sequence], batch_rows: int = 1000,
+                        before: Sequence[str] = (), after: Sequence[str] = ()) -> List[dict]:
+        """
+        Executes a query with a VALUES list for rows, batch by batch.
+
+        Parameters:
+            query (str): SQL query with a single %s placeholder for the
+            VALUES list, e.g. 'insert into t (a, b) values %s'.
+            rows (Iterable[Sequence]): Values of every row, bound as typed
+            parameters.
+            batch_rows (int): Rows of every batch.
+            before (Sequence[str]): Statements run before query in the
+            transaction of every batch, e.g. creating a staging table.
+            after (Sequence[str]): Statements run after query in the
+            transaction of every batch, e.g. merging the staging table.
+
+        Returns:
+            List[dict]: 'batch', 'rows' and 'seconds' of every batch.
+
+        Process:
+            - Every batch is a transaction of its own on a connection of the
+              pool: the before statements, query with all the rows of the
+              batch sent with execute_values in one statement, the after
+              statements and the commit.
+            - A failed batch is rolled back; the batches before it stay
+              committed.
+        """
+        if batch_rows < 1:
+            raise ValueError("batch_rows should be positive")
+
+        timings = []
+        rows = list(rows)
+        try:
+            with self.borrow() as connection:
+                for start in range(0, len(rows), batch_rows):
+                    batch = rows[start:start + batch_rows]
+                    started_at = time.monotonic()
+                    with connection.cursor() as cursor:
+                        for statement in before:
+                            cursor.execute(statement)
+                        execute_values(cursor, query, batch, page_size=len(batch))
+                        for statement in after:
+                            cursor.execute(statement)
+                    connection.commit()
+                    timings.append({'batch': len(timings), 'rows': len(batch),
+                                    'seconds': time.monotonic() - started_at})
+            return timings
+        except Exception as e:
+            raise Exception(f"Error executing batch {len(timings)}: {str(e)}")
+
+    def iter_query(self, query: str, chunk_rows: int = 50000,
+                   params: dict = None) -> Iterator[pd.DataFrame]:
+        """
+        Executes a SELECT query on the PostgreSQL database and yields its results in chunks.
+
+        Parameters:
+            query (str): SQL query to execute.
+            chunk_rows (int): Rows of every chunk.
+            params (dict, optional): Values bound to the %(name)s
+            placeholders of the query.
+
+        Returns:
+            Iterator[pd.DataFrame]: The results, chunk by chunk.
+
+        Process:
+            - Executes the query with a server-side (named) cursor, so the
+              rows stay in PostgreSQL until they are fetched.
+            - Fetches chunk_rows rows at a time and converts them into a
+              pandas DataFrame.
+            - Keeps a connection of the pool while iterating, and gives it
+              back when the iteration ends.
+        """
+        try:
+            with self.borrow() as connection:
+                cursor = connection.cursor(name=f'eiv_{uuid.uuid4().hex}')
+                cursor.itersize = chunk_rows
+                try:
+                    cursor.execute(query.strip().lstrip('-'), params)
+                    while True:
+                        result = cursor.fetchmany(chunk_rows)
+                        if not result:
+                            break
+
+                        columns = [desc[0] for desc in cursor.description]
+                        yield pd.DataFrame(result, columns=columns)
+                finally:
+                    cursor.close()
+
         except Exception as e:
             raise Exception(f"Error executing query: {str(e)}")
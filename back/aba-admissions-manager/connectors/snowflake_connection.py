@@ -1,15 +1,33 @@
+import threading
+import time
 import pandas as pd
+import pyarrow as pa
+from concurrent.futures import ThreadPoolExecutor
 from snowflake.connector import connect
-from typing import Union
+from snowflake.connector.errors import TokenExpiredError
+from snowflake.connector.result_batch import ArrowResultBatch
+from typing import Iterator, Union
 from connectors.interface_connection import InterfaceConnection
 
+# Errors of a session that expired or was closed, fixed by logging in again:
+# session no longer exists, session expired, authentication token expired,
+# connection closed and failed to renew the session
+SESSION_EXPIRED_ERRORS = {390111, 390112, 390114, 250002, 252007}
+
+
 class SnowflakeConnection(InterfaceConnection):
     """
     Connects to Snowflake, executes queries, and returns dataframes.
+
+    The session is opened on the first query and kept for the life of the
+    object, with client_session_keep_alive so it doesn't expire while idle;
+    a query failing because it expired anyway logs in again and is run once
+    more.
     """
 
     def __init__(self, account: str, user: str, password: str, database: str, 
-                 schema: str, warehouse: str, role: str):
+                 schema: str, warehouse: str, role: str, fetch_workers: int = 4,
+                 keep_alive: bool = True):
         """
         Initializes the SnowflakeConnection object.
 
@@ -21,6 +39,9 @@ class SnowflakeConnection(InterfaceConnection):
             schema (str): Snowflake schema.
             warehouse (str): Snowflake warehouse name.
             role (str): Snowflake role name.
+            fetch_workers (int): Threads downloading the result batches of a
+            query in parallel.
+            keep_alive (bool): Keep the session alive while idle.
 
         Returns:
             None
@@ -35,7 +56,17 @@ class SnowflakeConnection(InterfaceConnection):
         self.schema = schema
         self.warehouse = warehouse
         self.role = role
+        self.fetch_workers = fetch_workers
+        self.keep_alive = keep_alive
         self.connection = None
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.reconnects = 0
+        self.connect_seconds = 0.0
+        self.last_connect_seconds = None
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.last_query_seconds = None
 
     def connect(self):
         """
@@ -52,19 +83,48 @@ class SnowflakeConnection(InterfaceConnection):
               using the provided account, user, password, database, schema, warehouse, 
               and role.
             - Assigns the connection to the 'self.connection' attribute.
+            - Adds the time taken to connect_seconds.
         """
         try:
+            started_at = time.monotonic()
             self.connection = connect(
                 account=self.account,
                 user=self.user,
                 password=self.password,
                 database=self.database,
                 schema=self.schema,
-                warehouse=self.warehouse
+                warehouse=self.warehouse,
+                client_session_keep_alive=self.keep_alive
             )
+            self.last_connect_seconds = time.monotonic() - started_at
+            self.connect_seconds += self.last_connect_seconds
+            self.connects += 1
         except Exception as e:
             raise Exception(f"Error connecting to Snowflake: {str(e)}")
 
+    def get_connection(self):
+        """
+        Return the open connection, connecting first if there is none or it
+        was closed.
+        """
+        with self._lock:
+            if self.connection is None or self.connection.is_closed():
+                self.connection = None
+                self.connect()
+            return self.connection
+
+    def reconnect(self, expired_connection=None):
+        """
+        Close the connection and log in again, unless another thread already
+        replaced expired_connection.
+        """
+        with self._lock:
+            if expired_connection is not None and self.connection is not expired_connection:
+                return
+            self.disconnect()
+            self.connect()
+            self.reconnects += 1
+
     def disconnect(self):
         """
         Disconnects from the Snowflake database.
@@ -79,48 +139,226 @@ class SnowflakeConnection(InterfaceConnection):
             - Closes the active Snowflake connection.
         """
         if self.connection is not None:
-            self.connection.close()
+            connection = self.connection
             self.connection = None
+            try:
+                connection.close()
+            except Exception:
+                # An expired session can't be closed cleanly
+                pass
+
+    def open_cursor(self, query: str, params: dict = None):
+        """
+        Execute a query on a new cursor of the shared connection.
+
+        Parameters:
+            query (str): SQL query to execute.
+            params (dict, optional): Values bound to the %(name)s
+            placeholders of the query.
+
+        Returns:
+            SnowflakeCursor: The cursor, to be closed by the caller.
 
-    def execute_query(self, query: str) -> Union[pd.DataFrame, None]:
+        Process:
+            - If the query fails because the session expired, logs in again
+              and executes it once more.
+        """
+        for attempt in range(2):
+            connection = self.get_connection()
+            cursor = connection.cursor()
+            try:
+                cursor.execute(query, params)
+                return cursor
+            except Exception as e:
+                cursor.close()
+                if attempt or not is_session_expired(e):
+                    raise
+                self.reconnect(connection)
+
+    def stats(self) -> dict:
+        """
+        Return the logins (and reconnections after an expired session) and
+        the seconds spent on them, apart from the queries run and the seconds
+        spent executing and fetching them.
+        """
+        return {'connected': self.connection is not None,
+                'connects': self.connects,
+                'reconnects': self.reconnects,
+                'connect_seconds': self.connect_seconds,
+                'last_connect_seconds': self.last_connect_seconds,
+                'queries': self.queries,
+                'query_seconds': self.query_seconds,
+                'last_query_seconds': self.last_query_seconds}
+
+    def execute_query(self, query: str, params: dict = None,
+                      as_arrow: bool = False) -> Union[pd.DataFrame, pa.Table, None]:
         """
         Executes a SQL query on the connected Snowflake database and returns the results as a DataFrame.
 
         Parameters:
             query (str): SQL query to execute.
+            params (dict, optional): Values bound to the %(name)s
+            placeholders of the query.
+            as_arrow (bool, optional): Return the results as a pyarrow Table
+            instead of a DataFrame.
 
         Returns:
-            Union[pd.DataFrame, None]: A DataFrame containing the results of the query.
-                                       Returns None if the connection is not established.
+            Union[pd.DataFrame, pa.Table, None]: A DataFrame (or Table) containing the results of the query.
+                                                 Returns None if the connection is not established.
 
         Process:
             - Executes the provided SQL query on the Snowflake database using the
-              active connection.
-            - Fetches the results and converts them into a pandas DataFrame.
+              shared connection (see open_cursor), which stays open for the next
+              queries.
+            - Fetches the results with fetch_arrow (see below) and converts them
+              into a pandas DataFrame, unless as_arrow is set.
             - Returns the DataFrame or None if the connection is not established.
         """
         try:
-            # Connect to the database if not connected already
-            if self.connection is None:
-                self.connect()
-                
             # Remove leading comments, if any
             # clean_query = query.strip().lstrip('-')
 
-            with self.connection.cursor() as cursor:
-                cursor.execute(query)
-                result = cursor.fetchall()
-                
-                cursor.close()
-                self.disconnect()
+            started_at = (time.monotonic(), self.connect_seconds)
+            with self.open_cursor(query, params) as cursor:
+                result = self.fetch_arrow(cursor)
+            self._add_query_time(started_at)
 
-                if result:
-                    columns = [desc[0] for desc in cursor.description]
-                    df = pd.DataFrame(result, columns=columns)
-                    return df
-                else:
-                    return pd.DataFrame()
+            if as_arrow:
+                return result
+            return result.to_pandas(self_destruct=True, split_blocks=True)
 
         except Exception as e:
 
             raise Exception(f"Error executing query: {str(e)}")
+
+    def iter_query(self, query: str, chunk_rows: int = 50000, params: dict = None,
+                   as_arrow: bool = False) -> Iterator[Union[pd.DataFrame, pa.Table]]:
+        """
+        Executes a SQL query on the Snowflake database and yields its results in chunks.
+
+        Parameters:
+            query (str): SQL query to execute.
+            chunk_rows (int): Rows of every chunk.
+            params (dict, optional): Values bound to the %(name)s
+            placeholders of the query.
+            as_arrow (bool, optional): Yield pyarrow Tables instead of
+            DataFrames.
+
+        Returns:
+            Iterator[Union[pd.DataFrame, pa.Table]]: The results, chunk by
+            chunk.
+
+        Process:
+            - Downloads the Arrow result batches of the query in order, at
+              most fetch_workers ahead of the chunk being consumed, so memory
+              is bounded by a few batches whatever the size of the results.
+            - Regroups the batches into chunks of chunk_rows rows.
+            - Closes the cursor when the iteration ends; the connection stays
+              open.
+        """
+        started_at = (time.monotonic(), self.connect_seconds)
+        try:
+            with self.open_cursor(query, params) as cursor, \
+                    ThreadPoolExecutor(max_workers=max(1, self.fetch_workers)) as executor:
+                batches = cursor.get_result_batches()
+
+                if not is_arrow(batches):
+                    # Results not sent as Arrow
+                    columns = [desc[0] for desc in cursor.description or []]
+                    tables = (pa.Table.from_pandas(pd.DataFrame(rows, columns=columns), preserve_index=False)
+                              for rows in iter(lambda: cursor.fetchmany(chunk_rows), []))
+                else:
+                    tables = self._download_in_order(executor, batches, cursor.connection)
+
+                pending = []
+                pending_rows = 0
+                for table in tables:
+                    pending.append(table)
+                    pending_rows += table.num_rows
+                    while pending_rows >= chunk_rows:
+                        chunk = pa.concat_tables(pending)
+                        yield self._to_result(chunk.slice(0, chunk_rows), as_arrow)
+                        pending = [chunk.slice(chunk_rows)]
+                        pending_rows -= chunk_rows
+
+                if pending_rows:
+                    yield self._to_result(pa.concat_tables(pending), as_arrow)
+
+        except Exception as e:
+            raise Exception(f"Error executing query: {str(e)}")
+        finally:
+            self._add_query_time(started_at)
+
+    def _add_query_time(self, started_at: tuple):
+        # Time of the query, without the logins it waited for
+        started_at, connect_seconds = started_at
+        self.last_query_seconds = time.monotonic() - started_at - (self.connect_seconds - connect_seconds)
+        self.query_seconds += self.last_query_seconds
+        self.queries += 1
+
+    def _download_in_order(self, executor: ThreadPoolExecutor, batches: list,
+                           connection) -> Iterator[pa.Table]:
+        # Keep fetch_workers downloads in flight, yielding them in order
+        futures = []
+        for batch in batches:
+            futures.append(executor.submit(batch.to_arrow, connection))
+            if len(futures) > self.fetch_workers:
+                table = futures.pop(0).result()
+                if table.num_rows:
+                    yield table
+        for future in futures:
+            table = future.result()
+            if table.num_rows:
+                yield table
+
+    def _to_result(self, table: pa.Table, as_arrow: bool) -> Union[pd.DataFrame, pa.Table]:
+        if as_arrow:
+            return table
+        return table.to_pandas(split_blocks=True)
+
+    def fetch_arrow(self, cursor) -> pa.Table:
+        """
+        Fetch the results of an executed query as a pyarrow Table.
+
+        Parameters:
+            cursor (SnowflakeCursor): Cursor that executed the query.
+
+        Returns:
+            pa.Table: The results, with the columns of the query even when
+            there are no rows.
+
+        Process:
+            - Downloads the Arrow result batches of the query with
+              fetch_workers threads and concatenates them, without building
+              a Python object per value.
+            - Results not sent as Arrow (e.g. of DDL statements) are fetched
+              as rows.
+        """
+        columns = [desc[0] for desc in cursor.description or []]
+        batches = cursor.get_result_batches()
+
+        if not is_arrow(batches):
+            rows = cursor.fetchall()
+            return pa.Table.from_pandas(pd.DataFrame(rows, columns=columns), preserve_index=False)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.fetch_workers, len(batches)))) as executor:
+            tables = [table for table in executor.map(lambda batch: batch.to_arrow(cursor.connection), batches)
+                      if table.num_columns]
+
+        if not tables:
+            return pa.table({column: pa.array([], pa.null()) for column in columns})
+        return pa.concat_tables(tables)
+
+
+def is_arrow(batches) -> bool:
+    """
+    Tell whether the result batches of a query can be read as Arrow.
+    """
+    return batches is not None and all(isinstance(batch, ArrowResultBatch) for batch in batches)
+
+
+def is_session_expired(error: Exception) -> bool:
+    """
+    Tell whether a query failed because the session expired or was closed.
+    """
+    return isinstance(error, TokenExpiredError) or getattr(error, 'errno', None) in SESSION_EXPIRED_ERRORS
@@ -1,15 +1,84 @@
 from services.eiv_services import EIVService
 from connectors.interface_connection import InterfaceConnection
 from util.util import response_json, response_error_json, receive_json
-from typing import List
+from typing import Dict, List, Tuple, Union
+from datetime import datetime, timezone
 import json
+import numpy as np
 import pandas as pd
 import pickle
 from util.pickle_manager import PickleManager
-from services.eiv_helper import check_bool_values, check_percent, \
-                                check_fundingType, check_ids, \
-                                check_multiplan_variable, \
-                                check_quantities_vob, check_user_name
+from services.vob_validator import VOB_VALIDATOR
+from services.prediction_cache import PredictionCache
+from services.reference_index import ReferenceIndex, compact_reference_data
+
+
+# Fields of the SCA/OON payloads and the prediction column they come from
+RESPONSE_FIELDS = {
+    'EIVPercentage': 'EIV_percentage',
+    'EIVValue': 'EIV_money',
+    'EIVClientType': 'client_type',
+    'PercClientType': 'probability',
+    'EIVZscore': 'z_score',
+    'FinancialStatus': 'financial_status'
+}
+
+# Scenarios a request can ask for, as a bit mask of the branches scored:
+# 1 is SCA (SCA_FLAG 1.0, 'SCA' payload) and 2 is NSCA (SCA_FLAG -1.0, 'OON'
+# payload). Without a scenario every VOB gets the branch of its SCA value.
+SCENARIOS = {'sca': 1, 'nsca': 2, 'both': 3}
+
+# Branches of the predictions: bit, SCA_FLAG, column prefix and payload
+BRANCHES = [(1, 1.0, 'SCA', 'SCA'), (2, -1.0, 'NSCA', 'OON')]
+
+# Responses at least this size are gzip compressed when the client accepts it
+GZIP_MIN_BYTES = 8192
+
+# Largest batch that loads only its own reference rows without AppContext
+PUSHDOWN_MAX_VOBS = 25
+
+
+def accepts_gzip(event) -> bool:
+    """
+    Check the Accept-Encoding header of the lambda event for gzip.
+    """
+    headers = event.get('headers') or {}
+    for name, value in headers.items():
+        if name.lower() == 'accept-encoding' and 'gzip' in str(value).lower():
+            return True
+    return False
+
+
+def read_scenario(event) -> Union[str, None]:
+    """
+    Read the 'scenario' query string parameter of the lambda event.
+
+    Raises:
+        ValueError: If the scenario is not one of SCENARIOS.
+    """
+    parameters = event.get('queryStringParameters') or {}
+    scenario = parameters.get('scenario')
+    if scenario is None:
+        return None
+
+    scenario = str(scenario).lower()
+    if scenario not in SCENARIOS:
+        raise ValueError(f"Scenario should be one of {', '.join(SCENARIOS)}, but it is {scenario}")
+    return scenario
+
+
+def scenario_codes(sca: pd.Series, scenario: str = None) -> np.ndarray:
+    """
+    Return the bit mask of the branches to score for every VOB.
+
+    Parameters:
+        sca (Series): SCA value of every VOB.
+        scenario (str, optional): One of SCENARIOS, or None for the branch
+        of the SCA value of each VOB.
+    """
+    if scenario is None:
+        return np.where(sca.to_numpy(dtype=bool), SCENARIOS['sca'], SCENARIOS['nsca'])
+    return np.full(len(sca), SCENARIOS[scenario])
 
 
 class EIVController:
@@ -26,20 +95,26 @@ class EIVController:
         predict_cashflow: Predict cashflow and return the result.
 
     """
-    def __init__(self, interface_connectors: List[InterfaceConnection]):
+    def __init__(self, interface_connectors: List[InterfaceConnection],
+                 app_context=None):
         """
         Initialize the CashflowController.
 
         Parameters:
             interface_connectors (List[InterfaceConnection]): List of
             InterfaceConnection instances.
+            app_context (AppContext, optional): Process-lifetime context that
+            keeps the models and reference data between requests. When it is
+            None they are loaded on every prediction.
 
         Process:
             - Create TimeService and CashService instances.
             - Save the InterfaceConnection instances.
         """
         try:
-            self.eiv_services = EIVService(interface_connectors)
+            query_cache = app_context.get_query_cache() if app_context is not None else None
+            self.eiv_services = EIVService(interface_connectors, query_cache)
+            self.app_context = app_context
         except Exception as e:
             raise Exception(f"Error initializing EIVController: {str(e)}")
 
@@ -48,20 +123,26 @@ class EIVController:
         To make predictions and return the result.
 
         Parameters:
-            event (JSON): AWS Lambda event data.
+            event (JSON): AWS Lambda event data. The body is one VOB object
+            or a JSON array of VOBs (batch).
             context : AWS Lambda context.
 
         Returns:
-            dict: A dictionary with the prediction result.
+            dict: A dictionary with the prediction result, one item per VOB
+            in the order received. In a batch the VOBs with invalid data get
+            an 'error' item instead of failing the whole request.
 
         Process:
             - Catch data from the AWS Lambda event.
-            - Run the predict_pipeline functions in EIV model.
+            - Run the predict_pipeline functions in EIV model once for all
+              the VOBs.
             - Return the prediction result.
         """
         try:
             # Read data sent by the user
-            body = self.create_dataframe_from_lambda_data(event)
+            scenario = read_scenario(event)
+            lambda_data = self.read_lambda_data(event)
+            body, errors = self.create_dataframe_from_lambda_data(lambda_data)
 
         except json.JSONDecodeError as e:
             error_message = f"JSONDecodeError: {str(e)}"
@@ -85,7 +166,11 @@ class EIVController:
 
         else:
             try:
-                df_eiv = self.predict_pipeline(body)
+                df_eiv, category_errors = self.predict_pipeline(body, scenario)
+
+                # A single VOB keeps failing the whole request
+                if not isinstance(lambda_data, list) and category_errors:
+                    raise ValueError(category_errors[0][0]['error'])
 
             except FileNotFoundError as e:
                 return response_error_json(400, str(e))
@@ -109,110 +194,186 @@ class EIVController:
                 return response_error_json(400, str(e))
 
             else:
-                data = []
-                # Data for json
-                for row in range(0, df_eiv.shape[0]):
-                    row_dict = {}
-                    if not body.loc[row, 'SCA']:
-                        row_dict = {'OON': {
-                                        'EIVPercentage': df_eiv.loc[row, 'NSCA_EIV_percentage'],
-                                        'EIVValue': df_eiv.loc[row, 'NSCA_EIV_money'],
-                                        'EIVClientType': df_eiv.loc[row, 'NSCA_client_type'],
-                                        'PercClientType': df_eiv.loc[row, 'NSCA_probability'],
-                                        'EIVZscore': df_eiv.loc[row, 'NSCA_z_score'],
-                                        'FinancialStatus': df_eiv.loc[row, 'NSCA_financial_status']
-                                    }}
-                    else:
-                        row_dict = {'SCA': {
-                                        'EIVPercentage': df_eiv.loc[row, 'SCA_EIV_percentage'],
-                                        'EIVValue': df_eiv.loc[row, 'SCA_EIV_money'],
-                                        'EIVClientType': df_eiv.loc[row, 'SCA_client_type'],
-                                        'PercClientType': df_eiv.loc[row, 'SCA_probability'],
-                                        'EIVZscore': df_eiv.loc[row, 'SCA_z_score'],
-                                        'FinancialStatus': df_eiv.loc[row, 'SCA_financial_status']
-                                    }}
-                    data.append(row_dict)
-
-                return response_json(data)
-
-    def create_dataframe_from_lambda_data(self, lambda_data_json) -> pd.DataFrame:
+                errors.update(category_errors)
+                items = len(lambda_data) if isinstance(lambda_data, list) else 1
+
+                data = self.build_response_data(df_eiv, body, errors, items, scenario)
+
+                # Version of the reference data the VOBs were scored with
+                if not df_eiv.empty:
+                    snapshot_version = df_eiv['snapshot_version'].iloc[0]
+                else:
+                    snapshot_version = self.app_context.reference_version if self.app_context is not None else None
+
+                compress_min_bytes = GZIP_MIN_BYTES if accepts_gzip(event) else None
+                return response_json(data, compress_min_bytes, snapshot_version)
+
+    def build_response_data(self, df_eiv: pd.DataFrame, body: pd.DataFrame,
+                            errors: Dict[int, List[dict]], items: int,
+                            scenario: str = None) -> list:
+        """
+        Build the items of the response column-wise from the predictions.
+
+        Parameters:
+            df_eiv (DataFrame): Predictions returned by predict_pipeline.
+            body (DataFrame): Data sent by the user (see
+            create_dataframe_from_lambda_data).
+            errors (Dict[int, List[dict]]): Failed fields of every VOB not
+            scored.
+            items (int): Number of VOBs received.
+            scenario (str, optional): Scenario scored, see SCENARIOS.
+
+        Returns:
+            list: One item per VOB in the order received: the 'SCA' and/or
+            'OON' payloads of the scenario (by default the one of its SCA
+            value), or its first 'error' and the list of failed fields in
+            'errors'.
+        """
+        data = [None] * items
+        for row, failures in errors.items():
+            data[row] = {'error': failures[0]['error'], 'errors': failures}
+
+        if df_eiv.empty:
+            return data
+
+        codes = scenario_codes(body.loc[df_eiv.index, 'SCA'], scenario)
+        for row in df_eiv.index:
+            data[row] = {}
+
+        for bit, _, prefix, payload in BRANCHES:
+            mask = (codes & bit) > 0
+            rows = df_eiv.index[mask].tolist()
+            # One list of python values per field
+            columns = []
+            for column in RESPONSE_FIELDS.values():
+                values = df_eiv[f'{prefix}_{column}'][mask]
+                columns.append(values.astype(object).where(values.notna(), None).tolist())
+
+            for row, values in zip(rows, zip(*columns)):
+                data[row][payload] = dict(zip(RESPONSE_FIELDS, values))
+
+        return data
+
+    def read_lambda_data(self, lambda_data_json) -> Union[dict, list]:
+        """
+        Read the body of the lambda event.
+
+        Args:
+            lambda_data_json (json): AWS Lambda event data.
+
+        Returns:
+            Union[dict, list]: One VOB, or the list of VOBs of a batch.
+
+        Raises:
+            ValueError: If the body is not a VOB object or a non empty list of
+            VOB objects.
+        """
+        body = str(lambda_data_json['body']).replace("'", '"')
+        lambda_data = receive_json(body)
+
+        if isinstance(lambda_data, list):
+            if len(lambda_data) == 0:
+                raise ValueError("The batch of VOBs is empty.")
+            if not all(isinstance(vob, dict) for vob in lambda_data):
+                raise ValueError("Every item of the batch should be a VOB object.")
+        elif not isinstance(lambda_data, dict):
+            raise ValueError("The body should be a VOB object or a list of VOB objects.")
+
+        return lambda_data
+
+    def create_dataframe_from_lambda_data(self, lambda_data: Union[dict, list]) -> Tuple[pd.DataFrame, Dict[int, List[dict]]]:
 
         """
         Check variables types and values, raise value errors if those are
         incorrect. Create a Pandas DataFrame from lambda data.
 
         Args:
-            lambda_data_json (json): A dictionary containing lambda data.
+            lambda_data (Union[dict, list]): One VOB, or the list of VOBs of
+            a batch (see read_lambda_data).
 
         Returns:
-            pd.DataFrame: A DataFrame with lambda data.
+            pd.DataFrame: A DataFrame with lambda data, one row per valid VOB
+            indexed by its position in the request.
+            Dict[int, List[dict]]: Failed fields of every invalid VOB of a
+            batch (see VOBValidator.validate).
 
         Raises:
-            ValueError: If a column is not found in the lambda data.
-            TypeError: If a column doesn't have the expected data type.
+            KeyError: If a column is not found in the lambda data.
+            ValueError: If a column doesn't have the expected data type.
+            Only for a single VOB; in a batch the errors are returned.
         """
-        _variable_types = {
-            "ClientTrackingID": str,
-            "ClientName": str,
-            "VOBID": str,
-            "SCA": bool,
-            "OONBenefits": bool,
-            "Subscriber": str,
-            "Payor": str,
-            "GroupID": str,
-            "PolicyID": str,
-            "FundingType": str,
-            "PolicyType": str,
-            "Copay": float,
-            "CoinsuranceOON": float,
-            "Deductible": float,
-            "OutOfBucket": float,
-            "State": str,
-            "Multiplan": bool
-        }
+        if not isinstance(lambda_data, list):
+            return VOB_VALIDATOR.validate_one(lambda_data), {}
 
-        body = str(lambda_data_json['body']).replace("'", '"')
-        lambda_data = receive_json(body)
+        return VOB_VALIDATOR.validate(lambda_data)
 
-        data = {}
-
-        for var_name, _ in _variable_types.items():
-            if var_name not in lambda_data:
-                raise KeyError(f"Column '{var_name}' not found in the input.")
-
-        data["ClientTrackingID"] = check_ids("ClientTrackingID",
-                                             lambda_data["ClientTrackingID"])
-        data["ClientName"] = check_user_name(lambda_data["ClientName"])
-        data["VOBID"] = check_ids("VOBID", lambda_data["VOBID"])
-        data["SCA"] = check_bool_values("SCA",  lambda_data["SCA"])
-        data["OONBenefits"] = check_bool_values("OONBenefits",
-                                                lambda_data["OONBenefits"])
-        data["Subscriber"] = check_user_name(lambda_data["Subscriber"])
-        data["Payor"] = lambda_data["Payor"]
-        data["GroupID"] = check_ids("GroupID", lambda_data["GroupID"])
-        data["PolicyID"] = check_ids("PolicyID", lambda_data["PolicyID"])
-        data["FundingType"] = check_fundingType(lambda_data["FundingType"])
-        data["PolicyType"] = lambda_data["PolicyType"]
-        data["Copay"] = check_percent(lambda_data["Copay"])
-        data["CoinsuranceOON"] = check_percent(lambda_data["CoinsuranceOON"])
-        data["Deductible"] = check_quantities_vob(lambda_data["Deductible"])
-        data["OutOfBucket"] = check_quantities_vob(lambda_data["OutOfBucket"])
-        data["State"] = lambda_data["State"]
-        data["Multiplan"] = check_multiplan_variable(lambda_data["Multiplan"])
-
-        df = pd.DataFrame([data])
-
-        return df
-
-    def predict_pipeline(self, body: pd.DataFrame) -> pd.DataFrame:
+    def predict_pipeline(self, body: pd.DataFrame,
+                         scenario: str = None) -> Tuple[pd.DataFrame, Dict[int, List[dict]]]:
         """
         Initializes and Execute all the pipeline for prediction.
 
         Parameters:
-            DataFrame: A DataFrame containing the data for predictions.
+            DataFrame: A DataFrame containing the data for predictions, one
+            row per VOB.
+            scenario (str, optional): Branches to score, see SCENARIOS.
+
+        Returns:
+            DataFrame: predicted data from the model, with the same index as
+            the VOBs of body that were scored.
+            Dict[int, List[dict]]: Failed fields of every VOB of body with
+            a category not allowed; those are not scored.
+
+        Process:
+            - Runs every step once for the whole batch.
+            - Saves all the predictions into RDS with a single write, in the
+              background through the PredictionWriter of the app_context
+              when there is one, so the response doesn't wait for it.
+        """
+        reference_index = self.load_reference_index(body)
+
+        prediction_cache = None
+        if self.app_context is not None:
+            prediction_cache = self.app_context.get_prediction_cache()
+
+        df_save, errors = self.score(body, self.load_models(), reference_index,
+                                     prediction_cache, scenario)
+
+        # Save into RDS
+        if not df_save.empty:
+            if self.app_context is not None:
+                self.app_context.get_prediction_writer().submit(df_save, 'eiv')
+            else:
+                self.eiv_services.save_data_with_cashrepository(df_save, 'eiv')
+
+        return df_save, errors
+
+    def score(self, body: pd.DataFrame, models: dict,
+              reference_index: ReferenceIndex,
+              prediction_cache: PredictionCache = None,
+              scenario: str = None) -> Tuple[pd.DataFrame, Dict[int, List[dict]]]:
+        """
+        Score a batch of VOBs with the given models and reference data,
+        without saving the predictions.
+
+        Parameters:
+            body (DataFrame): Data for predictions, one row per VOB.
+            models (dict): 'scaler', 'model_pt' and 'model_proba' objects, as
+            returned by load_models.
+            reference_index (ReferenceIndex): The reference data and its
+            indexes, as returned by load_reference_index. Its version is
+            part of the cache key and saved with every prediction.
+            prediction_cache (PredictionCache, optional): Cache of the model
+            outputs; VOBs with the same features as a cached one skip
+            inference.
+            scenario (str, optional): Branches to score, see SCENARIOS. By
+            default only the branch of the SCA value of each VOB.
 
         Returns:
-            DataFrame: predicted data from the model
+            DataFrame: predicted data from the model, with the same index as
+            the VOBs of body that were scored, and their snapshot_version.
+            The columns of a branch not scored are None.
+            Dict[int, List[dict]]: Failed fields of every VOB of body with
+            a category not allowed; those are not scored.
         """
         # Columns used by the model
         cols = ['PREFIX_$', 'PAYOR_$', 'REGION_$', 'SUBS_$', 'GROUP_$',
@@ -230,15 +391,15 @@ class EIVController:
                     'MASTER_COLLECTED': 0.329085900650,
                     }
 
-        # Load models and preprocessors
-        scaler_EIV = PickleManager('pickle/').load_pickle('EIV_Scaler.pkl')
-        model_pt_EIV = PickleManager('pickle/').load_pickle('EIV_PT_Model.pkl')
-        model_probabilities_EIV = PickleManager('pickle/').load_pickle('xgb_model.pkl')
-
         # Execute pipeline
-        df_snowflake = self.eiv_services.load_data_from_snowflake()
+        # VOBs with categories not allowed are reported and not scored
+        errors = self.eiv_services.verify_categories(body, reference_index)
+        body = body.drop(index=list(errors))
+        if body.empty:
+            return pd.DataFrame(), errors
+
         df_original = self.eiv_services.load_data_to_dataframe(body,
-                                                               df_snowflake)
+                                                               reference_index)
 
         df_include = self.eiv_services.include_columns(df_original)
 
@@ -248,39 +409,141 @@ class EIVController:
 
         df_transform = self.eiv_services.transform_columns(df_type)
 
-        df_scale = self.eiv_services.scale_values(df_transform[cols],
-                                                  scaler_EIV)
+        # The scenario of every VOB goes with its features, so it is part of
+        # the key of the cache
+        codes = scenario_codes(body['SCA'], scenario)
+        features = df_transform[cols].assign(SCENARIO=codes)
 
-        # SCA
-        df_scale['SCA_FLAG'] = 1.0
-        df_sca = df_scale
-        df_predict_pt_sca = self.eiv_services.model_predict(df_sca,
-                                                            model_pt_EIV)
-
-        df_predict_proba_sca = self.eiv_services.model_predict_proba(df_sca[['PREFIX_$', 'PAYOR_$', 'REGION_$',
-                                                                             'GROUP_$', 'FUNDED_$', 'OON_BENEFITS']],
-                                                                     model_probabilities_EIV)
-
-        # NSCA
-        df_scale['SCA_FLAG'] = -1.0
-        df_nsca = df_scale
-        df_predict_pt_nsca = self.eiv_services.model_predict(df_nsca,
-                                                             model_pt_EIV)
-        df_predict_proba_nsca = self.eiv_services.model_predict_proba(df_nsca[['PREFIX_$', 'PAYOR_$', 'REGION_$',
-                                                                               'GROUP_$', 'FUNDED_$', 'OON_BENEFITS']], 
-                                                                      model_probabilities_EIV)
+        if prediction_cache is None:
+            predictions = self.predict_features(features, models)
+        else:
+            predictions = prediction_cache.predict(features, reference_index.version,
+                                                   lambda features: self.predict_features(features, models))
+        df_predict_pt_sca, df_predict_proba_sca, df_predict_pt_nsca, df_predict_proba_nsca = predictions
 
         df_save = self.eiv_services.create_prediction_dataframe(df_original,
                                                                 df_predict_pt_sca,
-                                                                df_predict_proba_sca[:2],
+                                                                df_predict_proba_sca,
                                                                 df_predict_pt_nsca,
-                                                                df_predict_proba_nsca[:2],
-                                                                vob=(df_original['DEDUCTIBLE'][0],
-                                                                     df_original['OUT_OF_POCKET'][0]))
+                                                                df_predict_proba_nsca,
+                                                                vob=(df_original['DEDUCTIBLE'],
+                                                                     df_original['OUT_OF_POCKET']))
 
-        df_save = df_save.iloc[[0]]
+        for bit, _, prefix, _ in BRANCHES:
+            skipped = (codes & bit) == 0
+            if skipped.any():
+                columns = [f'{prefix}_{column}' for column in RESPONSE_FIELDS.values()]
+                df_save[columns] = df_save[columns].astype(object)
+                df_save.loc[skipped, columns] = None
 
-        # Save into RDS
-        self.eiv_services.save_data_with_cashrepository(df_save, 'eiv')
+        df_save['snapshot_version'] = reference_index.version
+
+        return df_save, errors
+
+    def predict_features(self, features: pd.DataFrame, models: dict) -> Tuple:
+        """
+        Run the models over the features of a batch, for the branches (SCA
+        and/or NSCA) in the SCENARIO column of each row.
+
+        Parameters:
+            features (DataFrame): The model columns after transform_columns,
+            plus SCENARIO (see SCENARIOS).
+            models (dict): 'scaler', 'model_pt' and 'model_proba' objects.
+
+        Returns:
+            Tuple: SCA percentages, SCA probabilities, NSCA percentages and
+            NSCA probabilities, one item per row of features. Percentages of
+            a branch not scored are NaN.
+
+        Process:
+            - Stacks the rows of both branches with their SCA_FLAG into one
+              matrix and runs the regressor once.
+            - The probabilities don't depend on SCA_FLAG, so the classifier
+              runs once and both branches share them.
+        """
+        scaler_EIV = models['scaler']
+        model_pt_EIV = models['model_pt']
+        model_probabilities_EIV = models['model_proba']
+
+        codes = features['SCENARIO'].to_numpy()
+        df_scale = self.eiv_services.scale_values(features.drop(columns='SCENARIO'),
+                                                  scaler_EIV)
+
+        # One row per VOB and branch, with the SCA_FLAG of the branch
+        scaled = df_scale.to_numpy()
+        masks = [(codes & bit) > 0 for bit, _, _, _ in BRANCHES]
+        stacked = np.empty((sum(int(mask.sum()) for mask in masks), scaled.shape[1] + 1))
+        start = 0
+        for mask, (_, sca_flag, _, _) in zip(masks, BRANCHES):
+            end = start + int(mask.sum())
+            stacked[start:end, :-1] = scaled[mask]
+            stacked[start:end, -1] = sca_flag
+            start = end
+
+        df_stacked = pd.DataFrame(stacked, columns=[*df_scale.columns, 'SCA_FLAG'])
+        df_predict_pt = self.eiv_services.model_predict(df_stacked, model_pt_EIV)
+
+        predictions_pt = []
+        start = 0
+        for mask in masks:
+            end = start + int(mask.sum())
+            prediction = np.full(len(codes), np.nan)
+            prediction[mask] = df_predict_pt[start:end]
+            predictions_pt.append(prediction)
+            start = end
+
+        df_predict_proba = self.eiv_services.model_predict_proba(df_scale[['PREFIX_$', 'PAYOR_$', 'REGION_$',
+                                                                           'GROUP_$', 'FUNDED_$', 'OON_BENEFITS']],
+                                                                 model_probabilities_EIV)
+
+        return predictions_pt[0], df_predict_proba, predictions_pt[1], df_predict_proba
+
+    def load_models(self) -> dict:
+        """
+        Return the models and preprocessors used by the pipeline.
+
+        Returns:
+            dict: 'scaler', 'model_pt' and 'model_proba' objects.
+
+        Process:
+            - Reuses the ones kept by the AppContext when available.
+            - Otherwise loads them from the pickle files.
+        """
+        if self.app_context is not None:
+            return self.app_context.get_models()
+
+        return {'scaler': PickleManager('pickle/').load_pickle('EIV_Scaler.pkl'),
+                'model_pt': PickleManager('pickle/').load_pickle('EIV_PT_Model.pkl'),
+                'model_proba': PickleManager('pickle/').load_pickle('xgb_model.pkl')}
+
+    def load_reference_index(self, body: pd.DataFrame = None) -> ReferenceIndex:
+        """
+        Return the ReferenceIndex of the EIV reference data.
+
+        Parameters:
+            body (DataFrame, optional): VOBs the index is for. Small batches
+            may get an index of only the reference rows they use.
+
+        Process:
+            - Reuses the index kept by the AppContext, built once per
+              snapshot, when available.
+            - On a cold container, or without AppContext, a small batch
+              queries Snowflake only for the rows with its keys (see
+              EIVService.load_reference_rows); its version starts with
+              'pushdown-'.
+            - Otherwise queries Snowflake and builds it.
+        """
+        if body is not None:
+            if self.app_context is None:
+                pushdown = len(body) <= PUSHDOWN_MAX_VOBS
+            else:
+                pushdown = self.app_context.use_reference_pushdown(len(body))
+            if pushdown:
+                version = 'pushdown-' + datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+                data, _ = compact_reference_data(self.eiv_services.load_reference_rows(body))
+                return ReferenceIndex(data, version)
+
+        if self.app_context is not None:
+            return self.app_context.get_reference_index(self.eiv_services)
 
-        return df_save
+        return ReferenceIndex(self.eiv_services.load_data_from_snowflake())
@@ -1,33 +1,39 @@
-from connectors.postgresql_connection import PostgreSQLConnection
-from connectors.snowflake_connection import SnowflakeConnection
-from controller.eiv_controller import EIVController
-from util.yaml_config_loader import YAMLConfigLoader
+from app_context import get_app_context
+import os
 import warnings
 
 
 def lambda_request(event, context):
 
-    # Extract information of the config
-    config = YAMLConfigLoader().load_config()
-    credentials = YAMLConfigLoader().load_credentials()
+    # Reuse the controller, connectors, models and reference data of the
+    # container; they are only built on the first (cold) invocation
+    app_context = get_app_context()
+    eiv_controller = app_context.get_controller()
 
-    # Instance the connection with RDS
-    db_rds = PostgreSQLConnection(config['rds']['host'],
-                                  config['rds']['port'],
-                                  config['rds']['database'],
-                                  credentials['rds']['user'],
-                                  credentials['rds']['password'])
-    db_snowflake = SnowflakeConnection(config['snowflake']['account'],
-                                       credentials['snowflake']['user'],
-                                       credentials['snowflake']['password'],
-                                       config['snowflake']['database'],
-                                       config['snowflake']['schema'],
-                                       config['snowflake']['warehouse'],
-                                       config['snowflake']['role'])
+    response = eiv_controller.handle_request(event, context)
 
-    eiv_controller = EIVController([db_rds, db_snowflake])
+    # The container is frozen once the handler returns: the predictions are
+    # saved first, for up to lambda_flush_timeout seconds, and the ones left
+    # are spilled to /tmp and saved after the container is thawed
+    app_context.flush_predictions()
 
-    return eiv_controller.handle_request(event, context)
+    return response
+
+
+def warm_up():
+    # Runs during the Lambda INIT phase, before the first invocation: the
+    # models, logins and reference data are loaded at the same time. Steps
+    # not done in init_timeout go on in the background, and failed ones are
+    # built again by the first request.
+    warnings.filterwarnings("ignore")
+    app_context = get_app_context()
+    try:
+        startup_config = app_context.get_config().get('startup') or {}
+    except Exception:
+        startup_config = {}
+    app_context.warm_up(bool(startup_config.get('reference', True)),
+                        int(startup_config.get('max_workers', 8)),
+                        float(startup_config.get('init_timeout', 8)))
 
 
 def lambda_handler(event, context):
@@ -35,3 +41,8 @@ def lambda_handler(event, context):
 
     # Call handler for AWS Lambda
     return lambda_request(event, context)
+
+
+# Only in Lambda, not when the module is imported elsewhere (e.g. tests)
+if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
+    warm_up()
@@ -1,10 +1,62 @@
 import pandas as pd
-from typing import List
+import pyarrow as pa
+from typing import Dict, Iterator, List, Union
 from connectors.interface_connection import InterfaceConnection
 from connectors.postgresql_connection import PostgreSQLConnection
 from connectors.snowflake_connection import SnowflakeConnection
 from repository.interface_repository import InterfaceRepository
+from repository.query_cache import QueryResultCache
 from datetime import datetime
+import re
+
+# Unquoted Snowflake identifier, safe to place in a query
+SQL_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_$]*$')
+
+
+# Prediction columns saved for every VOB, named as in the table
+PREDICTION_COLUMNS = [f'{branch}_{name}' for branch in ('SCA', 'NSCA')
+                      for name in ('EIV_percentage', 'EIV_money', 'client_type', 'probability',
+                                   'z_score', 'financial_status')]
+
+# Unique key of the predictions table
+UPSERT_KEY = ['vob_id', 'prediction_date']
+
+UPSERT_BATCH_ROWS = 1000
+
+
+def to_sql_value(value):
+    """
+    Convert a value to a Python type psycopg2 binds; missing values are None.
+    """
+    if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    if hasattr(value, 'item'):
+        # numpy scalars
+        return value.item()
+    return value
+
+
+def select_row_groups(query: str, where: str, group_columns: List[str]) -> str:
+    """
+    Build a query returning every row of query that shares its values of
+    group_columns (None equal to None) with a row matching where, e.g. so
+    the duplicates of the matched rows can be dropped as in the whole data.
+    """
+    for column in group_columns:
+        if not SQL_IDENTIFIER.match(column):
+            raise ValueError(f"Invalid column name {column}")
+
+    query = query.strip().rstrip(';')
+    same_group = '\n      and '.join(f'matched.{column} is not distinct from all_rows.{column}'
+                                      for column in group_columns)
+    return f"""select * from ({query}) as all_rows
+where exists (
+    select 1 from ({query}) as matched
+    where ({where})
+      and {same_group})"""
+
 
 class EIVRepository(InterfaceRepository):
     """
@@ -17,12 +69,14 @@ class EIVRepository(InterfaceRepository):
         - Interacts with PostgreSQLConnection and SnowflakeConnection classes for database operations.
     """
 
-    def __init__(self, connectors: List[InterfaceConnection]):
+    def __init__(self, connectors: List[InterfaceConnection],
+                 query_cache: QueryResultCache = None):
         """
         Initializes the EIVRepository object.
 
         Parameters:
             connectors (List[InterfaceConnection]): A list of InterfaceConnection objects.
+            query_cache (QueryResultCache, optional): Cache of the results of the read queries.
 
         Returns:
             None
@@ -30,14 +84,18 @@ class EIVRepository(InterfaceRepository):
         Process:
             - Calls the constructor of the InterfaceRepository to save the provided InterfaceConnection objects as class attributes.
         """
-        super().__init__(connectors)
+        super().__init__(connectors, query_cache)
 
-    def retrieve_data(self, query: str) -> pd.DataFrame:
+    def retrieve_data(self, query: str, params: dict = None, ttl: float = None) -> pd.DataFrame:
         """
         Retrieves data from the database using the provided query.
 
         Parameters:
             query (str): SQL query to retrieve data.
+            params (dict, optional): Values bound to the %(name)s
+            placeholders of the query.
+            ttl (float, optional): Seconds the result is cached, see
+            retrieve_data_from_snowflake.
 
         Returns:
             pd.DataFrame: A DataFrame containing the query results.
@@ -46,114 +104,269 @@ class EIVRepository(InterfaceRepository):
             - Calls the 'retrieve_data_from_snowflake()' method to execute the provided query and get the results as a DataFrame.
             - Returns the DataFrame.
         """
-        return self.retrieve_data_from_snowflake(query)
+        return self.retrieve_data_from_snowflake(query, params, ttl=ttl)
 
-    def save_data(self, data: pd.DataFrame, table_name: str) -> None:
+    def save_data(self, data: pd.DataFrame, table_name: str,
+                  batch_rows: int = UPSERT_BATCH_ROWS) -> List[dict]:
         """
         Saves data to the database table.
 
         Parameters:
             data (pd.DataFrame): DataFrame containing the data to be saved.
             table_name (str): Name of the database table to save the data.
+            batch_rows (int): Rows written per batch.
 
         Returns:
-            None
+            List[dict]: Timings of every batch, see save_data_to_postgresql.
 
         Process:
             - Calls the 'save_data_to_postgresql()' method to save the provided data in the specified table.
         """
-        self.save_data_to_postgresql(data, table_name)
+        return self.save_data_to_postgresql(data, table_name, batch_rows)
 
-    def retrieve_data_from_snowflake(self, query: str) -> pd.DataFrame:
+    def retrieve_data_from_snowflake(self, query: str, params: dict = None, as_arrow: bool = False,
+                                     ttl: float = None) -> Union[pd.DataFrame, pa.Table]:
         """
         Retrieves data from Snowflake using the provided query.
 
         Parameters:
             query (str): SQL query to retrieve data.
+            params (dict, optional): Values bound to the %(name)s
+            placeholders of the query.
+            as_arrow (bool, optional): Return a pyarrow Table instead of a
+            DataFrame.
+            ttl (float, optional): Seconds the result is reused from the
+            query_cache, by default the ttl of the cache; 0 always runs the
+            query.
 
         Returns:
-            pd.DataFrame: A DataFrame containing the query results.
+            Union[pd.DataFrame, pa.Table]: The query results.
 
         Process:
-            - Calls the 'execute_query()' method of the appropriate SnowflakeConnection instance
+            - Returns the result cached for the same query (whitespace
+              aside) and params, if any.
+            - Otherwise calls the 'execute_query()' method of the appropriate SnowflakeConnection instance
               to execute the provided query and get the results as a DataFrame.
             - Returns the DataFrame.
         """
         try:
             for connector in self.connectors:
                 if isinstance(connector, SnowflakeConnection):
-                    return connector.execute_query(query)
+                    return self.cached_query(query, params,
+                                             lambda: connector.execute_query(query, params, as_arrow=as_arrow),
+                                             ttl, 'arrow' if as_arrow else '')
 
             raise Exception("No SnowflakeConnection found in the list of connectors.")
         except Exception as e:
             raise Exception(f"Error retrieving data from Snowflake: {str(e)}")
 
-    def save_data_to_postgresql(self, data: pd.DataFrame, table_name: str) -> None:
+    def iter_data_from_snowflake(self, query: str, chunk_rows: int = 50000,
+                                 params: dict = None) -> Iterator[pd.DataFrame]:
+        """
+        Retrieves data from Snowflake in chunks, so results larger than the
+        memory of the container can be processed incrementally.
+
+        Parameters:
+            query (str): SQL query to retrieve data.
+            chunk_rows (int): Rows of every chunk.
+            params (dict, optional): Values bound to the %(name)s
+            placeholders of the query.
+
+        Returns:
+            Iterator[pd.DataFrame]: The query results, chunk by chunk.
+        """
+        return self._iter_data(SnowflakeConnection, query, chunk_rows, params)
+
+    def iter_data_from_postgresql(self, query: str, chunk_rows: int = 50000,
+                                  params: dict = None) -> Iterator[pd.DataFrame]:
+        """
+        Retrieves data from PostgreSQL in chunks, read with a server-side
+        cursor.
+
+        Parameters:
+            query (str): SQL query to retrieve data.
+            chunk_rows (int): Rows of every chunk.
+            params (dict, optional): Values bound to the %(name)s
+            placeholders of the query.
+
+        Returns:
+            Iterator[pd.DataFrame]: The query results, chunk by chunk.
+        """
+        return self._iter_data(PostgreSQLConnection, query, chunk_rows, params)
+
+    def _iter_data(self, connection_type: type, query: str, chunk_rows: int,
+                   params: dict) -> Iterator[pd.DataFrame]:
+        for connector in self.connectors:
+            if isinstance(connector, connection_type):
+                break
+        else:
+            raise Exception(f"No {connection_type.__name__} found in the list of connectors.")
+
+        try:
+            yield from connector.iter_query(query, chunk_rows, params)
+        except Exception as e:
+            raise Exception(f"Error retrieving data in chunks: {str(e)}")
+
+    def probe_snowflake_table(self, table: str) -> dict:
+        """
+        Read the last change time and row count of a Snowflake table from
+        INFORMATION_SCHEMA, a metadata query that doesn't scan the table.
+
+        Parameters:
+            table (str): Fully qualified name, DATABASE.SCHEMA.TABLE.
+
+        Returns:
+            dict: 'last_altered' (str) and 'row_count' (int); they change
+            whenever the table does.
+
+        Raises:
+            ValueError: If the table name is not DATABASE.SCHEMA.TABLE.
+        """
+        parts = table.split('.')
+        if len(parts) != 3 or not all(SQL_IDENTIFIER.match(part) for part in parts):
+            raise ValueError(f"Table should be DATABASE.SCHEMA.TABLE, but it is {table}")
+
+        database, schema, name = parts
+        query = f"""
+            select LAST_ALTERED, ROW_COUNT
+            from {database}.INFORMATION_SCHEMA.TABLES
+            where TABLE_SCHEMA = %(schema)s and TABLE_NAME = %(table)s
+        """
+        # Never cached, it tells whether the table changed
+        result = self.retrieve_data_from_snowflake(query, {'schema': schema.upper(),
+                                                           'table': name.upper()}, ttl=0)
+        if result.empty:
+            raise Exception(f"Table {table} not found in Snowflake")
+
+        return {'last_altered': str(result.iloc[0]['LAST_ALTERED']),
+                'row_count': int(result.iloc[0]['ROW_COUNT'])}
+
+    def retrieve_rows_by_keys(self, query: str, keys: Dict[str, list],
+                              group_columns: List[str] = None) -> pd.DataFrame:
+        """
+        Retrieve only the rows of a query whose value of any of the given
+        columns is one of the given keys, filtered in Snowflake.
+
+        Parameters:
+            query (str): SQL query of the whole data.
+            keys (Dict[str, list]): Column -> values searched in it. The
+            comparison is case insensitive; None values are skipped.
+            group_columns (List[str], optional): Also return the rows with
+            the same values of these columns as a matching row.
+
+        Returns:
+            pd.DataFrame: The matching rows, with the columns of the query,
+            in its order.
+
+        Process:
+            - Builds one 'upper(column) in (...)' condition per column, joined
+              with 'or', with every value as a bind variable.
+            - With group_columns, selects the rows of the groups of the
+              matching rows, see select_row_groups.
+        """
+        conditions = []
+        params = {}
+        for column, values in keys.items():
+            if not SQL_IDENTIFIER.match(column):
+                raise ValueError(f"Invalid column name {column}")
+
+            placeholders = []
+            for value in sorted({str(value).upper() for value in values if value is not None}):
+                name = f'key_{len(params)}'
+                params[name] = value
+                placeholders.append(f'%({name})s')
+
+            if placeholders:
+                conditions.append(f"upper({column}) in ({', '.join(placeholders)})")
+
+        query = query.strip().rstrip(';')
+        # Without keys no row matches, but the columns are still returned
+        where = '\n   or '.join(conditions) if conditions else '1 = 0'
+        if group_columns and conditions:
+            return self.retrieve_data_from_snowflake(select_row_groups(query, where, group_columns),
+                                                     params)
+        return self.retrieve_data_from_snowflake(f"select * from ({query})\nwhere {where}", params)
+
+    def save_data_to_postgresql(self, data: pd.DataFrame, table_name: str,
+                                batch_rows: int = UPSERT_BATCH_ROWS) -> List[dict]:
         """
         Saves data to PostgreSQL table.
 
         Parameters:
             data (pd.DataFrame): DataFrame containing the data to be saved.
             table_name (str): Name of the PostgreSQL table to save the data.
+            batch_rows (int): Rows written per round of statements.
 
         Returns:
-            None
+            List[dict]: 'batch', 'rows' and 'seconds' of every batch.
 
         Process:
-            - Calls the 'execute_query()' method of the appropriate PostgreSQLConnection instance
-              to insert or update the provided data in the specified table.
-            - If the 'claim_id' and 'prediction_date' exist in the table, the 'future_collected_cash'
-              column will be updated. Otherwise, a new row will be inserted.
+            - Calls the 'execute_batches()' method of the appropriate PostgreSQLConnection instance
+              to copy every batch of rows, with typed parameters, into a temporary staging table
+              with the columns of the table.
+            - Merges the staging table into the table with one 'insert ... on conflict' statement:
+              if the 'vob_id' and 'prediction_date' exist in the table, the prediction columns
+              will be updated, except the ones without a value (the branch not scored), which
+              keep the value saved. Otherwise, a new row will be inserted. When the data repeats
+              a 'vob_id', its last row is kept, with the last values of the prediction columns
+              it lacks.
+            - The 'snapshot_version' column is written only when data has it.
         """
+        if not all(SQL_IDENTIFIER.match(part) for part in table_name.split('.')):
+            raise ValueError(f"Invalid table name {table_name}")
+
         try:
             for connector in self.connectors:
                 if isinstance(connector, PostgreSQLConnection):
-                    
-                    query = ''
-                    
-                    for _, row in data.iterrows():
-                        vob_id = row['VOB_ID'] if row['VOB_ID'] is not None else '001'
-                        client_name = row['CLIENT_NAME']
-                        prediction_date = datetime.now().date()
-                        SCA_EIV_percentage = row['SCA_EIV_percentage']
-                        SCA_EIV_money = row['SCA_EIV_money']
-                        SCA_client_type = row['SCA_client_type']
-                        SCA_probability = row['SCA_probability']
-                        SCA_z_score = row['SCA_z_score']
-                        SCA_financial_status = row['SCA_financial_status']
-                        NSCA_EIV_percentage = row['NSCA_EIV_percentage']
-                        NSCA_EIV_money = row['NSCA_EIV_money']
-                        NSCA_client_type = row['NSCA_client_type']
-                        NSCA_probability = row['NSCA_probability']
-                        NSCA_z_score = row['NSCA_z_score']
-                        NSCA_financial_status = row['NSCA_financial_status'] 
-                        time_stamp = datetime.now()
-
-                        query = query + f"""
-                            INSERT INTO {table_name} (vob_id, CLIENT_NAME, prediction_date, 
-                              SCA_EIV_percentage, SCA_EIV_money, SCA_client_type, SCA_probability,
-                              SCA_z_score, SCA_financial_status, NSCA_EIV_percentage, NSCA_EIV_money, 
-                              NSCA_client_type, NSCA_probability, NSCA_z_score, NSCA_financial_status, 
-                              timestamp)
-                            VALUES ('{vob_id}','{client_name}', '{prediction_date}', 
-                              '{SCA_EIV_percentage}', '{SCA_EIV_money}', '{SCA_client_type}', '{SCA_probability}',
-                              '{SCA_z_score}', '{SCA_financial_status}', '{NSCA_EIV_percentage}', '{NSCA_EIV_money}', 
-                              '{NSCA_client_type}', '{NSCA_probability}', '{NSCA_z_score}', '{NSCA_financial_status}',
-                              '{time_stamp}')
-                            ON CONFLICT (vob_id, prediction_date)
-                            DO UPDATE SET vob_id = '{vob_id}', CLIENT_NAME = '{client_name}', prediction_date = '{prediction_date}', 
-                              SCA_EIV_percentage = '{SCA_EIV_percentage}', SCA_EIV_money = '{SCA_EIV_money}', 
-                              SCA_client_type = '{SCA_client_type}', SCA_probability = '{SCA_probability}',
-                              SCA_z_score = '{SCA_z_score}', SCA_financial_status = '{SCA_financial_status}', 
-                              NSCA_EIV_percentage = '{NSCA_EIV_percentage}', NSCA_EIV_money = '{NSCA_EIV_money}', 
-                              NSCA_client_type = '{NSCA_client_type}', NSCA_probability = '{NSCA_probability}', 
-                              NSCA_z_score = '{NSCA_z_score}', NSCA_financial_status = '{NSCA_financial_status}',
-                              timestamp = '{time_stamp}';
-                        """
-
-                    connector.execute_query(query)
-
-                    return
+                    # Predictions written late (see PredictionWriter) keep their date
+                    prediction_date = data['prediction_date'] if 'prediction_date' in data.columns \
+                        else datetime.now().date()
+                    time_stamp = datetime.now()
+                    vob_ids = data['VOB_ID'].where(data['VOB_ID'].notna(), '001')
+
+                    columns = {'vob_id': vob_ids, 'CLIENT_NAME': data['CLIENT_NAME'],
+                               'prediction_date': prediction_date,
+                               **{column: data[column] for column in PREDICTION_COLUMNS},
+                               'timestamp': time_stamp}
+                    # Needs sql/eiv_snapshot_version.sql; predictions spilled
+                    # by older versions don't have it
+                    if 'snapshot_version' in data.columns:
+                        columns['snapshot_version'] = data['snapshot_version']
+                    frame = pd.DataFrame(columns, index=data.index)
+                    rows = [tuple(map(to_sql_value, row)) for row in frame.itertuples(index=False)]
+
+                    column_list = ', '.join(columns)
+                    # A branch not scored now keeps the prediction saved before
+                    updates = ', '.join(
+                        f'{column} = COALESCE(excluded.{column}, saved.{column})'
+                        if column in PREDICTION_COLUMNS else f'{column} = excluded.{column}'
+                        for column in columns if column not in UPSERT_KEY)
+                    key_list = ', '.join(UPSERT_KEY)
+                    # Last value of every column of a repeated key, the last
+                    # one with a value for the prediction columns
+                    latest = ', '.join(
+                        column if column in UPSERT_KEY else
+                        f'(array_agg({column} ORDER BY staging_position DESC)' +
+                        (f' FILTER (WHERE {column} IS NOT NULL)' if column in PREDICTION_COLUMNS else '') +
+                        f')[1] AS {column}'
+                        for column in columns)
+
+                    return connector.execute_batches(
+                        f"INSERT INTO eiv_staging ({column_list}, staging_position) VALUES %s",
+                        [(*row, position) for position, row in enumerate(rows)],
+                        batch_rows,
+                        before=[f"""
+                            CREATE TEMPORARY TABLE eiv_staging ON COMMIT DROP AS
+                            SELECT {column_list}, 0 AS staging_position FROM {table_name} WITH NO DATA
+                        """],
+                        after=[f"""
+                            INSERT INTO {table_name} AS saved ({column_list})
+                            SELECT {latest}
+                            FROM eiv_staging
+                            GROUP BY {key_list}
+                            ON CONFLICT ({key_list})
+                            DO UPDATE SET {updates}
+                        """])
 
             raise Exception("No PostgreSQLConnection found in the list of connectors.")
         except Exception as e:
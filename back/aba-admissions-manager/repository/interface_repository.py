@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod
-from typing import List
+from typing import Callable, List
 from connectors.interface_connection import InterfaceConnection
+from repository.query_cache import QueryResultCache
 
 class InterfaceRepository(ABC):
     """
@@ -8,17 +9,20 @@ class InterfaceRepository(ABC):
 
     Variables:
         connectors (List[InterfaceConnection]): A list of database connectors (e.g., PostgreSQLConnection, SnowflakeConnection).
+        query_cache (QueryResultCache): Cache of the results of the read queries, or None.
 
     Interactions:
         - Interacts with PostgreSQLConnection and SnowflakeConnection classes for database operations.
     """
 
-    def __init__(self, connectors: List[InterfaceConnection]):
+    def __init__(self, connectors: List[InterfaceConnection],
+                 query_cache: QueryResultCache = None):
         """
         Initializes the InterfaceRepository object.
 
         Parameters:
             connectors (List[InterfaceConnection]): A list of InterfaceConnection objects.
+            query_cache (QueryResultCache, optional): Cache shared by the repositories.
 
         Returns:
             None
@@ -27,6 +31,28 @@ class InterfaceRepository(ABC):
             - Saves the provided InterfaceConnection objects as class attributes.
         """
         self.connectors = connectors
+        self.query_cache = query_cache
+
+    def cached_query(self, query: str, params: dict, load: Callable[[], object],
+                     ttl: float = None, variant: str = ''):
+        """
+        Return the result of a read query from the query_cache, or call load
+        and cache its result.
+
+        Parameters:
+            query (str): SQL query.
+            params (dict): Values bound to the query.
+            load (Callable[[], object]): Runs the query.
+            ttl (float, optional): Seconds the result is reused, by default
+            the ttl of the cache; 0 always runs the query.
+            variant (str): Anything else changing the result, e.g. its format.
+
+        Returns:
+            The result of the query.
+        """
+        if self.query_cache is None:
+            return load()
+        return self.query_cache.load(query, params, load, ttl, variant)
 
     @abstractmethod
     def retrieve_data(self, query: str):
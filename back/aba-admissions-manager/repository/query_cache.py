@@ -0,0 +1,365 @@
+import hashlib
+import json
+import os
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Tuple
+import pandas as pd
+import pyarrow as pa
+
+# Runs of whitespace, collapsed so formatting doesn't change the key
+WHITESPACE = re.compile(r'\s+')
+
+# Schema metadata of the files of the disk tier
+EXPIRES_AT = b'eiv_cache_expires_at'
+RESULT_TYPE = b'eiv_cache_type'
+
+
+class QueryResultCache:
+    """
+    LRU cache of query results, bounded by their size in bytes, with a time
+    to live per query and an optional second tier of files on disk.
+
+    Variables:
+        max_bytes (int): Bytes of results kept in memory; the least recently
+        used ones are dropped when a new one doesn't fit. Larger results
+        are only kept on disk.
+        ttl (float): Seconds a result is reused when the query doesn't set
+        its own; 0 to not cache.
+        directory (str): Folder of the disk tier, None to keep the results
+        in memory only. DataFrames and pyarrow Tables are written to it as
+        Arrow IPC files; other results are kept in memory only. It is
+        created readable by this user only, and not used if it belongs to
+        another one.
+        max_disk_bytes (int): Bytes of the files of the disk tier; the least
+        recently used ones are removed when they don't fit.
+
+    Interactions:
+        - Kept by the AppContext and used by InterfaceRepository.cached_query
+          for every read query of the repositories.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = 300.0,
+                 directory: str = None, max_disk_bytes: int = 256 * 1024 * 1024):
+        """
+        Initializes the QueryResultCache object.
+
+        Parameters:
+            max_bytes (int): Bytes kept in memory.
+            ttl (float): Default seconds a result is reused.
+            directory (str, optional): Folder of the disk tier.
+            max_disk_bytes (int): Bytes kept on disk.
+
+        Returns:
+            None
+        """
+        if max_bytes < 0 or max_disk_bytes < 0:
+            raise ValueError("max_bytes and max_disk_bytes can't be negative")
+
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.bytes_saved = 0
+        self.last_disk_error = None
+        self._directory_ready = False
+
+    @staticmethod
+    def make_key(query: str, params: dict = None, variant: str = '') -> str:
+        """
+        Build the key of a query.
+
+        Parameters:
+            query (str): SQL text; whitespace and a final ';' are ignored.
+            params (dict, optional): Values bound to the query.
+            variant (str): Anything else changing the result, e.g. its
+            format.
+
+        Returns:
+            str: '<hash of the query>-<hash of the params and variant>', so
+            every result of a query shares its prefix.
+        """
+        text = WHITESPACE.sub(' ', query).strip().rstrip(';').strip()
+        arguments = json.dumps([params or {}, variant], sort_keys=True, default=str)
+        return (hashlib.sha256(text.encode('utf-8')).hexdigest()[:24] + '-' +
+                hashlib.sha256(arguments.encode('utf-8')).hexdigest()[:24])
+
+    def get(self, key: str):
+        """
+        Return the result stored for key, from memory or disk, or None if
+        there is none or it expired. DataFrames are returned as copies, so
+        callers may modify them.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, size, value = entry
+                if time.time() < expires_at:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    self.bytes_saved += size
+                    return _copy(value)
+                self._remove(key)
+                self.expirations += 1
+
+        entry = self._read_file(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, value = entry
+            size = _size(value)
+            self._store(key, expires_at, size, value)
+            self.hits += 1
+            self.disk_hits += 1
+            self.bytes_saved += size
+            return _copy(value)
+
+    def put(self, key: str, value, ttl: float = None):
+        """
+        Store the result of key for ttl seconds (by default the ttl of the
+        cache), dropping the least recently used results that don't fit.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+
+        expires_at = time.time() + ttl
+        value = _copy(value)
+        with self._lock:
+            self._store(key, expires_at, _size(value), value)
+        self._write_file(key, expires_at, value)
+
+    def load(self, query: str, params: dict, load: Callable[[], object],
+             ttl: float = None, variant: str = ''):
+        """
+        Return the cached result of a query, or call load and cache its
+        result.
+
+        Parameters:
+            query (str): SQL text.
+            params (dict): Values bound to the query.
+            load (Callable[[], object]): Runs the query.
+            ttl (float, optional): Seconds the result is reused, by default
+            the ttl of the cache; 0 runs the query without caching it.
+            variant (str): See make_key.
+
+        Returns:
+            The result of the query.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return load()
+
+        key = self.make_key(query, params, variant)
+        value = self.get(key)
+        if value is None:
+            value = load()
+            self.put(key, value, ttl)
+        return value
+
+    def invalidate(self, query: str = None, params: dict = None, variant: str = ''):
+        """
+        Drop cached results.
+
+        Parameters:
+            query (str, optional): Query whose results are dropped; None
+            drops every result.
+            params (dict, optional): Drop only the result of the query with
+            these values (and variant).
+            variant (str): See make_key.
+        """
+        if query is None:
+            prefix = ''
+        elif params is None:
+            prefix = self.make_key(query).split('-')[0] + '-'
+        else:
+            prefix = self.make_key(query, params, variant)
+
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                self._remove(key)
+
+        if self.directory is not None:
+            for file_name in self._list_files():
+                if file_name.startswith(prefix):
+                    self._remove_file(file_name)
+
+    def clear(self):
+        """
+        Drop every result, in memory and on disk.
+        """
+        self.invalidate()
+
+    def stats(self) -> dict:
+        """
+        Return the hits (and those served from disk), misses, evictions,
+        expirations, entries and bytes in memory, bytes of results served
+        without running their query, and hit rate of the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'max_bytes': self.max_bytes,
+                    'bytes_saved': self.bytes_saved,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'last_disk_error': self.last_disk_error}
+
+    def _store(self, key: str, expires_at: float, size: int, value):
+        # Called with _lock held
+        if key in self._entries:
+            self._remove(key)
+        if size > self.max_bytes:
+            return
+
+        self._entries[key] = (expires_at, size, value)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        # Called with _lock held
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _list_files(self) -> list:
+        try:
+            return [file_name for file_name in os.listdir(self.directory)
+                    if file_name.endswith('.arrow')]
+        except OSError:
+            return []
+
+    def _open_directory(self) -> bool:
+        # Its files are read back as results: only a folder of this user
+        # that nobody else can write is used
+        if self._directory_ready:
+            return True
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            status = os.stat(self.directory)
+            if status.st_uid != os.getuid():
+                raise PermissionError(f"'{self.directory}' belongs to another user")
+            if status.st_mode & 0o077:
+                os.chmod(self.directory, 0o700)
+        except OSError as e:
+            self.last_disk_error = f"Error opening the query cache: {str(e)}"
+            return False
+        self._directory_ready = True
+        return True
+
+    def _read_file(self, key: str) -> Tuple[float, object]:
+        if self.directory is None or not self._open_directory():
+            return None
+
+        path = os.path.join(self.directory, key + '.arrow')
+        if not os.path.exists(path):
+            return None
+        try:
+            with pa.OSFile(path, 'rb') as file:
+                reader = pa.ipc.open_file(file)
+                metadata = dict(reader.schema.metadata)
+                expires_at = float(metadata.pop(EXPIRES_AT))
+                result_type = metadata.pop(RESULT_TYPE)
+                if time.time() >= expires_at:
+                    self._remove_file(key + '.arrow')
+                    return None
+                table = reader.read_all().replace_schema_metadata(metadata)
+            value = table.to_pandas() if result_type == b'pandas' else table
+        except Exception:
+            # Unreadable files are misses, and written again
+            self._remove_file(key + '.arrow')
+            return None
+
+        # Last use, for the eviction of the disk tier
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return expires_at, value
+
+    def _write_file(self, key: str, expires_at: float, value):
+        if (self.directory is None or not isinstance(value, (pd.DataFrame, pa.Table))
+                or not self._open_directory()):
+            return
+
+        path = os.path.join(self.directory, key + '.arrow')
+        temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            if isinstance(value, pd.DataFrame):
+                table, result_type = pa.Table.from_pandas(value), b'pandas'
+            else:
+                table, result_type = value, b'arrow'
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                                   EXPIRES_AT: repr(expires_at).encode(),
+                                                   RESULT_TYPE: result_type})
+            with pa.OSFile(temporary_path, 'wb') as file:
+                with pa.ipc.new_file(file, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(temporary_path, path)
+            self._prune_files()
+            self.last_disk_error = None
+        except Exception as e:
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
+            self.last_disk_error = f"Error writing the query cache: {str(e)}"
+
+    def _prune_files(self):
+        # Remove the least recently used files until the rest fit
+        files = []
+        for file_name in self._list_files():
+            try:
+                status = os.stat(os.path.join(self.directory, file_name))
+            except OSError:
+                continue
+            files.append((status.st_mtime, status.st_size, file_name))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, file_name in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            self._remove_file(file_name)
+            total -= size
+
+    def _remove_file(self, file_name: str):
+        try:
+            os.remove(os.path.join(self.directory, file_name))
+        except OSError:
+            pass
+
+
+def _size(value) -> int:
+    # Bytes of a result
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pa.Table):
+        return int(value.nbytes)
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def _copy(value):
+    # pyarrow Tables are immutable; DataFrames are copied so neither the
+    # caller nor the cache see the changes of the other
+    if isinstance(value, pd.DataFrame):
+        return value.copy()
+    return value
@@ -0,0 +1,246 @@
+import asyncio
+import os
+import re
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+from app_context import AppContext, get_app_context
+from util.util import compact_json
+
+# Status code at the start of the responses built by util.util
+STATUS_PATTERN = re.compile(r'^\{"statusCode":(\d+)')
+
+MAX_BODY_BYTES = 10 * 1024 * 1024
+
+
+class EIVServer:
+    """
+    ASGI application serving EIVController over HTTP, for the long-running
+    ECS deployment.
+
+    Variables:
+        app_context (AppContext): Context with the controller, connectors,
+        models and reference data shared by every request.
+        max_concurrency (int): Requests scored at the same time; the others
+        wait for a free slot.
+        shutdown_timeout (float): Seconds to wait for the requests in flight
+        when the server stops.
+
+    Interactions:
+        - POST / (or /eiv) takes the same body as the Lambda event and returns
+          the response of EIVController.handle_request, with its statusCode
+          as the HTTP status.
+        - GET /health returns 200, with the version and age of the
+          reference data and the failures and last error of its background
+          refreshes, once the models and reference data are loaded, and 503
+          while starting or shutting down. Its status is 'stale' while the
+          data is older than 'reference: max_age' (see
+          AppContext.start_reference_refresher).
+        - Run by EIV_WORKERS uvicorn worker processes, each with its own
+          EIVServer; they map the same reference snapshot (see
+          ReferenceSnapshot), which only one of them loads.
+    """
+
+    def __init__(self, app_context: AppContext = None,
+                 max_concurrency: int = 4, shutdown_timeout: float = 30.0):
+        """
+        Initializes the EIVServer object.
+
+        Parameters:
+            app_context (AppContext): Shared context, by default the one of
+            the process.
+            max_concurrency (int): Requests scored at the same time.
+            shutdown_timeout (float): Seconds to wait for the requests in
+            flight on shutdown.
+
+        Returns:
+            None
+        """
+        self.app_context = app_context or get_app_context()
+        self.max_concurrency = max_concurrency
+        self.shutdown_timeout = shutdown_timeout
+        self.ready = False
+        self.draining = False
+        self.in_flight = 0
+        self._executor = None
+        self._semaphore = None
+        self._idle = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """
+        Handle the ASGI lifespan protocol.
+
+        Process:
+            - On startup, loads the controller, models and reference data in
+              the executor, so the first request is served warm.
+            - On shutdown, stops taking requests, waits up to
+              shutdown_timeout for the ones in flight and closes the
+              connectors.
+        """
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed',
+                                'message': f"Error starting EIVServer: {str(e)}"})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def startup(self):
+        warnings.filterwarnings("ignore")
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                            thread_name_prefix='eiv')
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.warm_up)
+        self.ready = True
+
+    def warm_up(self):
+        """
+        Load the controller, models and reference data of the app_context,
+        and start refreshing the reference data in the background, so no
+        request waits for a reload.
+
+        The steps run at the same time (see AppContext.warm_up); the ones
+        that failed are tried again here, so their error stops the startup.
+        """
+        self.app_context.warm_up()
+        controller = self.app_context.get_controller()
+        controller.load_models()
+        controller.load_reference_index()
+        self.app_context.start_reference_refresher(controller.eiv_services)
+
+    async def shutdown(self):
+        self.draining = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.app_context.reset()
+        self.ready = False
+
+    async def http(self, scope, receive, send):
+        path = scope['path'].rstrip('/') or '/'
+        method = scope['method']
+
+        if path == '/health' and method == 'GET':
+            if self.ready and not self.draining:
+                reference = self.app_context.get_reference_status()
+                refresher = reference['refresher'] or {}
+                await respond(send, 200, compact_json({'status': 'stale' if reference['stale'] else 'ok',
+                                                       'in_flight': self.in_flight,
+                                                       'reference_version': reference['version'],
+                                                       'reference_age': reference['age'],
+                                                       'refresh_failures': refresher.get('failures'),
+                                                       'refresh_error': refresher.get('last_error')}))
+            else:
+                await respond(send, 503, compact_json({'status': 'draining' if self.draining else 'starting'}))
+        elif path in ('/', '/eiv') and method == 'POST':
+            await self.predict(scope, receive, send)
+        elif path in ('/', '/eiv', '/health'):
+            await respond(send, 405, compact_json({'error': 'Method not allowed'}))
+        else:
+            await respond(send, 404, compact_json({'error': 'Not found'}))
+
+    async def predict(self, scope, receive, send):
+        """
+        Score the VOBs of a request with EIVController.handle_request.
+
+        Process:
+            - Rejects requests with 503 while starting or shutting down and
+              with 413 when the body is larger than MAX_BODY_BYTES.
+            - Runs the controller in the executor, at most max_concurrency
+              at a time, so the event loop keeps accepting requests.
+        """
+        if not self.ready or self.draining:
+            await respond(send, 503, compact_json({'error': 'Server not available'}))
+            return
+
+        self.in_flight += 1
+        self._idle.clear()
+        try:
+            body = await read_body(receive)
+            if body is None:
+                await respond(send, 413, compact_json({'error': 'Request body too large'}))
+                return
+
+            headers = {name.decode('latin-1'): value.decode('latin-1')
+                       for name, value in scope['headers']}
+            event = {'body': body.decode('utf-8'), 'headers': headers,
+                     'queryStringParameters': dict(parse_qsl(scope['query_string'].decode('latin-1')))}
+
+            async with self._semaphore:
+                controller = self.app_context.get_controller()
+                response = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, controller.handle_request, event, None)
+
+            match = STATUS_PATTERN.match(response)
+            await respond(send, int(match.group(1)) if match else 200, response)
+        finally:
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self._idle.set()
+
+
+async def read_body(receive) -> bytes:
+    """
+    Read the whole body of an HTTP request.
+
+    Returns:
+        bytes: The body, or None if it is larger than MAX_BODY_BYTES.
+    """
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            return None
+        chunks.append(chunk)
+        if not message.get('more_body', False):
+            break
+    return b''.join(chunks)
+
+
+async def respond(send, status: int, body: str):
+    """
+    Send a JSON response.
+    """
+    content = body.encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(content)).encode('latin-1'))]})
+    await send({'type': 'http.response.body', 'body': content})
+
+
+app = EIVServer(max_concurrency=int(os.environ.get('EIV_MAX_CONCURRENCY', '4')),
+                shutdown_timeout=float(os.environ.get('EIV_SHUTDOWN_TIMEOUT', '30')))
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    # Every worker process imports this module and serves its own app
+    uvicorn.run('server:app', host='0.0.0.0', port=int(os.environ.get('PORT', '3000')),
+                workers=int(os.environ.get('EIV_WORKERS', '1')),
+                timeout_graceful_shutdown=app.shutdown_timeout)
@@ -1,19 +1,26 @@
-from typing import Dict, List
+from typing import Dict, Iterator, List
 from pandas import DataFrame
 import pandas as pd
 import datetime
 from connectors.interface_connection import InterfaceConnection
-from repository.eiv_repository import EIVRepository
+from repository.eiv_repository import EIVRepository, SQL_IDENTIFIER, select_row_groups
+from repository.query_cache import QueryResultCache
 from sklearn.impute import SimpleImputer
+from sklearn.preprocessing import StandardScaler
 from util.textfile_manager import TextfileManager
 from services.eiv_helper import verify_data_categories
-from services.eiv_helper import extract_prefix, search_and_get_first_value, \
-                                search_specific_and_get_first_value, \
-                                calculate_master_collected, \
-                                calculate_claim_amount_paid
+from services.eiv_helper import extract_prefix, \
+                                WATERFALL_DIMENSIONS, \
+                                resolve_waterfall, \
+                                MASTER_COLLECTED_RULES, \
+                                CLAIM_AMOUNT_PAID_RULES
 from services.eiv_helper import calculate_adjusted_eiv
+from services.reference_index import ReferenceIndex
 import numpy as np
 
+# Columns of the reference rows kept once, the first time they are seen
+REFERENCE_KEY = ['CLIENT_NAME', 'ALLOWED']
+
 
 class EIVService:
     """
@@ -27,13 +34,16 @@ class EIVService:
         None.
     """
 
-    def __init__(self, connectors: List[InterfaceConnection]):
+    def __init__(self, connectors: List[InterfaceConnection],
+                 query_cache: QueryResultCache = None):
         """
         Initializes the EIVService object.
 
         Parameters:
             connectors (List[InterfaceConnection]): A list of
             InterfaceConnection objects.
+            query_cache (QueryResultCache, optional): Cache of the results
+            of the read queries of the repository.
 
         Returns:
             None
@@ -41,7 +51,7 @@ class EIVService:
         Process:
             - Creates a EIVRepository object and saves it as a class attribute.
         """
-        self.eiv_repository = EIVRepository(connectors)
+        self.eiv_repository = EIVRepository(connectors, query_cache)
 
     def load_data_from_snowflake(self) -> DataFrame:
         """
@@ -53,55 +63,242 @@ class EIVService:
         # Load SQL file
         sql = TextfileManager('sql/').load_textfile('eiv_sql.sql')
 
-        # Call to snowflake database
-        df_snowflake = self.eiv_repository.retrieve_data_from_snowflake(sql)
+        # Call to snowflake database; not cached, the ReferenceSnapshot
+        # decides when it is loaded again
+        df_snowflake = self.eiv_repository.retrieve_data_from_snowflake(sql, ttl=0)
+
+        return self.clean_reference_data(df_snowflake)
 
+    def clean_reference_data(self, df_snowflake: DataFrame) -> DataFrame:
+        """
+        Clean the reference rows read from Snowflake.
+
+        Parameters:
+            df_snowflake (pd.DataFrame): Rows of the reference table.
+
+        Returns:
+            dataframe (pd.DataFrame): The rows with one row per
+            (CLIENT_NAME, ALLOWED) and the VOB_ID column.
+        """
         # Delete some rows from the query for some special inner joins
         # This features are less than 1% of the data
-        df_snowflake = df_snowflake.drop_duplicates(['CLIENT_NAME', 'ALLOWED'])
+        df_snowflake = df_snowflake.drop_duplicates(REFERENCE_KEY)
 
         # Create a column for identifien propouses
         df_snowflake['VOB_ID'] = None
 
         return df_snowflake
 
+    def iter_reference_data(self, chunk_rows: int = 50000) -> Iterator[DataFrame]:
+        """
+        Load the reference data from Snowflake in chunks, to build indexes
+        or aggregates of it without holding the whole table in memory.
+
+        Parameters:
+            chunk_rows (int): Rows read from Snowflake at a time.
+
+        Returns:
+            Iterator[pd.DataFrame]: The rows of load_data_from_snowflake,
+            chunk by chunk and in the same order.
+
+        Process:
+            - Drops the rows of a (CLIENT_NAME, ALLOWED) already seen in an
+              earlier chunk, so the chunks put together are equal to the
+              data of load_data_from_snowflake.
+        """
+        sql = TextfileManager('sql/').load_textfile('eiv_sql.sql')
+
+        seen = set()
+        for df_snowflake in self.eiv_repository.iter_data_from_snowflake(sql, chunk_rows):
+            df_snowflake = self.clean_reference_data(df_snowflake)
+
+            keys = pd.Series(list(zip(df_snowflake['CLIENT_NAME'], df_snowflake['ALLOWED'])),
+                             index=df_snowflake.index)
+            df_snowflake = df_snowflake[~keys.isin(seen)]
+            seen.update(keys[df_snowflake.index])
+
+            if not df_snowflake.empty:
+                yield df_snowflake
+
+    def load_reference_rows(self, body: DataFrame) -> DataFrame:
+        """
+        Load from Snowflake only the reference rows a batch of VOBs can use,
+        instead of the whole table.
+
+        Parameters:
+            body (DataFrame): Data sent by the user, one row per VOB.
+
+        Returns:
+            dataframe (pd.DataFrame): The rows whose key of any waterfall
+            level, or POLICY_TYPE, is one of the batch, cleaned as in
+            load_data_from_snowflake. For these VOBs the waterfall lookups,
+            the PAID_CLAIM_$ search and the category checks give the same
+            results as with the whole table.
+        """
+        sql = TextfileManager('sql/').load_textfile('eiv_sql.sql')
+
+        # Keys as load_data_to_dataframe and verify_categories search them
+        keys = {'CLIENT_NAME': body['ClientName'],
+                'PREFIX': body['PolicyID'].map(lambda policy_id: extract_prefix(policy_id, 3)),
+                'PAYOR': body['Payor'],
+                'STATE': body['State'],
+                'SUBSCRIBER': body['Subscriber'],
+                'GROUP_NUMBER': body['GroupID'],
+                'FUNDED_STATUS': body['FundingType'],
+                'POLICY_TYPE': body['PolicyType']}
+
+        # With the other rows of their (CLIENT_NAME, ALLOWED), so the same
+        # duplicates are dropped as in the whole table
+        df_snowflake = self.eiv_repository.retrieve_rows_by_keys(
+            sql, {column: values.tolist() for column, values in keys.items()}, REFERENCE_KEY)
+
+        return self.clean_reference_data(df_snowflake)
+
+    def probe_reference_data(self, table: str) -> dict:
+        """
+        Check cheaply whether the reference table changed, without reading
+        it.
+
+        Parameters:
+            table (str): The table of 'eiv_sql.sql', DATABASE.SCHEMA.TABLE.
+
+        Returns:
+            dict: 'last_altered' and 'row_count' of the table; equal probes
+            mean the table didn't change.
+        """
+        return self.eiv_repository.probe_snowflake_table(table)
+
+    def load_reference_changes(self, watermark_column: str, watermark) -> DataFrame:
+        """
+        Load the reference rows changed after a watermark.
+
+        Parameters:
+            watermark_column (str): Last modified column of the table.
+            watermark: Greatest value of watermark_column already loaded.
+
+        Returns:
+            dataframe (pd.DataFrame): The changed rows with every other row
+            of their (CLIENT_NAME, ALLOWED), in the order of the table and
+            not cleaned yet, see merge_reference_changes.
+        """
+        if not SQL_IDENTIFIER.match(watermark_column):
+            raise ValueError(f"Invalid watermark column {watermark_column}")
+
+        # Same query as the full load, limited to the groups of the rows
+        # changed since then, so their duplicates are dropped as in it
+        sql = TextfileManager('sql/').load_textfile('eiv_sql.sql')
+        sql = select_row_groups(sql, f"{watermark_column} > %(watermark)s", REFERENCE_KEY)
+
+        return self.eiv_repository.retrieve_data_from_snowflake(sql, {'watermark': watermark}, ttl=0)
+
+    def merge_reference_changes(self, data: DataFrame, changes: DataFrame) -> DataFrame:
+        """
+        Merge changed reference rows into the current reference data.
+
+        Parameters:
+            data (pd.DataFrame): Current reference data, not modified.
+            changes (pd.DataFrame): Rows returned by load_reference_changes.
+
+        Returns:
+            dataframe (pd.DataFrame): data with the rows of the same
+            (CLIENT_NAME, ALLOWED) as a change replaced in place and the
+            other changes appended, so the first match of every waterfall
+            lookup is the same as after a full load.
+
+        Process:
+            - Cleans the changes as in load_data_from_snowflake, so a change
+              of a row the full load drops, as a duplicate of an earlier row
+              of its (CLIENT_NAME, ALLOWED), keeps that earlier row.
+        """
+        keys = REFERENCE_KEY
+        data = data.reset_index(drop=True)
+        changes = self.clean_reference_data(changes)
+        changes = changes.reindex(columns=data.columns).reset_index(drop=True)
+
+        positions = pd.MultiIndex.from_frame(data[keys]).get_indexer(pd.MultiIndex.from_frame(changes[keys]))
+        replaced = positions >= 0
+
+        # Position of every row in the result: kept rows and replacements at
+        # the position of the row they replace, new rows at the end
+        kept = np.ones(len(data), dtype=bool)
+        kept[positions[replaced]] = False
+        order = np.concatenate([np.flatnonzero(kept), positions[replaced],
+                                len(data) + np.arange((~replaced).sum())])
+
+        merged = pd.concat([data[kept], changes[replaced], changes[~replaced]], ignore_index=True)
+        return merged.iloc[np.argsort(order, kind='stable')].reset_index(drop=True)
+
+    def verify_categories(self, body: DataFrame,
+                          reference_index: ReferenceIndex) -> Dict[int, List[dict]]:
+        """
+        Verify the PAYOR, STATE and POLICY_TYPE of every client against the
+        categories found in Snowflake.
+
+        Parameters:
+            body (DataFrame): Data sent by the user, one row per VOB.
+            reference_index (ReferenceIndex): Data loaded from Snowflake,
+            with the allowed categories precomputed.
+
+        Returns:
+            Dict[int, List[dict]]: For every row (body index) with a category
+            that is not allowed, one {'field', 'type', 'error'} item per
+            failed field.
+        """
+        try:
+            errors = {}
+            features = [('Payor', 'PAYOR', body['Payor']),
+                        ('State', 'STATE', body['State'].str.upper()),
+                        ('PolicyType', 'POLICY_TYPE', body['PolicyType'])]
+
+            for field, column_name, feature in features:
+                invalid = verify_data_categories(df_snowflake=reference_index.data,
+                                                 feature=feature,
+                                                 column_name=column_name,
+                                                 apply_filter=True,
+                                                 allowed_categories=reference_index.allowed_categories(column_name))
+                for row, message in invalid.items():
+                    errors.setdefault(row, []).append({'field': field,
+                                                       'type': 'category',
+                                                       'error': message})
+
+            return errors
+        except Exception as e:
+            raise Exception(f"Error verifying categories: {str(e)}")
+
     def load_data_to_dataframe(self, body: DataFrame,
-                               df_snowflake: DataFrame) -> DataFrame:
+                               reference_index: ReferenceIndex) -> DataFrame:
         """
         Create the initial DataFrame for use.
 
+        Parameters:
+            body (DataFrame): Data sent by the user, one row per VOB. The
+            categories must be checked before with verify_categories.
+            reference_index (ReferenceIndex): Data loaded from Snowflake and
+            its indexes.
+
         Returns:
-            DataFrame: A DataFrame containing the loaded data.
+            DataFrame: A DataFrame containing the loaded data, one row per
+            VOB with the same index as body.
         Process:
             - Creates every field for the Dataframe for use the model
+            - Looks up the waterfall values of every level in the hash
+              indexes of reference_index
         """
         try:
-            client_name = {'CLIENT_NAME': ['', '']}
-            index = [0, 1]  # Only for one client
-            data = pd.DataFrame(client_name, index=index)
+            data = pd.DataFrame(index=body.index)
 
             # Identification data
             data['VOB_ID'] = body['VOBID']
-            data['CLIENT_NAME'] = body['ClientName'] if body['ClientName'] is not None else None
-            data['CONNECT_TRACKING_ID'] = body['ClientTrackingID'] if body['ClientTrackingID'] is not None else None
+            data['CLIENT_NAME'] = body['ClientName']
+            data['CONNECT_TRACKING_ID'] = body['ClientTrackingID']
 
             # Relevant variables for the model
-            data['SUBSCRIBER'] = body['Subscriber'].str.upper() if body['Subscriber'] is not None else None
-            data['GROUP_NUMBER'] = body['GroupID'].str.upper() if body['GroupID'] is not None else None
-            data['PREFIX'] = extract_prefix(body['PolicyID'], 3)
-
-            payor = body['Payor'] if body['Payor'] is not None else None
-            data['PAYOR'] = verify_data_categories(df_snowflake=df_snowflake,
-                                                   feature=payor,
-                                                   column_name='PAYOR',
-                                                   apply_filter=True)
-            data['FUNDED_STATUS'] = body['FundingType'] if body['FundingType'] is not None else None
-
-            state = body['State'].str.upper() if body['State'] is not None else None
-            data['STATE'] = verify_data_categories(df_snowflake=df_snowflake,
-                                                   feature=state,
-                                                   column_name='STATE',
-                                                   apply_filter=True)
+            data['SUBSCRIBER'] = body['Subscriber'].str.upper()
+            data['GROUP_NUMBER'] = body['GroupID'].str.upper()
+            data['PREFIX'] = body['PolicyID'].map(lambda policy_id: extract_prefix(policy_id, 3))
+            data['PAYOR'] = body['Payor']
+            data['FUNDED_STATUS'] = body['FundingType']
+            data['STATE'] = body['State'].str.upper()
 
             data['DEDUCTIBLE'] = body['Deductible']
             data['OUT_OF_POCKET'] = body['OutOfBucket']
@@ -109,11 +306,7 @@ class EIVService:
             data['OON_BENEFITS'] = body['OONBenefits']
             data['SCA_FLAG'] = body['SCA']
             data['MULTIPLAN_FLAG'] = body['Multiplan']
-
-            data['POLICY_TYPE'] = verify_data_categories(df_snowflake=df_snowflake,
-                                                         feature=body['PolicyType'],
-                                                         column_name='POLICY_TYPE',
-                                                         apply_filter=True)
+            data['POLICY_TYPE'] = body['PolicyType']
 
             # Remplace for data be equal to snowflake for querys
             data['OON_BENEFITS'] = data['OON_BENEFITS'].astype(str, errors='ignore').replace({'True': 'Yes',
@@ -123,65 +316,25 @@ class EIVService:
             data['MULTIPLAN_FLAG'] = data['MULTIPLAN_FLAG'].astype(str, errors='ignore').replace({'True': 'Yes',
                                                                                                   'False': 'No'})
 
-            # Return data from the number of claims in the waterfall
-            data['CLIENT_CLAIMS_PY'] = search_and_get_first_value(df_snowflake, 'CLIENT_NAME', data['CLIENT_NAME'][0],'CLIENT_CLAIMS_PY', data['SCA_FLAG'][0])
-            data['PREFIX_CLAIMS_PY'] = search_and_get_first_value(df_snowflake, 'PREFIX', data['PREFIX'][0], 'PREFIX_CLAIMS_PY', data['SCA_FLAG'][0])
-            data['PAYOR_CLAIMS_PY'] = search_and_get_first_value(df_snowflake, 'PAYOR', data['PAYOR'][0], 'PAYOR_CLAIMS_PY', data['SCA_FLAG'][0])
-            data['STATE_CLAIMS_PY'] = search_and_get_first_value(df_snowflake, 'STATE', data['STATE'][0], 'STATE_CLAIMS_PY', data['SCA_FLAG'][0])
-            data['SUBS_CLAIMS_PY'] = search_and_get_first_value(df_snowflake, 'SUBSCRIBER', data['SUBSCRIBER'][0], 'SUBS_CLAIMS_PY', data['SCA_FLAG'][0])
-            data['GROUP_CLAIMS_PY'] = search_and_get_first_value(df_snowflake, 'GROUP_NUMBER', data['GROUP_NUMBER'][0], 'GROUP_CLAIMS_PY', data['SCA_FLAG'][0])
-            data['FUNDED_CLAIMS_PY'] = search_and_get_first_value(df_snowflake, 'FUNDED_STATUS', data['FUNDED_STATUS'][0], 'FUNDED_CLAIMS_PY', data['SCA_FLAG'][0])
-
-            data['CLIENT_CLAIMS'] = search_and_get_first_value(df_snowflake, 'CLIENT_NAME',data['CLIENT_NAME'][0],'CLIENT_CLAIMS', data['SCA_FLAG'][0])
-            data['PREFIX_CLAIMS'] = search_and_get_first_value(df_snowflake, 'PREFIX', data['PREFIX'][0], 'PREFIX_CLAIMS', data['SCA_FLAG'][0])
-            data['PAYOR_CLAIMS'] = search_and_get_first_value(df_snowflake, 'PAYOR', data['PAYOR'][0], 'PAYOR_CLAIMS', data['SCA_FLAG'][0])
-            data['STATE_CLAIMS'] = search_and_get_first_value(df_snowflake, 'STATE', data['STATE'][0], 'STATE_CLAIMS', data['SCA_FLAG'][0])
-            data['SUBS_CLAIMS'] = search_and_get_first_value(df_snowflake, 'SUBSCRIBER', data['SUBSCRIBER'][0], 'SUBS_CLAIMS', data['SCA_FLAG'][0])
-            data['GROUP_CLAIMS'] = search_and_get_first_value(df_snowflake, 'GROUP_NUMBER', data['GROUP_NUMBER'][0], 'GROUP_CLAIMS', data['SCA_FLAG'][0])
-            data['FUNDED_CLAIMS'] = search_and_get_first_value(df_snowflake, 'FUNDED_STATUS', data['FUNDED_STATUS'][0], 'FUNDED_CLAIMS', data['SCA_FLAG'][0])
-
-            # Return data from the pullthrought of claims in the waterfall
-            data['CLIENT_$_PY'] = search_and_get_first_value(df_snowflake, 'CLIENT_NAME',data['CLIENT_NAME'][0],'CLIENT_$_PY',data['SCA_FLAG'][0])
-            data['PREFIX_$_PY'] = search_and_get_first_value(df_snowflake, 'PREFIX', data['PREFIX'][0], 'PREFIX_$_PY',data['SCA_FLAG'][0])
-            data['PAYOR_$_PY'] = search_and_get_first_value(df_snowflake, 'PAYOR', data['PAYOR'][0], 'PAYOR_$_PY',data['SCA_FLAG'][0])
-            data['STATE_$_PY'] = search_and_get_first_value(df_snowflake, 'STATE', data['STATE'][0], 'STATE_$_PY',data['SCA_FLAG'][0])
-            data['SUBS_$_PY'] = search_and_get_first_value(df_snowflake, 'SUBSCRIBER', data['SUBSCRIBER'][0], 'SUBS_$_PY',data['SCA_FLAG'][0])
-            data['GROUP_$_PY'] = search_and_get_first_value(df_snowflake, 'GROUP_NUMBER', data['GROUP_NUMBER'][0], 'GROUP_$_PY',data['SCA_FLAG'][0])
-            data['FUNDED_$_PY'] = search_and_get_first_value(df_snowflake, 'FUNDED_STATUS', data['FUNDED_STATUS'][0], 'FUNDED_$_PY',data['SCA_FLAG'][0])
-
-            data['CLIENT_$'] = search_and_get_first_value(df_snowflake, 'CLIENT_NAME', data['CLIENT_NAME'][0],'CLIENT_$', data['SCA_FLAG'][0])
-            data['PREFIX_$'] = search_and_get_first_value(df_snowflake, 'PREFIX', data['PREFIX'][0], 'PREFIX_$', data['SCA_FLAG'][0])
-            data['PAYOR_$'] = search_and_get_first_value(df_snowflake, 'PAYOR', data['PAYOR'][0], 'PAYOR_$',data['SCA_FLAG'][0])
-            data['STATE_$'] = search_and_get_first_value(df_snowflake, 'STATE', data['STATE'][0], 'STATE_$',data['SCA_FLAG'][0])
-            data['SUBS_$'] = search_and_get_first_value(df_snowflake, 'SUBSCRIBER', data['SUBSCRIBER'][0], 'SUBS_$',data['SCA_FLAG'][0])
-            data['GROUP_$'] = search_and_get_first_value(df_snowflake, 'GROUP_NUMBER', data['GROUP_NUMBER'][0], 'GROUP_$',data['SCA_FLAG'][0])
-            data['FUNDED_$'] = search_and_get_first_value(df_snowflake, 'FUNDED_STATUS', data['FUNDED_STATUS'][0], 'FUNDED_$',data['SCA_FLAG'][0])
-            data['MASTER_COLLECTED'] = data.apply(calculate_master_collected, axis=1)
-
-            # Return data from the number of claims in the waterfall
-            data['CLIENT_BILL_PY'] = search_and_get_first_value(df_snowflake, 'CLIENT_NAME',data['CLIENT_NAME'][0],'CLIENT_BILL_PY', data['SCA_FLAG'][0])
-            data['PREFIX_BILL_PY'] = search_and_get_first_value(df_snowflake, 'PREFIX', data['PREFIX'][0], 'PREFIX_BILL_PY',data['SCA_FLAG'][0])
-            data['PAYOR_BILL_PY'] = search_and_get_first_value(df_snowflake, 'PAYOR', data['PAYOR'][0], 'PAYOR_BILL',data['SCA_FLAG'][0])
-            data['STATE_BILL_PY'] = search_and_get_first_value(df_snowflake, 'STATE', data['STATE'][0], 'STATE_BILL_PY',data['SCA_FLAG'][0])
-            data['SUBS_BILL_PY'] = search_and_get_first_value(df_snowflake, 'SUBSCRIBER', data['SUBSCRIBER'][0], 'SUBS_BILL',data['SCA_FLAG'][0])
-            data['GROUP_BILL_PY'] = search_and_get_first_value(df_snowflake, 'GROUP_NUMBER', data['GROUP_NUMBER'][0], 'GROUP_BILL_PY',data['SCA_FLAG'][0])
-            data['FUNDED_BILL_PY'] = search_and_get_first_value(df_snowflake, 'FUNDED_STATUS', data['FUNDED_STATUS'][0], 'FUNDED_BILL_PY',data['SCA_FLAG'][0])
-            
-            data['CLIENT_BILL'] = search_and_get_first_value(df_snowflake, 'CLIENT_NAME',data['CLIENT_NAME'][0],'CLIENT_BILL',data['SCA_FLAG'][0])
-            data['PREFIX_BILL'] = search_and_get_first_value(df_snowflake, 'PREFIX', data['PREFIX'][0], 'PREFIX_BILL',data['SCA_FLAG'][0])
-            data['PAYOR_BILL'] = search_and_get_first_value(df_snowflake, 'PAYOR', data['PAYOR'][0], 'PAYOR_BILL',data['SCA_FLAG'][0])
-            data['STATE_BILL'] = search_and_get_first_value(df_snowflake, 'STATE', data['STATE'][0], 'STATE_BILL',data['SCA_FLAG'][0])
-            data['SUBS_BILL'] = search_and_get_first_value(df_snowflake, 'SUBSCRIBER', data['SUBSCRIBER'][0], 'SUBS_BILL',data['SCA_FLAG'][0])
-            data['GROUP_BILL'] = search_and_get_first_value(df_snowflake, 'GROUP_NUMBER', data['GROUP_NUMBER'][0], 'GROUP_BILL',data['SCA_FLAG'][0])
-            data['FUNDED_BILL'] = search_and_get_first_value(df_snowflake, 'FUNDED_STATUS', data['FUNDED_STATUS'][0], 'FUNDED_BILL',data['SCA_FLAG'][0])
-            data['CLAIM_AMOUNT_PAID'] = data.apply(calculate_claim_amount_paid, axis=1)
+            # Return the number of claims, pullthrought and bills of every
+            # level in the waterfall
+            for search_column in WATERFALL_DIMENSIONS:
+                values = reference_index.lookup(search_column, data[search_column],
+                                                data['SCA_FLAG'])
+                data[values.columns] = values
+
+            # Level of the waterfall that resolved every value, for audits
+            data['MASTER_COLLECTED'], data['MASTER_COLLECTED_LEVEL'] = \
+                resolve_waterfall(data, MASTER_COLLECTED_RULES)
+            data['CLAIM_AMOUNT_PAID'], data['CLAIM_AMOUNT_PAID_LEVEL'] = \
+                resolve_waterfall(data, CLAIM_AMOUNT_PAID_RULES)
 
             # This is the tarjet variable - only for train pursoses
-            data['PAID_CLAIM_$'] = search_specific_and_get_first_value(df_snowflake, data['CLIENT_NAME'][0], data['PREFIX'][0],
-                                                                       data['PAYOR'][0], data['STATE'][0], data['SUBSCRIBER'][0],
-                                                                       data['GROUP_NUMBER'][0], data['FUNDED_STATUS'][0], 'PAID_CLAIM_$')
-            # Only for unique propouses
-            data.iloc[1] = data.iloc[0]
+            # First row matching all the keys of every client
+            keys = data[list(WATERFALL_DIMENSIONS)].astype(object)
+            keys = keys.where(keys.notna(), None)
+            data['PAID_CLAIM_$'] = [reference_index.first_value(key, 'PAID_CLAIM_$')
+                                    for key in keys.itertuples(index=False, name=None)]
 
             return data
         except Exception as e:
@@ -427,7 +580,6 @@ class EIVService:
         """
         try:
             pred = model.predict_proba(data)
-            pred = np.tile(pred, (data.shape[0], 1))
             return pred
 
         except ValueError as e:
@@ -490,8 +642,9 @@ class EIVService:
             prediction_class_nsca = np.select(conditions, values, default='Unknown')
             
             # Select the maximun probability of be in the classification group
-            prediction_data_prob_sca = np.max(prediction_data_prob_sca, axis=1)
-            prediction_data_prob_nsca = np.max(prediction_data_prob_nsca, axis=1)
+            # (as float64, so the rounded values stay exact once serialized)
+            prediction_data_prob_sca = np.max(prediction_data_prob_sca, axis=1).astype(float)
+            prediction_data_prob_nsca = np.max(prediction_data_prob_nsca, axis=1).astype(float)
             
             # Financial Status
             conditions = [(prediction_class_sca == 'Scholarship') | (prediction_class_sca == 'Mid Payor'), (prediction_class_sca == 'Scholarship Provider')]
@@ -532,7 +685,7 @@ class EIVService:
         except Exception as e:
             raise Exception(f"Error creating prediction DataFrame: {str(e)}")
 
-    def save_data_with_cashrepository(self, data: DataFrame, table_name: str):
+    def save_data_with_cashrepository(self, data: DataFrame, table_name: str) -> List[dict]:
         """
         Save data to the TimeRepository.
 
@@ -541,12 +694,12 @@ class EIVService:
             table_name (str): The name of the database table to save the data.
 
         Returns:
-            None
+            List[dict]: 'batch', 'rows' and 'seconds' of every batch written.
 
         Process:
             - Uses the TimeRepository object to save the provided data in the specified table.
         """
         try:
-            self.eiv_repository.save_data(data, table_name)
+            return self.eiv_repository.save_data(data, table_name)
         except Exception as e:
             raise Exception(f"Error saving data with TimeRepository: {str(e)}")
\ No newline at end of file
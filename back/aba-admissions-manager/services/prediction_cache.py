@@ -0,0 +1,163 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, List, Tuple
+import numpy as np
+import pandas as pd
+
+
+class PredictionCache:
+    """
+    LRU cache with a time to live of the model outputs of every feature
+    vector, so VOBs that resolve to the same model inputs skip inference.
+
+    Variables:
+        max_size (int): Feature vectors kept; the least recently used one is
+        dropped when a new one doesn't fit.
+        ttl (float): Seconds an entry is reused after it was stored.
+        decimals (int): Decimals the features are rounded to for the key.
+
+    Interactions:
+        - Kept by the AppContext and used by EIVController.score between
+          transform_columns and model_predict.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 3600.0,
+                 decimals: int = 6):
+        """
+        Initializes the PredictionCache object.
+
+        Parameters:
+            max_size (int): Feature vectors kept.
+            ttl (float): Seconds an entry is reused.
+            decimals (int): Decimals of the features in the key.
+
+        Returns:
+            None
+        """
+        if max_size < 1:
+            raise ValueError("max_size should be positive")
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.decimals = decimals
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def make_keys(self, features: pd.DataFrame, version: Hashable) -> List[Tuple]:
+        """
+        Build the key of every row of features.
+
+        Parameters:
+            features (DataFrame): Model inputs, one row per VOB.
+            version (Hashable): Version of the reference data the features
+            were computed from.
+
+        Returns:
+            List[Tuple]: (version, columns, rounded feature vector) of every
+            row.
+        """
+        values = np.round(features.to_numpy(dtype=np.float64), self.decimals)
+        # Bytes keep NaN values comparable and are cheap to hash
+        return [(version, tuple(features.columns), row.tobytes()) for row in values]
+
+    def get(self, key: Tuple):
+        """
+        Return the outputs stored for key, or None if there are none or
+        they expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            stored_at, value = entry
+            if time.monotonic() - stored_at >= self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Tuple, value):
+        """
+        Store the outputs of key, dropping the least recently used entries
+        that don't fit.
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def predict(self, features: pd.DataFrame, version: Hashable,
+                predict: Callable[[pd.DataFrame], Tuple[np.ndarray, ...]]) -> Tuple[np.ndarray, ...]:
+        """
+        Return the model outputs of every row of features, calling predict
+        only for the feature vectors not found in the cache.
+
+        Parameters:
+            features (DataFrame): Model inputs, one row per VOB.
+            version (Hashable): Version of the reference data.
+            predict (Callable): Function that returns a tuple of arrays with
+            one item (a value or a row) per row of the features it gets.
+
+        Returns:
+            Tuple[np.ndarray, ...]: The outputs of predict for all the rows,
+            in the order of features.
+
+        Process:
+            - Rows with the same key are predicted once.
+            - The returned arrays are new, so callers may modify them.
+        """
+        keys = self.make_keys(features, version)
+        values = [self.get(key) for key in keys]
+
+        # First row of every key not found
+        missing = {}
+        for position, (key, value) in enumerate(zip(keys, values)):
+            if value is None and key not in missing:
+                missing[key] = position
+
+        if missing:
+            outputs = predict(features.iloc[list(missing.values())])
+            for item, key in enumerate(missing):
+                value = tuple(np.copy(output[item]) for output in outputs)
+                self.put(key, value)
+                missing[key] = value
+            values = [missing[key] if value is None else value
+                      for key, value in zip(keys, values)]
+
+        return tuple(np.array([value[output] for value in values])
+                     for output in range(len(values[0])))
+
+    def clear(self):
+        """
+        Drop every entry.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Return the hits, misses, evictions, expirations, size and hit rate
+        of the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'size': len(self._entries),
+                    'max_size': self.max_size,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
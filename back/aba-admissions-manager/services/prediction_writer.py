@@ -0,0 +1,366 @@
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, List, Tuple
+import pandas as pd
+
+
+class PredictionWriter:
+    """
+    Write-behind queue of the predictions saved into RDS, so the responses
+    don't wait for the insert, nor fail with it.
+
+    Variables:
+        save (Callable[[pd.DataFrame, str], object]): Function that saves a
+        DataFrame of predictions into a table, e.g.
+        EIVService.save_data_with_cashrepository, returning the timings of
+        its batches, if any.
+        max_pending_rows (int): Rows kept in memory; predictions submitted
+        beyond that are spilled to disk.
+        batch_rows (int): Rows that start a write without waiting for
+        flush_interval.
+        flush_interval (float): Seconds the first pending row waits for more
+        rows before they are written.
+        max_retries (int): Attempts after a failed write before its rows are
+        spilled to disk.
+        backoff (float): Seconds before the first retry; doubled on every
+        retry up to max_backoff.
+        max_backoff (float): Longest wait between retries.
+        spill_dir (str): Folder of the Parquet files of the rows that
+        couldn't be written. They are written again, oldest first, once a
+        write succeeds, also by other processes or the next Lambda
+        invocation of the container.
+
+    Interactions:
+        - Kept by the AppContext. EIVController.predict_pipeline submits the
+          predictions of every request.
+        - The Lambda handler flushes what is pending before the container is
+          frozen, for up to 'lambda_flush_timeout' seconds, and spills the
+          rows left to disk (see AppContext.flush_predictions); the ECS
+          server flushes it on shutdown through AppContext.reset.
+        - Rows can still be lost in Lambda when the flush doesn't finish:
+          the spilled ones if the container is reclaimed instead of thawed,
+          as /tmp goes with it, and the batch being written when it is
+          frozen, which is retried after the thaw but lost with the
+          container too.
+    """
+
+    def __init__(self, save: Callable[[pd.DataFrame, str], object],
+                 max_pending_rows: int = 50000, batch_rows: int = 1000,
+                 flush_interval: float = 1.0, max_retries: int = 5,
+                 backoff: float = 0.5, max_backoff: float = 30.0,
+                 spill_dir: str = '/tmp/eiv_spill'):
+        """
+        Initializes the PredictionWriter object.
+
+        Parameters:
+            save (Callable[[pd.DataFrame, str], object]): Saves predictions
+            into a table.
+            max_pending_rows (int): Rows kept in memory.
+            batch_rows (int): Rows written without waiting.
+            flush_interval (float): Seconds pending rows wait for more.
+            max_retries (int): Retries of a failed write.
+            backoff (float): Seconds before the first retry.
+            max_backoff (float): Longest wait between retries.
+            spill_dir (str): Folder of the rows not written.
+
+        Returns:
+            None
+        """
+        if batch_rows < 1 or max_pending_rows < 1:
+            raise ValueError("batch_rows and max_pending_rows should be positive")
+
+        self.save = save
+        self.max_pending_rows = max_pending_rows
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.spill_dir = spill_dir
+        # (table name, predictions) in the order submitted
+        self._pending = deque()
+        self._pending_rows = 0
+        self._first_pending_at = None
+        self._writing = False
+        self._flushes = 0
+        # Write the next predictions at once, and the spilled ones after them
+        self._replay_requested = False
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self.submitted_rows = 0
+        self.saved_rows = 0
+        self.batches = 0
+        self.failures = 0
+        self.retries = 0
+        self.spilled_rows = 0
+        self.replayed_rows = 0
+        self.lost_rows = 0
+        self.last_error = None
+        self.last_write_seconds = None
+        self.last_write_batches = None
+
+    def submit(self, data: pd.DataFrame, table_name: str):
+        """
+        Queue predictions to be saved into table_name, without waiting.
+        Rows beyond max_pending_rows are spilled to disk instead.
+        """
+        if data.empty:
+            return
+
+        data = data.copy()
+        with self._condition:
+            self.submitted_rows += len(data)
+            full = self._pending_rows + len(data) > self.max_pending_rows
+            if not full:
+                self._pending.append((table_name, data))
+                self._pending_rows += len(data)
+                if self._first_pending_at is None:
+                    self._first_pending_at = time.monotonic()
+                self._condition.notify_all()
+
+        if full:
+            self._spill(data, table_name)
+        self.start()
+
+    def start(self):
+        """
+        Start the thread writing the predictions, if it isn't running.
+        """
+        with self._condition:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name='eiv-prediction-writer',
+                                            daemon=True)
+            self._thread.start()
+
+    def run(self):
+        """
+        Write the pending predictions, by table, whenever batch_rows are
+        pending, the first of them waited flush_interval, or a flush is
+        requested, until close is called.
+
+        Process:
+            - A failed write is retried with exponential backoff up to
+              max_retries times; its rows are then spilled to disk.
+            - After a write succeeds, the rows spilled before are written
+              again.
+        """
+        self._replay_spilled()
+        while True:
+            with self._condition:
+                while not self._ready():
+                    if self._stop.is_set():
+                        return
+                    self._condition.wait(self._wait_time())
+                batch = self._take_pending()
+                self._writing = True
+
+            written = True
+            try:
+                for table_name, data in batch:
+                    written = self._write(data, table_name) and written
+            finally:
+                with self._condition:
+                    self._writing = False
+                    self._condition.notify_all()
+
+            if written and not self._stop.is_set():
+                self._replay_spilled()
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Write every pending prediction now, waiting up to timeout seconds
+        (None waits for them all).
+
+        Returns:
+            bool: True if nothing is pending nor being written.
+        """
+        self.start()
+        with self._condition:
+            self._flushes += 1
+            self._condition.notify_all()
+            try:
+                return self._condition.wait_for(lambda: not self._pending and not self._writing,
+                                                timeout)
+            finally:
+                self._flushes -= 1
+
+    def spill_pending(self):
+        """
+        Move the predictions not being written yet to disk, without waiting
+        for the database, e.g. before a Lambda container is frozen or when a
+        flush didn't finish in time and the process may not resume.
+
+        Process:
+            - The thread isn't woken: the next predictions submitted are
+              written at once, without waiting for flush_interval, and the
+              spilled ones after them.
+        """
+        with self._condition:
+            batch = self._take_pending()
+        for table_name, data in batch:
+            self._spill(data, table_name)
+        if batch:
+            with self._condition:
+                self._replay_requested = True
+
+    def close(self, timeout: float = 30.0):
+        """
+        Flush the pending predictions for up to timeout seconds, spill the
+        ones left and stop the thread.
+        """
+        if not self.flush(timeout):
+            self.spill_pending()
+        self._stop.set()
+        with self._condition:
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self) -> dict:
+        """
+        Return the rows submitted, pending, saved, spilled to disk, written
+        again from disk and lost (neither saved nor spilled), the writes,
+        failed writes and retries, the last error, and the duration of the
+        last write (seconds) and the timings of its batches, as returned by
+        save.
+        """
+        with self._condition:
+            return {'running': self._thread is not None and self._thread.is_alive(),
+                    'submitted_rows': self.submitted_rows,
+                    'pending_rows': self._pending_rows,
+                    'saved_rows': self.saved_rows,
+                    'spilled_rows': self.spilled_rows,
+                    'replayed_rows': self.replayed_rows,
+                    'lost_rows': self.lost_rows,
+                    'batches': self.batches,
+                    'failures': self.failures,
+                    'retries': self.retries,
+                    'last_error': self.last_error,
+                    'last_write_seconds': self.last_write_seconds,
+                    'last_write_batches': self.last_write_batches}
+
+    def _ready(self) -> bool:
+        # Called with _condition held
+        if not self._pending:
+            return False
+        return (self._pending_rows >= self.batch_rows or self._flushes > 0 or self._stop.is_set()
+                or self._replay_requested
+                or time.monotonic() - self._first_pending_at >= self.flush_interval)
+
+    def _wait_time(self) -> float:
+        # Called with _condition held
+        if not self._pending:
+            return None
+        if self._replay_requested:
+            return 0.0
+        return max(self.flush_interval - (time.monotonic() - self._first_pending_at), 0.0)
+
+    def _take_pending(self) -> List[Tuple[str, pd.DataFrame]]:
+        # Called with _condition held; every table is written in one batch
+        tables = {}
+        for table_name, data in self._pending:
+            tables.setdefault(table_name, []).append(data)
+        self._pending.clear()
+        self._pending_rows = 0
+        self._first_pending_at = None
+        return [(table_name, pd.concat(frames, ignore_index=True))
+                for table_name, frames in tables.items()]
+
+    def _write(self, data: pd.DataFrame, table_name: str, spill: bool = True) -> bool:
+        for attempt in range(self.max_retries + 1):
+            started_at = time.monotonic()
+            try:
+                batches = self.save(data, table_name)
+            except Exception as e:
+                self.failures += 1
+                self.last_error = f"Error saving the predictions: {str(e)}"
+                if attempt == self.max_retries or self._stop.is_set() or not spill:
+                    break
+                self.retries += 1
+                # Returns at once when the writer is closed
+                self._stop.wait(min(self.backoff * 2 ** attempt, self.max_backoff))
+                continue
+
+            self.last_write_seconds = time.monotonic() - started_at
+            self.last_write_batches = batches
+            self.saved_rows += len(data)
+            self.batches += 1
+            return True
+
+        if spill:
+            self._spill(data, table_name)
+        return False
+
+    def _spill(self, data: pd.DataFrame, table_name: str):
+        path = os.path.join(self.spill_dir, f'{table_name}-{time.time_ns()}-{os.getpid()}.parquet')
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            data.to_parquet(path + '.tmp', index=False)
+            os.replace(path + '.tmp', path)
+            self.spilled_rows += len(data)
+        except Exception as e:
+            self.lost_rows += len(data)
+            self.last_error = f"Error spilling the predictions to '{self.spill_dir}': {str(e)}"
+
+    def _replay_spilled(self):
+        # Write the spilled files again, oldest first, until one fails
+        try:
+            file_names = os.listdir(self.spill_dir)
+        except OSError:
+            # Nothing was spilled
+            with self._condition:
+                self._replay_requested = False
+            return
+
+        for file_name in file_names:
+            # Files claimed by a process that died while writing them
+            if file_name.endswith('.replay'):
+                pid = int(file_name.rsplit('.', 2)[1])
+                if pid != os.getpid() and not _is_running(pid):
+                    try:
+                        os.rename(os.path.join(self.spill_dir, file_name),
+                                  os.path.join(self.spill_dir, file_name.rsplit('.', 2)[0]))
+                        file_names.append(file_name.rsplit('.', 2)[0])
+                    except OSError:
+                        pass
+
+        file_names = sorted((file_name for file_name in file_names if file_name.endswith('.parquet')),
+                            key=lambda file_name: int(file_name.rsplit('-', 2)[1]))
+
+        for file_name in file_names:
+            if self._stop.is_set():
+                return
+            path = os.path.join(self.spill_dir, file_name)
+            claimed_path = f'{path}.{os.getpid()}.replay'
+            try:
+                # Taken by one process only
+                os.rename(path, claimed_path)
+                data = pd.read_parquet(claimed_path)
+            except (OSError, ValueError):
+                continue
+
+            table_name = file_name.rsplit('-', 2)[0]
+            if not self._write(data, table_name, spill=False):
+                os.rename(claimed_path, path)
+                return
+            os.remove(claimed_path)
+            self.replayed_rows += len(data)
+
+        with self._condition:
+            self._replay_requested = False
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
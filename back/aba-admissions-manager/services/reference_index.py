@@ -0,0 +1,284 @@
+from typing import Dict, Hashable, Iterable, Tuple
+import numpy as np
+import pandas as pd
+from services.eiv_helper import WATERFALL_DIMENSIONS, waterfall_columns, normalize_key
+
+# Columns whose categories are verified against the reference data
+CATEGORY_COLUMNS = ['PAYOR', 'REGION', 'STATE', 'POLICY_TYPE', 'PAYOR_TYPE']
+
+# Metric columns read by the waterfall lookups
+METRIC_COLUMNS = list(dict.fromkeys(source for prefix in WATERFALL_DIMENSIONS.values()
+                                    for source in waterfall_columns(prefix).values()))
+
+# Columns of the reference data read by the pipeline; ALLOWED is the
+# (CLIENT_NAME, ALLOWED) key of the incremental refresh
+REFERENCE_COLUMNS = list(dict.fromkeys([*WATERFALL_DIMENSIONS, *CATEGORY_COLUMNS, 'SCA_FLAG',
+                                        'ALLOWED', 'PAID_CLAIM_$', *METRIC_COLUMNS]))
+
+
+def compact_reference_data(data: pd.DataFrame,
+                           keep_columns: Iterable[str] = ()) -> Tuple[pd.DataFrame, dict]:
+    """
+    Return a compact, typed copy of the reference data.
+
+    Parameters:
+        data (pd.DataFrame): Reference data as loaded from Snowflake.
+        keep_columns (Iterable[str]): Other columns to keep, e.g. the
+        watermark of the incremental refresh.
+
+    Returns:
+        pd.DataFrame: The columns of REFERENCE_COLUMNS and keep_columns,
+        with the key and category columns as pandas categoricals, the
+        metric columns as int32 (whole numbers without missing values) or
+        float32, and SCA_FLAG as a nullable boolean (True for 'Yes').
+        dict: 'rows', 'columns_before', 'columns_after', 'bytes_before' and
+        'bytes_after' (deep memory usage) of the data.
+
+    Process:
+        - The text keeps its case, as the categories are verified case
+          sensitive; ReferenceIndex upper-cases the keys once when it is
+          built.
+        - PAID_CLAIM_$ and ALLOWED keep their 64-bit values, as they are
+          saved and compared as they are.
+        - Compacting compacted data returns it as it is.
+    """
+    bytes_before = int(data.memory_usage(deep=True).sum())
+    columns_before = len(data.columns)
+    columns = [column for column in dict.fromkeys([*REFERENCE_COLUMNS, *keep_columns])
+               if column in data.columns]
+
+    compact = {}
+    for column in columns:
+        values = data[column]
+        if column in WATERFALL_DIMENSIONS or column in CATEGORY_COLUMNS:
+            values = values.astype('category')
+        elif column == 'SCA_FLAG':
+            if not pd.api.types.is_bool_dtype(values):
+                # Merged data may mix compacted flags with new text ones
+                values = values.map(normalize_key).map({'YES': True, 'NO': False,
+                                                        'TRUE': True, 'FALSE': False}).astype('boolean')
+        elif column in METRIC_COLUMNS:
+            values = pd.to_numeric(values, errors='coerce')
+            whole = values.notna().all() and (values % 1 == 0).all() \
+                and (values.abs() < 2 ** 31).all()
+            values = values.astype(np.int32 if whole else np.float32)
+        elif column == 'PAID_CLAIM_$':
+            values = pd.to_numeric(values, errors='coerce')
+        compact[column] = values
+
+    data = pd.DataFrame(compact, index=data.index)
+    report = {'rows': len(data),
+              'columns_before': columns_before,
+              'columns_after': len(columns),
+              'bytes_before': bytes_before,
+              'bytes_after': int(data.memory_usage(deep=True).sum())}
+    return data, report
+
+
+class ReferenceIndex:
+    """
+    Hash indexes over the EIV reference data, built once per snapshot, so
+    the waterfall lookups of a VOB are dict lookups instead of scans of the
+    whole frame.
+
+    Variables:
+        data (pd.DataFrame): The reference data the index was built from.
+        version (Hashable): snapshot_version of data.
+        keys (Dict[str, dict]): For every waterfall dimension, (upper case
+        key, upper case SCA_FLAG) -> position in its metric matrix of the
+        first row of data with them.
+        metrics (Dict[str, np.ndarray]): For every dimension, a float matrix
+        with one row per key and one column per metric family, plus a last
+        row of NaN for the keys not found.
+        columns (Dict[str, dict]): For every dimension, target column ->
+        column of its metric matrix.
+        allowed (Dict[str, frozenset]): Allowed categories of every column
+        in CATEGORY_COLUMNS.
+        key_codes (Dict[str, dict]): For every dimension, upper case key ->
+        integer code.
+        codes (Dict[str, np.ndarray]): For every dimension, the code of the
+        key of every row of data, -1 when it is missing.
+        subsets (Dict[tuple, dict]): For every combination of dimensions
+        searched by first_value (a mask over WATERFALL_DIMENSIONS), codes of
+        their keys -> position of the first row of data with them. Built
+        the first time the combination is searched.
+
+    The metrics and codes arrays can be saved with arrays and given back to
+    a new index of the same data, e.g. memory-mapped from the snapshot
+    shared by the processes of the container.
+
+    Interactions:
+        - Built by the AppContext, used by EIVService.verify_categories and
+          EIVService.load_data_to_dataframe.
+    """
+
+    def __init__(self, data: pd.DataFrame, version: Hashable = None,
+                 arrays: Dict[str, np.ndarray] = None):
+        """
+        Initializes the ReferenceIndex object.
+
+        Parameters:
+            data (pd.DataFrame): The reference data loaded from Snowflake.
+            version (Hashable): snapshot_version of data.
+            arrays (Dict[str, np.ndarray], optional): The arrays of an index
+            of the same data (see arrays), used instead of computing them.
+
+        Returns:
+            None
+
+        Process:
+            - Indexes the first row of every (key, SCA_FLAG) pair of every
+              dimension in WATERFALL_DIMENSIONS, as the original lookups
+              took the first match.
+            - Collects the allowed categories of CATEGORY_COLUMNS.
+        """
+        arrays = arrays or {}
+        try:
+            self.data = data
+            self.version = version
+            self.keys = {}
+            self.metrics = {}
+            self.columns = {}
+
+            if pd.api.types.is_bool_dtype(data['SCA_FLAG']):
+                # Compacted data, see compact_reference_data
+                sca_flags = data['SCA_FLAG'].map({True: 'YES', False: 'NO'})
+            else:
+                sca_flags = data['SCA_FLAG'].str.upper()
+            for dimension, prefix in WATERFALL_DIMENSIONS.items():
+                columns = waterfall_columns(prefix)
+                sources = list(dict.fromkeys(columns.values()))
+
+                lookup = pd.DataFrame({'_KEY': data[dimension].str.upper(), '_SCA': sca_flags})
+                lookup = lookup.dropna().drop_duplicates()
+
+                matrix = arrays.get(f'metrics-{dimension}')
+                if matrix is None:
+                    values = data.loc[lookup.index, sources].apply(pd.to_numeric, errors='coerce')
+                    matrix = np.full((len(lookup) + 1, len(sources)), np.nan)
+                    matrix[:-1] = values.to_numpy(dtype=np.float64)
+
+                self.keys[dimension] = dict(zip(zip(lookup['_KEY'], lookup['_SCA']), range(len(lookup))))
+                self.metrics[dimension] = matrix
+                # Matrix column of every target column
+                self.columns[dimension] = {target: sources.index(source)
+                                           for target, source in columns.items()}
+
+            self.allowed = {column: frozenset(data[column].unique())
+                            for column in CATEGORY_COLUMNS if column in data.columns}
+
+            self.key_codes = {}
+            self.codes = {}
+            self.subsets = {}
+            for dimension in WATERFALL_DIMENSIONS:
+                codes = arrays.get(f'codes-{dimension}')
+                if codes is None:
+                    codes, uniques = pd.factorize(data[dimension].str.upper())
+                    codes = codes.astype(np.int32)
+                else:
+                    # Same order as the uniques of factorize
+                    uniques = pd.unique(data[dimension].str.upper().dropna())
+                self.codes[dimension] = codes
+                self.key_codes[dimension] = dict(zip(uniques, range(len(uniques))))
+        except KeyError as e:
+            raise KeyError(f"Column not found in the reference data: {e}")
+        except Exception as e:
+            raise Exception(f"Error building the reference index: {str(e)}")
+
+    def lookup(self, dimension: str, targets: pd.Series,
+               sca_flags: pd.Series) -> pd.DataFrame:
+        """
+        Return the metric columns of the first reference row of every target.
+
+        Parameters:
+            dimension (str): A key of WATERFALL_DIMENSIONS, e.g. 'SUBSCRIBER'.
+            targets (pd.Series): Values to search, one per client.
+            sca_flags (pd.Series): SCA_FLAG of every client.
+
+        Returns:
+            pd.DataFrame: One row per target (same index) with the metric
+            columns of the dimension, NaN when there is no match.
+        """
+        keys = self.keys[dimension]
+        missing = len(self.metrics[dimension]) - 1
+        positions = [keys.get((key, sca), missing) for key, sca in
+                     zip(targets.map(normalize_key), sca_flags.map(normalize_key))]
+
+        rows = self.metrics[dimension][positions]
+        return pd.DataFrame({target: rows[:, column]
+                             for target, column in self.columns[dimension].items()},
+                            index=targets.index)
+
+    def first_value(self, keys: tuple, value_column: str):
+        """
+        Return a column of the first reference row matching every key given.
+
+        Parameters:
+            keys (tuple): One key per dimension of WATERFALL_DIMENSIONS, in
+            its order; None for the dimensions not searched. Keys are
+            compared case insensitive.
+            value_column (str): Column of the reference data to return,
+            e.g. 'PAID_CLAIM_$'.
+
+        Returns:
+            The value of value_column, or None if no row matches or every
+            key is None.
+        """
+        mask = tuple(key is not None for key in keys)
+        if not any(mask):
+            return None
+
+        codes = []
+        for dimension, key in zip(WATERFALL_DIMENSIONS, keys):
+            if key is not None:
+                code = self.key_codes[dimension].get(str(key).upper())
+                if code is None:
+                    return None
+                codes.append(code)
+
+        subset = self.subsets.get(mask)
+        if subset is None:
+            subset = self.build_subset(mask)
+            self.subsets[mask] = subset
+
+        position = subset.get(tuple(codes))
+        if position is None:
+            return None
+        return self.data[value_column].iat[position]
+
+    def build_subset(self, mask: tuple) -> dict:
+        """
+        Index the first row of every combination of keys of the dimensions
+        in mask (see subsets).
+        """
+        matrix = np.column_stack([self.codes[dimension] for dimension, used
+                                  in zip(WATERFALL_DIMENSIONS, mask) if used])
+        positions = np.flatnonzero((matrix >= 0).all(axis=1))
+        matrix = matrix[positions]
+
+        first = ~pd.DataFrame(matrix).duplicated().to_numpy()
+        return dict(zip(map(tuple, matrix[first].tolist()), positions[first].tolist()))
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """
+        Return the metric matrices and key codes of every dimension, by
+        'metrics-<dimension>' and 'codes-<dimension>'.
+        """
+        arrays = {f'metrics-{dimension}': matrix for dimension, matrix in self.metrics.items()}
+        arrays.update({f'codes-{dimension}': codes for dimension, codes in self.codes.items()})
+        return arrays
+
+    def allowed_categories(self, column_name: str) -> frozenset:
+        """
+        Return the allowed categories of a column of CATEGORY_COLUMNS.
+        """
+        return self.allowed[column_name]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return the number of keys indexed for every dimension, and the
+        number of combinations of dimensions indexed by first_value.
+        """
+        stats = {dimension: len(keys) for dimension, keys in self.keys.items()}
+        stats['subsets'] = len(self.subsets)
+        return stats
@@ -0,0 +1,101 @@
+import threading
+import time
+from typing import Callable
+
+
+class ReferenceRefresher:
+    """
+    Background thread that refreshes the reference data every interval
+    seconds, so requests never pay for a reload.
+
+    Variables:
+        refresh (Callable[[], object]): Function that loads the reference
+        data and publishes it, e.g. AppContext.refresh_reference.
+        interval (float): Seconds between refreshes.
+
+    Interactions:
+        - Started by AppContext.start_reference_refresher. The refresh
+          function swaps the new ReferenceIndex in once it is fully built,
+          so readers keep using the previous one until then.
+    """
+
+    def __init__(self, refresh: Callable[[], object], interval: float = 300.0):
+        """
+        Initializes the ReferenceRefresher object.
+
+        Parameters:
+            refresh (Callable[[], object]): Function called on every refresh.
+            interval (float): Seconds between refreshes.
+
+        Returns:
+            None
+        """
+        if interval <= 0:
+            raise ValueError("interval should be positive")
+
+        self.refresh = refresh
+        self.interval = interval
+        self.refreshes = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_duration = None
+        self.last_refresh_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start the thread, if it isn't running.
+        """
+        if self.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='eiv-reference-refresher',
+                                        daemon=True)
+        self._thread.start()
+
+    def run(self):
+        """
+        Call refresh every interval seconds until stop is called. Errors are
+        kept in last_error and the refresh is tried again on the next round.
+        """
+        while not self._stop.wait(self.interval):
+            started_at = time.monotonic()
+            try:
+                self.refresh()
+                self.refreshes += 1
+                self.last_error = None
+            except Exception as e:
+                self.failures += 1
+                self.last_error = f"Error refreshing the reference data: {str(e)}"
+            self.last_duration = time.monotonic() - started_at
+            self.last_refresh_at = time.time()
+
+    def stop(self, timeout: float = None):
+        """
+        Stop the thread, waiting up to timeout seconds for a refresh in
+        progress.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def is_alive(self) -> bool:
+        """
+        Tell whether the thread is running.
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    def stats(self) -> dict:
+        """
+        Return the refreshes, failures, last error, duration of the last
+        refresh (seconds) and its time (epoch seconds).
+        """
+        return {'running': self.is_alive(),
+                'interval': self.interval,
+                'refreshes': self.refreshes,
+                'failures': self.failures,
+                'last_error': self.last_error,
+                'last_duration': self.last_duration,
+                'last_refresh_at': self.last_refresh_at}
@@ -0,0 +1,430 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Iterator, Tuple
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from services.reference_index import compact_reference_data
+
+# Pointer to the current snapshot; it is replaced atomically on every refresh
+MANIFEST_FILE = 'eiv_reference.json'
+
+# Held by the process refreshing the snapshot
+LOCK_FILE = 'eiv_reference.lock'
+
+DATA_PREFIX = 'eiv_reference-'
+INDEX_PREFIX = 'eiv_index-'
+
+
+class ReferenceSnapshot:
+    """
+    Local, versioned copy of the cleaned EIV reference data, shared by every
+    process of the container or host until it expires, and refreshed with
+    the rows changed in Snowflake instead of the whole table when possible.
+
+    Every version is an uncompressed Arrow IPC file (plus the lookup arrays
+    of its ReferenceIndex as .npy files) that processes memory-map read
+    only, so the pages are shared through the page cache instead of copied
+    into every process. Only one process at a time refreshes it (the one
+    holding LOCK_FILE); the others keep using the current version meanwhile.
+
+    Variables:
+        directory (str): Folder of the snapshot files.
+        ttl (float): Seconds a snapshot is reused before Snowflake is checked
+        for changes.
+        table (str): Table read by 'eiv_sql.sql', DATABASE.SCHEMA.TABLE,
+        probed for changes; None to always reload the whole table.
+        watermark_column (str): Last modified column of the table; None when
+        it has none, and the whole table is loaded when it changes.
+        full_refresh_interval (float): Seconds between full loads, which also
+        drop the rows deleted from the table.
+
+    Interactions:
+        - Used by the AppContext in front of the reference data methods of
+          EIVService.
+    """
+
+    def __init__(self, directory: str = '/tmp/eiv_reference', ttl: float = 3600.0,
+                 table: str = None, watermark_column: str = None,
+                 full_refresh_interval: float = 86400.0):
+        """
+        Initializes the ReferenceSnapshot object.
+
+        Parameters:
+            directory (str): Folder of the snapshot files, created if needed.
+            ttl (float): Seconds a snapshot is reused.
+            table (str): Table probed for changes.
+            watermark_column (str): Last modified column of the table.
+            full_refresh_interval (float): Seconds between full loads.
+
+        Returns:
+            None
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.table = table
+        self.watermark_column = watermark_column
+        self.full_refresh_interval = full_refresh_interval
+        self.last_write_error = None
+        self.last_refresh_error = None
+
+    def load(self, source, current_version: str = None,
+             current_data: pd.DataFrame = None) -> Tuple[pd.DataFrame, dict]:
+        """
+        Return the reference data and the manifest of its snapshot.
+
+        Parameters:
+            source (EIVService): Service that loads the data from Snowflake.
+            current_version (str, optional): Version of the data the caller
+            already has in memory.
+            current_data (pd.DataFrame, optional): That data, reused instead
+            of reading the snapshot file when the versions match.
+
+        Returns:
+            pd.DataFrame: The reference data.
+            dict: 'version', 'created_at' (epoch seconds), 'rows', 'file',
+            'probe' (see EIVService.probe_reference_data), 'watermark',
+            'full_loaded_at', 'refresh' ('full', 'delta' or 'renewed'),
+            'changed_rows' and 'memory' (see compact_reference_data) of the
+            snapshot.
+
+        Process:
+            - Reads the current snapshot when it is younger than ttl.
+            - When it expired, probes the table: if the probe didn't change
+              the snapshot is renewed as it is, with the same version.
+            - If it changed, loads only the rows past the watermark and
+              merges them into the snapshot, unless there is no watermark or
+              the last full load is older than full_refresh_interval.
+            - Otherwise, or if the refresh fails, loads the whole table.
+            - Loaded or merged data is compacted with compact_reference_data
+              before it is saved.
+            - If the new snapshot can't be written the data is still
+              returned, with its version, and the error is kept in
+              last_write_error.
+        """
+        manifest = self.read_manifest()
+        if manifest is not None and time.time() - manifest['created_at'] < self.ttl:
+            data = self.read(manifest, current_version, current_data)
+            if data is not None:
+                return data, manifest
+
+        with self.leader_lock(blocking=False) as leader:
+            if leader:
+                return self.load_as_leader(source, current_version, current_data)
+
+        # Another process is refreshing, keep using the current version
+        if manifest is not None:
+            data = self.read(manifest, current_version, current_data)
+            if data is not None:
+                return data, manifest
+
+        with self.leader_lock(blocking=True):
+            return self.load_as_leader(source, current_version, current_data)
+
+    def load_as_leader(self, source, current_version: str = None,
+                       current_data: pd.DataFrame = None) -> Tuple[pd.DataFrame, dict]:
+        """
+        Refresh the snapshot (see load), holding the leader lock.
+        """
+        # It may have been refreshed while the lock was taken
+        manifest = self.read_manifest()
+        if manifest is not None and time.time() - manifest['created_at'] < self.ttl:
+            data = self.read(manifest, current_version, current_data)
+            if data is not None:
+                return data, manifest
+
+        if manifest is not None and self.table is not None:
+            try:
+                refreshed = self.refresh(source, manifest, current_version, current_data)
+                self.last_refresh_error = None
+                if refreshed is not None:
+                    return refreshed
+            except Exception as e:
+                self.last_refresh_error = f"Error refreshing the reference snapshot: {str(e)}"
+
+        # Probe before loading, so changes made during the load are seen
+        # by the next probe
+        probe = self.probe(source)
+        data, memory = compact_reference_data(source.load_data_from_snowflake(),
+                                              self.keep_columns())
+        manifest = self.make_manifest(data, probe=probe, refresh='full',
+                                      watermark=self.max_watermark(data),
+                                      changed_rows=len(data), memory=memory)
+        self.save(data, manifest)
+        return data, manifest
+
+    def refresh(self, source, manifest: dict, current_version: str = None,
+                current_data: pd.DataFrame = None) -> Tuple[pd.DataFrame, dict]:
+        """
+        Refresh an expired snapshot with the changes of the table.
+
+        Returns:
+            Tuple[pd.DataFrame, dict]: The data and manifest, or None when
+            the whole table has to be loaded.
+        """
+        data = self.read(manifest, current_version, current_data)
+        if data is None:
+            return None
+
+        probe = source.probe_reference_data(self.table)
+        if probe == manifest.get('probe'):
+            manifest = dict(manifest, created_at=time.time(), refresh='renewed', changed_rows=0)
+            self.save(None, manifest)
+            return data, manifest
+
+        if self.watermark_column is None or manifest.get('watermark') is None \
+                or time.time() - manifest.get('full_loaded_at', 0) >= self.full_refresh_interval:
+            return None
+
+        changes = source.load_reference_changes(self.watermark_column, manifest['watermark'])
+        data, memory = compact_reference_data(source.merge_reference_changes(data, changes),
+                                              self.keep_columns())
+        manifest = self.make_manifest(data, probe=probe, refresh='delta',
+                                      watermark=self.max_watermark(changes) or manifest['watermark'],
+                                      changed_rows=len(changes), memory=memory,
+                                      full_loaded_at=manifest['full_loaded_at'])
+        self.save(data, manifest)
+        return data, manifest
+
+    def probe(self, source) -> dict:
+        """
+        Return the probe of the table, or None if there is no table or it
+        can't be probed.
+        """
+        if self.table is None:
+            return None
+        try:
+            return source.probe_reference_data(self.table)
+        except Exception:
+            return None
+
+    def keep_columns(self) -> list:
+        """
+        Return the columns kept by compact_reference_data besides the ones
+        the pipeline reads.
+        """
+        return [self.watermark_column] if self.watermark_column else []
+
+    def max_watermark(self, data: pd.DataFrame) -> str:
+        """
+        Return the greatest value of the watermark column in data, as text,
+        or None if there is none.
+        """
+        if self.watermark_column is None or self.watermark_column not in data.columns:
+            return None
+        watermark = data[self.watermark_column].max()
+        return None if pd.isna(watermark) else str(watermark)
+
+    def read(self, manifest: dict, current_version: str = None,
+             current_data: pd.DataFrame = None) -> pd.DataFrame:
+        """
+        Return the data of the snapshot of manifest, or None if its file
+        can't be read.
+        """
+        if current_data is not None and current_version == manifest['version']:
+            return current_data
+        path = os.path.join(self.directory, manifest['file'])
+        try:
+            if path.endswith('.parquet'):
+                # Snapshots written before the Arrow files
+                return pd.read_parquet(path)
+
+            # Numeric columns are views of the mapped file, not copies
+            table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+            return table.to_pandas(split_blocks=True)
+        except (OSError, ValueError, pa.ArrowInvalid):
+            # Removed or half written by another process, load it again
+            return None
+
+    def read_index(self, manifest: dict) -> Dict[str, np.ndarray]:
+        """
+        Return the lookup arrays of the ReferenceIndex of the snapshot of
+        manifest, memory-mapped read only, or None if they weren't written.
+        """
+        path = os.path.join(self.directory, INDEX_PREFIX + manifest['version'])
+        try:
+            return {file_name[:-len('.npy')]: np.load(os.path.join(path, file_name), mmap_mode='r')
+                    for file_name in os.listdir(path) if file_name.endswith('.npy')}
+        except (OSError, ValueError):
+            return None
+
+    def write_index(self, manifest: dict, arrays: Dict[str, np.ndarray]):
+        """
+        Write the lookup arrays of the ReferenceIndex of the snapshot of
+        manifest, so the other processes map them instead of building them.
+        Errors are kept in last_write_error.
+        """
+        path = os.path.join(self.directory, INDEX_PREFIX + manifest['version'])
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(temporary_path, exist_ok=True)
+            for name, array in arrays.items():
+                np.save(os.path.join(temporary_path, name + '.npy'), array)
+            # Fails if another process wrote them first, which is as good
+            os.rename(temporary_path, path)
+        except OSError as e:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            if not os.path.isdir(path):
+                self.last_write_error = f"Error writing the reference index: {str(e)}"
+
+    @contextmanager
+    def leader_lock(self, blocking: bool = True) -> Iterator[bool]:
+        """
+        Take LOCK_FILE, so only one process (or thread) refreshes the
+        snapshot at a time.
+
+        Parameters:
+            blocking (bool): Wait for the lock if another process holds it.
+
+        Returns:
+            Iterator[bool]: True while the lock is held, False if it is held
+            by another process and blocking is False. If the folder can't be
+            used the lock is not taken and True is returned, as there is
+            nothing to share.
+        """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            file = open(os.path.join(self.directory, LOCK_FILE), 'a')
+        except OSError:
+            yield True
+            return
+
+        try:
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+        finally:
+            file.close()
+
+    def save(self, data: pd.DataFrame, manifest: dict):
+        """
+        Write the snapshot (see write), keeping the error, if any, in
+        last_write_error.
+        """
+        try:
+            self.write(data, manifest)
+            self.last_write_error = None
+        except Exception as e:
+            self.last_write_error = f"Error writing the reference snapshot: {str(e)}"
+
+    def read_manifest(self) -> dict:
+        """
+        Return the manifest of the current snapshot, or None if there is none.
+        """
+        try:
+            with open(os.path.join(self.directory, MANIFEST_FILE), 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def make_manifest(self, data: pd.DataFrame, probe: dict = None,
+                      refresh: str = 'full', watermark: str = None,
+                      changed_rows: int = 0, full_loaded_at: float = None,
+                      memory: dict = None) -> dict:
+        """
+        Build the manifest of a new snapshot of data.
+
+        Returns:
+            dict: The version is the UTC creation time plus a digest of the
+            content, e.g. '20240101T120000Z-3f2a9c1b'.
+        """
+        created_at = time.time()
+        digest = hashlib.sha1(pd.util.hash_pandas_object(data, index=False).to_numpy().tobytes()).hexdigest()
+        version = datetime.fromtimestamp(created_at, timezone.utc).strftime('%Y%m%dT%H%M%SZ') + '-' + digest[:8]
+        return {'version': version,
+                'created_at': created_at,
+                'rows': len(data),
+                'file': f'{DATA_PREFIX}{version}.arrow',
+                'probe': probe,
+                'watermark': watermark,
+                'full_loaded_at': created_at if full_loaded_at is None else full_loaded_at,
+                'refresh': refresh,
+                'changed_rows': changed_rows,
+                'memory': memory}
+
+    def write(self, data: pd.DataFrame, manifest: dict):
+        """
+        Write data as the snapshot of manifest and make it the current one.
+
+        Process:
+            - Writes the uncompressed Arrow IPC file and then the manifest,
+              each to a temporary file renamed into place, so readers never
+              see a partial file. With data None only the manifest is
+              written, for a snapshot renewed as it is.
+            - Removes the files of the versions older than the previous
+              one; processes still using the previous version can keep
+              reading it until they refresh, and mapped files stay valid
+              after they are removed.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, manifest['file'])
+
+        if data is not None:
+            table = to_arrow_table(data)
+            with pa.OSFile(path + '.tmp', 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(path + '.tmp', path)
+
+        manifest_path = os.path.join(self.directory, MANIFEST_FILE)
+        with open(manifest_path + '.tmp', 'w') as file:
+            json.dump(manifest, file)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+        self.remove_old_versions(manifest['version'])
+
+    def remove_old_versions(self, version: str):
+        """
+        Remove the data and index files of every version but version and
+        the newest one before it.
+        """
+        files = {}
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith('.tmp'):
+                continue
+            if file_name.startswith(DATA_PREFIX):
+                files.setdefault(file_name[len(DATA_PREFIX):].rsplit('.', 1)[0], []).append(file_name)
+            elif file_name.startswith(INDEX_PREFIX):
+                files.setdefault(file_name[len(INDEX_PREFIX):], []).append(file_name)
+
+        # Versions start with their UTC creation time, so they sort by age
+        previous = sorted(other for other in files if other < version)[-1:]
+        for other, file_names in files.items():
+            if other == version or other in previous:
+                continue
+            for file_name in file_names:
+                path = os.path.join(self.directory, file_name)
+                try:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+
+def to_arrow_table(data: pd.DataFrame) -> pa.Table:
+    """
+    Convert data to a pyarrow Table that converts back to pandas without
+    copies.
+
+    Returns:
+        pa.Table: The table, with the NaN of the float columns kept as
+        values instead of nulls, as pandas can only use the Arrow buffers of
+        numeric columns without nulls as they are.
+    """
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    for position, field in enumerate(table.schema):
+        if pa.types.is_floating(field.type):
+            table = table.set_column(position, field,
+                                     pa.array(data[field.name].to_numpy(), type=field.type, from_pandas=False))
+    return table
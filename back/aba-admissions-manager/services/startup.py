@@ -0,0 +1,112 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable
+
+
+class StartupInitializer:
+    """
+    Run the independent steps of a cold start (reading the config,
+    unpickling the models, logging in to the databases, loading the
+    reference data) at the same time on a thread pool, each one as soon as
+    the steps it requires are done.
+
+    Variables:
+        max_workers (int): Steps run at the same time.
+        steps (Dict[str, tuple]): Step name -> (function, names of the steps
+        it requires), in the order added.
+
+    Interactions:
+        - Built by AppContext.warm_up, run by the Lambda handler module when
+          the container starts and by the ECS server on startup.
+    """
+
+    def __init__(self, max_workers: int = 8):
+        """
+        Initializes the StartupInitializer object.
+
+        Parameters:
+            max_workers (int): Steps run at the same time.
+
+        Returns:
+            None
+        """
+        if max_workers < 1:
+            raise ValueError("max_workers should be positive")
+
+        self.max_workers = max_workers
+        self.steps = {}
+
+    def add(self, name: str, function: Callable[[], object], requires: Iterable[str] = ()):
+        """
+        Add a step, run after every step in requires succeeded.
+        """
+        self.steps[name] = (function, tuple(requires))
+
+    def run(self, timeout: float = None) -> Dict[str, dict]:
+        """
+        Run every step.
+
+        Parameters:
+            timeout (float, optional): Seconds to wait for the steps; the
+            ones still running go on in the background.
+
+        Returns:
+            Dict[str, dict]: For every step, its 'status' ('done', 'failed',
+            'skipped' when a step it requires failed or doesn't exist, or
+            'running' when timeout passed first), 'start' (seconds since the
+            run started), 'seconds' it took and 'error'. The item 'total'
+            has the 'seconds' of the whole run.
+        """
+        started_at = time.monotonic()
+        report = {name: {'status': 'pending', 'start': None, 'seconds': None, 'error': None}
+                  for name in self.steps}
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='eiv-startup')
+        running = {}
+        try:
+            while True:
+                for name, (function, requires) in self.steps.items():
+                    if report[name]['status'] != 'pending':
+                        continue
+                    statuses = [report[required]['status'] if required in report else 'missing'
+                                for required in requires]
+                    if any(status not in ('pending', 'running', 'done') for status in statuses):
+                        report[name]['status'] = 'skipped'
+                        report[name]['error'] = "Required step not done: " + ', '.join(
+                            required for required, status in zip(requires, statuses) if status != 'done')
+                    elif all(status == 'done' for status in statuses):
+                        report[name]['status'] = 'running'
+                        report[name]['start'] = time.monotonic() - started_at
+                        running[executor.submit(self._run_step, function)] = name
+
+                if not running:
+                    break
+
+                remaining = None if timeout is None else timeout - (time.monotonic() - started_at)
+                if remaining is not None and remaining <= 0:
+                    break
+                finished, _ = wait(running, remaining, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    seconds, error = future.result()
+                    report[name]['seconds'] = seconds
+                    report[name]['status'] = 'failed' if error else 'done'
+                    report[name]['error'] = error
+        finally:
+            executor.shutdown(wait=False)
+
+        # Steps waiting for ones still running, or for each other
+        for step in report.values():
+            if step['status'] == 'pending':
+                step['status'] = 'skipped'
+                step['error'] = "Required steps not done"
+        report['total'] = {'seconds': time.monotonic() - started_at}
+        return report
+
+    @staticmethod
+    def _run_step(function: Callable[[], object]):
+        started_at = time.monotonic()
+        try:
+            function()
+            return time.monotonic() - started_at, None
+        except Exception as e:
+            return time.monotonic() - started_at, str(e)
@@ -0,0 +1,267 @@
+from typing import Dict, List, Tuple
+import pandas as pd
+import re
+
+
+# Fields of a VOB and the rule used to check each one, in the order they are
+# reported. Rules:
+#   id        str or None
+#   name      name and lastname of a person (see NAME_PATTERN)
+#   bool      bool, None is False
+#   multiplan bool, None is False
+#   funding   'Self funded' or 'Fully Funded', None is 'Self funded'
+#   percent   number in [0, 100] or None
+#   quantity  number >= 0 or None, converted to float
+#   text      any value, not checked
+VOB_SCHEMA = {
+    "ClientTrackingID": "id",
+    "ClientName": "name",
+    "VOBID": "id",
+    "SCA": "bool",
+    "OONBenefits": "bool",
+    "Subscriber": "name",
+    "Payor": "text",
+    "GroupID": "id",
+    "PolicyID": "id",
+    "FundingType": "funding",
+    "PolicyType": "text",
+    "Copay": "percent",
+    "CoinsuranceOON": "percent",
+    "Deductible": "quantity",
+    "OutOfBucket": "quantity",
+    "State": "text",
+    "Multiplan": "multiplan"
+}
+
+FUNDING_TYPES = {"Self funded", "Fully Funded"}
+
+# Regular expressions used to validate the names of the users, compiled once
+# Pattern to match names and surnames, of letters of any alphabet (e.g. 'José')
+NAME_PATTERN = re.compile(r'^(?:[^\W\d_]|[\'\-])+(?:[, ]+(?:[^\W\d_]|[\'\-])+)*$')
+NAME_DIGIT_PATTERN = re.compile(r'\d')
+NAME_SEPARATOR_PATTERN = re.compile(r'[,\s]+')
+# More than three letters repeated
+NAME_REPEATED_PATTERN = re.compile(r'(\w)\1{3,}')
+
+_MISSING = object()
+_NONE_TYPE = type(None)
+_NUMERIC_TYPES = {int, float, bool}
+
+
+class VOBValidator:
+    """
+    Check a batch of VOBs column by column against a compiled schema.
+
+    Variables:
+        rules (List[Tuple[str, Callable]]): Field name and check function of
+        every field of the schema.
+
+    Interactions:
+        - Built by compile_schema, used by EIVController.
+    """
+
+    def __init__(self, rules: list):
+        """
+        Initializes the VOBValidator object.
+
+        Parameters:
+            rules (list): (field, check function) pairs from compile_schema.
+
+        Returns:
+            None
+        """
+        self.rules = rules
+
+    def validate(self, records: List[dict]) -> Tuple[pd.DataFrame, Dict[int, List[dict]]]:
+        """
+        Check every VOB of the batch without stopping at the first failure.
+
+        Parameters:
+            records (List[dict]): VOBs sent by the user.
+
+        Returns:
+            pd.DataFrame: The checked values of the valid VOBs, indexed by
+            their position in records.
+            Dict[int, List[dict]]: For every invalid VOB, one
+            {'field', 'type', 'error'} item per failed field; 'type' is
+            'missing' or 'invalid'.
+
+        Process:
+            - Builds one column per field and applies its check to the whole
+              column at once.
+        """
+        index = pd.RangeIndex(len(records))
+        invalid = pd.Series(False, index=index)
+        failures = {}
+        columns = {}
+
+        for field, check in self.rules:
+            column = pd.Series([record.get(field, _MISSING) for record in records],
+                               index=index, dtype=object)
+
+            missing = column.map(lambda value: value is _MISSING).astype(bool)
+            for row in missing[missing].index:
+                failures.setdefault(row, []).append(
+                    {'field': field, 'type': 'missing',
+                     'error': f"Column '{field}' not found in the input."})
+
+            column = column.where(~missing, None)
+            values, errors = check(field, column, column.map(type))
+            for row, message in errors.items():
+                if not missing[row]:
+                    failures.setdefault(row, []).append({'field': field, 'type': 'invalid', 'error': message})
+
+            columns[field] = values
+
+        invalid.loc[list(failures)] = True
+
+        df = pd.DataFrame(columns, index=index)[~invalid.to_numpy()].infer_objects()
+
+        return df, failures
+
+    def validate_one(self, record: dict) -> pd.DataFrame:
+        """
+        Check a single VOB, raising on its first failure.
+
+        Parameters:
+            record (dict): VOB sent by the user.
+
+        Returns:
+            pd.DataFrame: The checked values of the VOB in one row.
+
+        Raises:
+            KeyError: If a field is not found in the VOB.
+            ValueError: If a field doesn't have the expected type or value.
+        """
+        df, failures = self.validate([record])
+        if failures:
+            errors = failures[0]
+            missing = [error for error in errors if error['type'] == 'missing']
+            if missing:
+                raise KeyError(missing[0]['error'])
+            raise ValueError(errors[0]['error'])
+        return df
+
+
+def _errors(column: pd.Series, mask: pd.Series, message) -> Dict[int, str]:
+    # Message of every failed row; message may be a function of the value
+    if not mask.any():
+        return {}
+    if callable(message):
+        return {row: message(value) for row, value in column[mask].items()}
+    return {row: message for row in mask[mask].index}
+
+
+def _check_id(field, column, types):
+    valid = types.isin([_NONE_TYPE, str])
+    return column, _errors(column, ~valid,
+                           lambda value: f"'{field}' should be of type str, but it is of type {type(value).__name__}")
+
+
+def _check_name(field, column, types):
+    errors = {}
+    is_none = types == _NONE_TYPE
+    is_str = types == str
+    errors.update(_errors(column, is_none, "Provide a valid name and lastname"))
+    errors.update(_errors(column, ~is_none & ~is_str, "Invalid username"))
+
+    text = column.where(is_str, '')
+    has_digits = is_str & text.str.contains(NAME_DIGIT_PATTERN)
+    errors.update(_errors(column, has_digits, lambda value: f"Invalid username, contains numbers: {value}"))
+
+    stripped = text.str.strip()
+    pending = is_str & ~has_digits
+    one_part = pending & (stripped.str.count(NAME_SEPARATOR_PATTERN) < 1)
+    errors.update(_errors(column, one_part, "Provide user name and lastname"))
+
+    pending &= ~one_part
+    repeated = pending & stripped.map(lambda value: NAME_REPEATED_PATTERN.search(value) is not None)
+    errors.update(_errors(stripped, repeated, lambda value: "Invalid Name or Lastname: " + next(
+        part for part in NAME_SEPARATOR_PATTERN.split(value) if NAME_REPEATED_PATTERN.search(part))))
+
+    pending &= ~repeated
+    mismatch = pending & ~stripped.str.match(NAME_PATTERN).astype(bool)
+    errors.update(_errors(column, mismatch,
+                          "Invalid name. The name should contain only letters and not be empty."))
+
+    return stripped.where(is_str, None), errors
+
+
+def _check_bool(field, column, types):
+    valid = types.isin([_NONE_TYPE, bool])
+    return column.where(types != _NONE_TYPE, False), _errors(
+        column, ~valid, lambda value: f"'{field}' should be of type bool, but it is of type {type(value).__name__}")
+
+
+def _check_multiplan(field, column, types):
+    valid = types.isin([_NONE_TYPE, bool])
+    return column.where(types != _NONE_TYPE, False), _errors(
+        column, ~valid, lambda value: f"multiplan should be of type bool or None, but it is of type {type(value).__name__}")
+
+
+def _check_funding(field, column, types):
+    is_none = types == _NONE_TYPE
+    valid = is_none | ((types == str) & column.where(types == str, None).isin(FUNDING_TYPES))
+    return column.where(~is_none, "Self funded"), _errors(
+        column, ~valid, "Variable should be in categories 'Self funded' or 'Fully Funded'.")
+
+
+def _numbers(column, types):
+    is_number = types.isin(_NUMERIC_TYPES)
+    return is_number, pd.to_numeric(column.where(is_number, None), errors='coerce')
+
+
+def _check_percent(field, column, types):
+    is_number, numbers = _numbers(column, types)
+    in_range = (numbers >= 0) & (numbers <= 100)
+    errors = _errors(column, is_number & ~in_range, "Copay or CoinsuranceOON should be positive and [0, 100]")
+    errors.update(_errors(column, ~is_number & (types != _NONE_TYPE), "Copay or CoinsuranceOON should be a float"))
+    return column, errors
+
+
+def _check_quantity(field, column, types):
+    is_number, numbers = _numbers(column, types)
+    errors = _errors(column, is_number & ~(numbers >= 0), "Deductible or OutOfPocket should be positive")
+    errors.update(_errors(column, ~is_number & (types != _NONE_TYPE),
+                          lambda value: f"Deductible and OutOfPocket should be numeric or None, but it is of type {type(value).__name__}"))
+    return numbers.astype(object).where(is_number, None), errors
+
+
+def _check_text(field, column, types):
+    return column, {}
+
+
+_RULES = {
+    "id": _check_id,
+    "name": _check_name,
+    "bool": _check_bool,
+    "multiplan": _check_multiplan,
+    "funding": _check_funding,
+    "percent": _check_percent,
+    "quantity": _check_quantity,
+    "text": _check_text
+}
+
+
+def compile_schema(schema: Dict[str, str]) -> VOBValidator:
+    """
+    Compile a declarative schema into a VOBValidator.
+
+    Args:
+        schema (Dict[str, str]): {field: rule name}, see VOB_SCHEMA.
+
+    Returns:
+        VOBValidator: Validator with the check function of every field.
+
+    Raises:
+        ValueError: If a rule name is unknown.
+    """
+    rules = []
+    for field, rule in schema.items():
+        if rule not in _RULES:
+            raise ValueError(f"Unknown rule '{rule}' for field '{field}'")
+        rules.append((field, _RULES[rule]))
+    return VOBValidator(rules)
+
+
+VOB_VALIDATOR = compile_schema(VOB_SCHEMA)
@@ -0,0 +1,3 @@
+-- Version of the reference data snapshot every prediction was scored with.
+-- Run it before deploying the images that save it (see infra/README.md).
+ALTER TABLE eiv ADD COLUMN IF NOT EXISTS snapshot_version VARCHAR(64);
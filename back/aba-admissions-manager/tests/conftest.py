@@ -0,0 +1,119 @@
+import os
+import re
+import sqlite3
+import sys
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+from connectors.postgresql_connection import PostgreSQLConnection  # noqa: E402
+from connectors.snowflake_connection import SnowflakeConnection  # noqa: E402
+from services.eiv_services import EIVService  # noqa: E402
+from util.textfile_manager import TextfileManager  # noqa: E402
+
+# %(name)s placeholders of the queries, bound as :name by SQLite
+PARAMETER = re.compile(r'%\((\w+)\)s')
+
+# Column prefix of every dimension of the reference data
+DIMENSIONS = ['CLIENT', 'PREFIX', 'PAYOR', 'STATE', 'SUBS', 'GROUP', 'FUNDED']
+
+
+def make_reference_table(size: int = 200) -> pd.DataFrame:
+    """
+    Build reference rows with every column the pipeline reads.
+    """
+    rng = np.random.default_rng(0)
+    reference = pd.DataFrame({
+        'CLIENT_NAME': rng.choice(['John Smith', 'Jane Doe'], size),
+        'PREFIX': rng.choice(['ABC', 'XYZ'], size),
+        'PAYOR': rng.choice(['Aetna', 'Cigna'], size),
+        'STATE': rng.choice(['FL', 'NJ'], size),
+        'SUBSCRIBER': rng.choice(['JOHN SMITH', 'JANE DOE'], size),
+        'GROUP_NUMBER': rng.choice(['G1', 'G2'], size),
+        'FUNDED_STATUS': rng.choice(['Self funded', 'Fully Funded'], size),
+        'SCA_FLAG': rng.choice(['Yes', 'No'], size),
+        'POLICY_TYPE': rng.choice(['PPO', 'HMO'], size),
+        'REGION': rng.choice(['ABACOF', 'ABACONJ'], size),
+        'PAYOR_TYPE': rng.choice(['Commercial', 'Medicaid'], size),
+        'ALLOWED': rng.integers(0, 10 ** 6, size),
+        'PAID_CLAIM_$': rng.random(size).round(3)})
+    for prefix in DIMENSIONS:
+        for suffix in ['CLAIMS', 'CLAIMS_PY']:
+            reference[f'{prefix}_{suffix}'] = rng.integers(0, 12, size)
+        for suffix in ['$', '$_PY', 'BILL', 'BILL_PY']:
+            reference[f'{prefix}_{suffix}'] = rng.random(size).round(4)
+    return reference
+
+
+class SQLiteSnowflake(SnowflakeConnection):
+    """
+    SnowflakeConnection running the queries on an in-memory SQLite database
+    whose table 'reference' stands for the table of 'eiv_sql.sql'.
+
+    Variables:
+        queries (List[str]): Queries run, as sent by the repository.
+    """
+
+    def __init__(self, reference: pd.DataFrame):
+        super().__init__('account', 'user', 'password', 'database', 'schema', 'warehouse', 'role')
+        self.table = TextfileManager('sql/').load_textfile('eiv_sql.sql').split()[-1].rstrip(';')
+        self.database_connection = sqlite3.connect(':memory:', check_same_thread=False)
+        self.queries = []
+        self.set_reference(reference)
+
+    def set_reference(self, reference: pd.DataFrame):
+        reference.to_sql('reference', self.database_connection, index=False, if_exists='replace')
+
+    def execute_query(self, query: str, params: dict = None, as_arrow: bool = False):
+        self.queries.append(query)
+        query = PARAMETER.sub(r':\1', query.replace(self.table, 'reference'))
+        return pd.read_sql_query(query, self.database_connection, params=params or {})
+
+
+class RecordingPostgreSQL(PostgreSQLConnection):
+    """
+    PostgreSQLConnection keeping the statements and rows sent to
+    execute_batches instead of running them.
+
+    Variables:
+        calls (List[dict]): 'query', 'rows', 'batch_rows', 'before' and
+        'after' of every call.
+        release (threading.Event): Cleared to hold the calls, as a database
+        not answering.
+    """
+
+    def __init__(self):
+        super().__init__('host', '5432', 'database', 'user', 'password')
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def execute_batches(self, query, rows, batch_rows=1000, before=(), after=()):
+        self.release.wait()
+        rows = list(rows)
+        self.calls.append({'query': query, 'rows': rows, 'batch_rows': batch_rows,
+                           'before': list(before), 'after': list(after)})
+        return [{'batch': batch, 'rows': len(rows[start:start + batch_rows]), 'seconds': 0.0}
+                for batch, start in enumerate(range(0, len(rows), batch_rows))]
+
+
+@pytest.fixture(autouse=True)
+def app_dir(monkeypatch):
+    # The services read the SQL files relative to the application folder
+    monkeypatch.chdir(APP_DIR)
+
+
+@pytest.fixture
+def make_service():
+    """
+    Build an EIVService reading the given reference rows; returns the
+    service and its SQLiteSnowflake.
+    """
+    def make(reference: pd.DataFrame):
+        snowflake = SQLiteSnowflake(reference)
+        return EIVService([snowflake]), snowflake
+    return make
@@ -0,0 +1,83 @@
+import copy
+import json
+import os
+import time
+import pytest
+import main
+from app_context import AppContext
+from conftest import RecordingPostgreSQL, SQLiteSnowflake, make_reference_table
+
+
+def make_event(vob_id: str) -> dict:
+    body = {'ClientTrackingID': 'T1', 'ClientName': 'John Smith', 'VOBID': vob_id, 'SCA': True,
+            'OONBenefits': True, 'Subscriber': 'John Smith', 'Payor': 'Aetna', 'GroupID': 'G1',
+            'PolicyID': 'ABC123', 'FundingType': 'Self funded', 'PolicyType': 'PPO',
+            'Copay': 10.0, 'CoinsuranceOON': 20.0, 'Deductible': 1000.0, 'OutOfBucket': 2000.0,
+            'State': 'FL', 'Multiplan': False}
+    return {'body': json.dumps(body)}
+
+
+def wait_until(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def saved_vob_ids(rds: RecordingPostgreSQL) -> list:
+    # vob_id is the first column of the staged rows
+    return [row[0] for call in rds.calls for row in call['rows']]
+
+
+@pytest.fixture
+def lambda_context(tmp_path, monkeypatch):
+    """
+    AppContext of the Lambda handler reading the reference data from
+    SQLite and saving the predictions into a RecordingPostgreSQL; returns
+    the context, its RecordingPostgreSQL and the spill folder.
+    """
+    context = AppContext()
+    config = copy.deepcopy(context.get_config())
+    config['reference']['snapshot_dir'] = str(tmp_path / 'reference')
+    config['query_cache']['directory'] = None
+    config['prediction_writer'].update(spill_dir=str(tmp_path / 'spill'), lambda_flush_timeout=0.5)
+    context._config = config
+
+    rds = RecordingPostgreSQL()
+    context._connectors = [rds, SQLiteSnowflake(make_reference_table())]
+    monkeypatch.setattr(main, 'get_app_context', lambda: context)
+    yield context, rds, str(tmp_path / 'spill')
+    rds.release.set()
+    context.reset()
+
+
+def test_handler_saves_the_predictions_before_it_returns(lambda_context):
+    context, rds, spill_dir = lambda_context
+
+    response = main.lambda_handler(make_event('V1'), None)
+
+    assert json.loads(response)['statusCode'] == 200
+    assert saved_vob_ids(rds) == ['V1']
+    # Timings of the batches, as returned by the repository
+    assert context.get_prediction_writer().stats()['last_write_batches'] == [
+        {'batch': 0, 'rows': 1, 'seconds': 0.0}]
+    assert not os.path.exists(spill_dir) or os.listdir(spill_dir) == []
+
+
+def test_handler_spills_the_predictions_rds_doesnt_save_in_time(lambda_context):
+    context, rds, spill_dir = lambda_context
+    rds.release.clear()
+
+    # The first batch is being written when the handler gives up on it
+    main.lambda_handler(make_event('V1'), None)
+    assert context.get_prediction_writer().stats()['saved_rows'] == 0
+    # The next one is still pending then, and spilled
+    main.lambda_handler(make_event('V2'), None)
+    assert len(os.listdir(spill_dir)) == 1
+
+    # Both are saved once RDS answers, e.g. after the container is thawed
+    rds.release.set()
+    assert wait_until(lambda: sorted(saved_vob_ids(rds)) == ['V1', 'V2'])
+    assert wait_until(lambda: os.listdir(spill_dir) == [])
@@ -0,0 +1,211 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+import pandas as pd
+import pytest
+from services.prediction_writer import PredictionWriter
+
+
+class FlakySave:
+    """
+    Save function failing its first `failures` calls (all of them with
+    None), recording the rows it saved and the spill files seen meanwhile.
+    """
+
+    def __init__(self, spill_dir, failures=0):
+        self.spill_dir = spill_dir
+        self.failures = failures
+        self.calls = 0
+        self.saved = []
+        self.files_seen = []
+
+    def __call__(self, data, table_name):
+        self.calls += 1
+        self.files_seen.append(sorted(os.listdir(self.spill_dir)) if os.path.isdir(self.spill_dir) else [])
+        if self.failures is None or self.calls <= self.failures:
+            raise Exception('RDS is down')
+        self.saved.append((table_name, data))
+
+
+class RecordingEvent(threading.Event):
+    """
+    Stop event returning at once from the backoff waits, recording them.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.waits = []
+
+    def wait(self, timeout=None):
+        if timeout is None:
+            return super().wait()
+        self.waits.append(timeout)
+        return self.is_set()
+
+
+def predictions(count: int, start: int = 0) -> pd.DataFrame:
+    return pd.DataFrame({'VOB_ID': [f'V{i}' for i in range(start, start + count)],
+                         'SCA_EIV_percentage': [0.5] * count})
+
+
+def wait_until(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def start_idle(writer: PredictionWriter):
+    # Start the thread and let it find nothing to replay, so it doesn't
+    # replay the files spilled by the test on its own
+    writer.start()
+    time.sleep(0.2)
+
+
+def spilled_files(spill_dir) -> list:
+    return sorted(os.listdir(spill_dir)) if os.path.isdir(spill_dir) else []
+
+
+@pytest.fixture
+def make_writer(tmp_path):
+    writers = []
+
+    def make(save, **options):
+        options.setdefault('flush_interval', 0.05)
+        options.setdefault('backoff', 0.01)
+        writer = PredictionWriter(save, spill_dir=str(tmp_path / 'spill'), **options)
+        writers.append(writer)
+        return writer
+
+    yield make
+    for writer in writers:
+        writer.close(1)
+
+
+def test_failed_writes_are_retried_with_exponential_backoff(make_writer, tmp_path):
+    save = FlakySave(str(tmp_path / 'spill'), failures=3)
+    writer = make_writer(save, max_retries=4, backoff=1.0, max_backoff=3.0)
+    writer._stop = RecordingEvent()
+
+    writer.submit(predictions(3), 'eiv')
+
+    assert writer.flush(5)
+    assert writer._stop.waits == [1.0, 2.0, 3.0]
+    stats = writer.stats()
+    assert (stats['failures'], stats['retries'], stats['saved_rows'], stats['spilled_rows']) == (3, 3, 3, 0)
+    assert len(save.saved) == 1
+
+
+def test_rows_are_spilled_after_the_last_retry(make_writer, tmp_path):
+    spill_dir = str(tmp_path / 'spill')
+    writer = make_writer(FlakySave(spill_dir, failures=None), max_retries=2)
+
+    writer.submit(predictions(4), 'eiv')
+
+    assert writer.flush(5)
+    files = spilled_files(spill_dir)
+    assert len(files) == 1
+    table_name, created_at, pid = files[0][:-len('.parquet')].rsplit('-', 2)
+    assert (table_name, pid) == ('eiv', str(os.getpid()))
+    pd.testing.assert_frame_equal(pd.read_parquet(os.path.join(spill_dir, files[0])), predictions(4))
+    stats = writer.stats()
+    assert (stats['failures'], stats['retries'], stats['spilled_rows'], stats['lost_rows']) == (3, 2, 4, 0)
+
+
+def test_rows_beyond_max_pending_rows_are_spilled(make_writer, tmp_path):
+    spill_dir = str(tmp_path / 'spill')
+    writer = make_writer(FlakySave(spill_dir), max_pending_rows=5, flush_interval=60)
+    start_idle(writer)
+
+    writer.submit(predictions(4), 'eiv')
+    writer.submit(predictions(2, start=4), 'eiv')
+
+    assert writer.stats()['pending_rows'] == 4
+    assert writer.stats()['spilled_rows'] == 2
+    assert len(spilled_files(spill_dir)) == 1
+
+
+def test_spilled_rows_are_replayed_after_a_write_succeeds(make_writer, tmp_path):
+    spill_dir = str(tmp_path / 'spill')
+    save = FlakySave(spill_dir, failures=1)
+    writer = make_writer(save, max_retries=0)
+
+    writer.submit(predictions(2), 'eiv')
+    assert writer.flush(5)
+    assert len(spilled_files(spill_dir)) == 1
+
+    writer.submit(predictions(3, start=2), 'eiv')
+    assert writer.flush(5)
+    assert wait_until(lambda: writer.stats()['replayed_rows'] == 2)
+
+    assert spilled_files(spill_dir) == []
+    saved = pd.concat([data for _, data in save.saved], ignore_index=True)
+    assert sorted(saved['VOB_ID']) == [f'V{i}' for i in range(5)]
+    assert writer.stats()['saved_rows'] == 5
+
+
+def test_replay_claims_a_file_and_gives_it_back_when_it_fails(make_writer, tmp_path):
+    spill_dir = str(tmp_path / 'spill')
+    save = FlakySave(spill_dir, failures=None)
+    writer = make_writer(save, max_retries=0)
+    writer._spill(predictions(2), 'eiv')
+    file_name = spilled_files(spill_dir)[0]
+
+    writer._replay_spilled()
+
+    # Renamed while written, so no other process writes it too
+    assert save.files_seen[-1] == [f'{file_name}.{os.getpid()}.replay']
+    assert spilled_files(spill_dir) == [file_name]
+    assert writer.stats()['replayed_rows'] == 0
+
+    save.failures = 0
+    writer._replay_spilled()
+
+    assert save.files_seen[-1] == [f'{file_name}.{os.getpid()}.replay']
+    assert spilled_files(spill_dir) == []
+    assert writer.stats()['replayed_rows'] == 2
+
+
+def test_files_claimed_by_a_dead_process_are_replayed(make_writer, tmp_path):
+    spill_dir = str(tmp_path / 'spill')
+    finished = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                              capture_output=True, text=True, check=True)
+    dead_pid = int(finished.stdout)
+    os.makedirs(spill_dir)
+    predictions(2).to_parquet(os.path.join(spill_dir, f'eiv-1-{dead_pid}.parquet.{dead_pid}.replay'))
+    # Claimed by this process, which is still writing it
+    predictions(1).to_parquet(os.path.join(spill_dir, f'eiv-2-1.parquet.{os.getpid()}.replay'))
+    save = FlakySave(spill_dir)
+    writer = make_writer(save)
+
+    writer._replay_spilled()
+
+    assert writer.stats()['replayed_rows'] == 2
+    assert spilled_files(spill_dir) == [f'eiv-2-1.parquet.{os.getpid()}.replay']
+
+
+def test_spill_pending_writes_the_next_predictions_at_once(make_writer, tmp_path):
+    spill_dir = str(tmp_path / 'spill')
+    save = FlakySave(spill_dir)
+    writer = make_writer(save, flush_interval=60)
+    start_idle(writer)
+
+    writer.submit(predictions(2), 'eiv')
+    started_at = time.monotonic()
+    writer.spill_pending()
+
+    # Only a local write, the database isn't waited for
+    assert time.monotonic() - started_at < 1
+    assert save.calls == 0
+    assert len(spilled_files(spill_dir)) == 1
+
+    # As the next invocation after the container is thawed
+    writer.submit(predictions(1, start=2), 'eiv')
+
+    assert wait_until(lambda: writer.stats()['saved_rows'] == 3)
+    assert writer.stats()['replayed_rows'] == 2
+    assert spilled_files(spill_dir) == []
@@ -0,0 +1,71 @@
+import os
+import stat
+import time
+import pandas as pd
+import pyarrow as pa
+from repository.query_cache import QueryResultCache
+
+
+def make_result() -> pd.DataFrame:
+    return pd.DataFrame({'CLIENT_NAME': ['Alice', None, 'Bob'], 'ALLOWED': [1, 2, 3],
+                         'PAYOR_$': [0.1, None, 0.3]}, index=[5, 6, 7])
+
+
+def cache_files(directory) -> list:
+    return sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+
+
+def test_results_are_read_back_from_disk(tmp_path):
+    directory = str(tmp_path / 'cache')
+    QueryResultCache(directory=directory).put('frame', make_result())
+    QueryResultCache(directory=directory).put('table', pa.Table.from_pandas(make_result()))
+
+    # Another process, with nothing in memory
+    cache = QueryResultCache(directory=directory)
+
+    pd.testing.assert_frame_equal(cache.get('frame'), make_result())
+    assert cache.get('table').equals(pa.Table.from_pandas(make_result()))
+    assert cache.stats()['disk_hits'] == 2
+    assert cache_files(directory) == ['frame.arrow', 'table.arrow']
+
+
+def test_folder_is_private(tmp_path):
+    directory = str(tmp_path / 'cache')
+
+    QueryResultCache(directory=directory).put('frame', make_result())
+
+    assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+
+
+def test_other_results_are_kept_in_memory_only(tmp_path):
+    directory = str(tmp_path / 'cache')
+    cache = QueryResultCache(directory=directory)
+
+    cache.put('rows', [('Alice', 1)])
+
+    assert cache.get('rows') == [('Alice', 1)]
+    assert cache_files(directory) == []
+
+
+def test_unreadable_files_are_misses_and_removed(tmp_path):
+    directory = str(tmp_path / 'cache')
+    QueryResultCache(directory=directory).put('frame', make_result())
+    with open(os.path.join(directory, 'frame.arrow'), 'wb') as file:
+        file.write(b'not an arrow file')
+
+    cache = QueryResultCache(directory=directory)
+
+    assert cache.get('frame') is None
+    assert cache.stats()['misses'] == 1
+    assert cache_files(directory) == []
+
+
+def test_expired_files_are_misses_and_removed(tmp_path):
+    directory = str(tmp_path / 'cache')
+    QueryResultCache(directory=directory).put('frame', make_result(), ttl=0.05)
+    time.sleep(0.1)
+
+    cache = QueryResultCache(directory=directory)
+
+    assert cache.get('frame') is None
+    assert cache_files(directory) == []
@@ -0,0 +1,41 @@
+import pandas as pd
+
+COLUMNS = ['CLIENT_NAME', 'ALLOWED', 'PAYOR', 'PAYOR_$', 'UPDATED_AT']
+
+
+def test_merge_keeps_the_duplicate_the_full_load_keeps(make_service):
+    reference = pd.DataFrame([('Alice', 5, 'Cigna', 0.1, 1),
+                              ('Alice', 5, 'Aetna', 0.2, 1),
+                              ('Bob', 7, 'Aetna', 0.3, 1)], columns=COLUMNS)
+    service, snowflake = make_service(reference)
+    data = service.load_data_from_snowflake()
+
+    # A change of the duplicate the full load drops, of a kept row, and new
+    # rows, one of them a duplicate of a kept row
+    reference.loc[1, ['PAYOR_$', 'UPDATED_AT']] = [0.25, 2]
+    reference.loc[2, ['PAYOR_$', 'UPDATED_AT']] = [0.35, 2]
+    reference = pd.concat([reference, pd.DataFrame([('Carol', 9, 'BCBS', 0.4, 3),
+                                                    ('Bob', 7, 'BCBS', 0.5, 3)], columns=COLUMNS)],
+                          ignore_index=True)
+    snowflake.set_reference(reference)
+
+    changes = service.load_reference_changes('UPDATED_AT', 1)
+    merged = service.merge_reference_changes(data, changes)
+
+    full = service.load_data_from_snowflake().reset_index(drop=True)
+    pd.testing.assert_frame_equal(merged, full)
+    assert merged['PAYOR_$'].tolist() == [0.1, 0.35, 0.4]
+
+
+def test_changes_of_no_row_leave_the_data_as_it_is(make_service):
+    reference = pd.DataFrame([('Alice', 5, 'Cigna', 0.1, 1),
+                              ('Bob', 7, 'Aetna', 0.3, 1)], columns=COLUMNS)
+    service, _ = make_service(reference)
+    data = service.load_data_from_snowflake()
+
+    changes = service.load_reference_changes('UPDATED_AT', 1)
+    merged = service.merge_reference_changes(data, changes)
+
+    assert changes.empty
+    # SQLite doesn't type the columns of an empty result
+    pd.testing.assert_frame_equal(merged, data.reset_index(drop=True), check_dtype=False)
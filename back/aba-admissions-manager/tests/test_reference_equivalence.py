@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+import pytest
+from services.eiv_helper import WATERFALL_DIMENSIONS, waterfall_columns, resolve_waterfall, \
+                                MASTER_COLLECTED_RULES, CLAIM_AMOUNT_PAID_RULES
+from services.reference_index import ReferenceIndex
+
+# Keys of every dimension, in several cases, and keys found in no row
+KEYS = {'CLIENT_NAME': ['John Smith', 'jane doe', 'ANN LEE'],
+        'PREFIX': ['ABC', 'xyz'],
+        'PAYOR': ['Aetna', 'CIGNA', 'bcbs'],
+        'STATE': ['FL', 'nj'],
+        'SUBSCRIBER': ['JOHN SMITH', 'mary smith'],
+        'GROUP_NUMBER': ['G1', 'g2', 'G3'],
+        'FUNDED_STATUS': ['Self funded', 'FULLY FUNDED']}
+UNKNOWN_KEYS = ['Nobody', None]
+
+
+def make_reference(size: int = 500, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for dimension, keys in KEYS.items():
+        values = rng.choice(np.array(keys, dtype=object), size)
+        values[rng.random(size) < 0.05] = None
+        columns[dimension] = values
+    columns['SCA_FLAG'] = rng.choice(['Yes', 'No', 'YES', 'no'], size)
+    columns['PAID_CLAIM_$'] = rng.random(size).round(3)
+    for prefix in WATERFALL_DIMENSIONS.values():
+        for source in dict.fromkeys(waterfall_columns(prefix).values()):
+            values = rng.integers(0, 12, size).astype(float)
+            values[rng.random(size) < 0.1] = np.nan
+            columns[source] = values
+    for column in ['REGION', 'POLICY_TYPE', 'PAYOR_TYPE']:
+        columns[column] = 'UNUSED'
+    return pd.DataFrame(columns)
+
+
+def scan_first_value(data: pd.DataFrame, search_column: str, target, value_column: str, sca_flag):
+    # The original lookup: the first row of the key and SCA_FLAG
+    if target is None:
+        return None
+    result = data[data[search_column].str.upper() == str(target).upper()]
+    result = result[result['SCA_FLAG'].str.upper() == str(sca_flag).upper()]
+    if not result.empty:
+        return result.iloc[0][value_column]
+    return None
+
+
+def scan_specific_first_value(data: pd.DataFrame, keys: tuple, value_column: str):
+    # The original query: the first row matching every key given
+    matches = pd.Series(True, index=data.index)
+    if all(key is None for key in keys):
+        return None
+    for dimension, key in zip(WATERFALL_DIMENSIONS, keys):
+        if key is not None:
+            matches &= data[dimension].str.upper() == str(key).upper()
+    result = data[matches]
+    if not result.empty:
+        return result.iloc[0][value_column]
+    return None
+
+
+@pytest.fixture(scope='module')
+def reference():
+    return make_reference()
+
+
+@pytest.mark.parametrize('from_arrays', [False, True])
+def test_lookup_matches_the_scan(reference, from_arrays):
+    index = ReferenceIndex(reference, 'v1')
+    if from_arrays:
+        # As when the arrays are mapped from the shared snapshot
+        index = ReferenceIndex(reference, 'v1', index.arrays())
+
+    for dimension, prefix in WATERFALL_DIMENSIONS.items():
+        targets = pd.Series(KEYS[dimension] + UNKNOWN_KEYS, dtype=object)
+        for sca_flag in ['Yes', 'NO']:
+            found = index.lookup(dimension, targets, pd.Series(sca_flag, index=targets.index))
+            for target_column, source_column in waterfall_columns(prefix).items():
+                expected = [scan_first_value(reference, dimension, target, source_column, sca_flag)
+                            for target in targets]
+                np.testing.assert_array_equal(found[target_column].to_numpy(),
+                                              np.array(expected, dtype=float))
+
+
+def test_first_value_matches_the_query_scan(reference):
+    index = ReferenceIndex(reference, 'v1')
+    choices = [KEYS[dimension][:2] + UNKNOWN_KEYS for dimension in WATERFALL_DIMENSIONS]
+    rng = np.random.default_rng(1)
+    combinations = [tuple(rng.choice(np.array(keys, dtype=object)) for keys in choices)
+                    for _ in range(300)]
+    # Every single dimension alone too
+    for position, dimension in enumerate(WATERFALL_DIMENSIONS):
+        for key in KEYS[dimension]:
+            combinations.append(tuple(key if other == position else None
+                                      for other in range(len(WATERFALL_DIMENSIONS))))
+
+    for keys in combinations:
+        expected = scan_specific_first_value(reference, keys, 'PAID_CLAIM_$')
+        assert index.first_value(keys, 'PAID_CLAIM_$') == expected, keys
+
+
+# The original row by row waterfalls, level by level
+MASTER_COLLECTED_LEVELS = [('SUBS_$', 'SUBS_CLAIMS'), ('SUBS_$_PY', 'SUBS_CLAIMS_PY'),
+                           ('GROUP_$', 'GROUP_CLAIMS'), ('GROUP_$_PY', 'GROUP_CLAIMS_PY'),
+                           ('PREFIX_$', 'PREFIX_CLAIMS'), ('PREFIX_$_PY', 'PREFIX_CLAIMS_PY'),
+                           ('PAYOR_$', 'PAYOR_CLAIMS'), ('PAYOR_$_PY', 'PAYOR_CLAIMS_PY'),
+                           ('FUNDED_$', 'FUNDED_CLAIMS'), ('FUNDED_$_PY', 'FUNDED_CLAIMS_PY'),
+                           ('STATE_$', 'STATE_CLAIMS'), ('STATE_$_PY', 'STATE_CLAIMS_PY')]
+
+CLAIM_AMOUNT_PAID_LEVELS = [('CLIENT_BILL', 'CLIENT_CLAIMS'), ('CLIENT_BILL_PY', 'CLIENT_CLAIMS_PY'),
+                            ('SUBS_BILL', 'SUBS_CLAIMS'), ('SUBS_BILL_PY', 'SUBS_CLAIMS_PY'),
+                            ('GROUP_BILL', 'GROUP_CLAIMS'), ('GROUP_BILL_PY', 'GROUP_CLAIMS_PY'),
+                            ('PREFIX_BILL', 'PREFIX_CLAIMS'), ('PREFIX_BILL_PY', 'PREFIX_CLAIMS_PY'),
+                            ('PAYOR_BILL', 'PAYOR_CLAIMS'), ('PAYOR_BILL_PY', 'PAYOR_CLAIMS_PY'),
+                            ('FUNDED_BILL', 'FUNDED_CLAIMS'), ('FUNDED_BILL_PY', 'FUNDED_CLAIMS_PY'),
+                            ('STATE_BILL', 'STATE_CLAIMS'), ('STATE_BILL_PY', 'STATE_CLAIMS_PY')]
+
+
+def waterfall_row(row: pd.Series, levels: list) -> pd.Series:
+    # Value and value column of the first level with more than 5 claims
+    for value_column, claims_column in levels:
+        if pd.notnull(row[value_column]) and pd.notnull(row[claims_column]) and row[claims_column] > 5:
+            return pd.Series({'value': row[value_column], 'column': value_column})
+    return pd.Series({'value': np.nan, 'column': None})
+
+
+@pytest.mark.parametrize('rules, levels', [(MASTER_COLLECTED_RULES, MASTER_COLLECTED_LEVELS),
+                                           (CLAIM_AMOUNT_PAID_RULES, CLAIM_AMOUNT_PAID_LEVELS)])
+def test_rule_tables_match_the_row_by_row_waterfall(rules, levels):
+    rng = np.random.default_rng(3)
+    size = 2000
+    columns = {}
+    for value_column, claims_column in levels:
+        values = rng.random(size)
+        values[rng.random(size) < 0.4] = np.nan
+        claims = rng.integers(0, 9, size).astype(float)
+        claims[rng.random(size) < 0.2] = np.nan
+        columns[value_column] = values
+        columns[claims_column] = claims
+    data = pd.DataFrame(columns)
+
+    expected = data.apply(waterfall_row, axis=1, args=(levels,))
+    value, level = resolve_waterfall(data, rules)
+
+    np.testing.assert_array_equal(value.to_numpy(), expected['value'].to_numpy(dtype=float))
+    value_columns = {name: value_column for name, value_column, _ in rules}
+    # Rows no level resolves have no level
+    assert level.map(value_columns).fillna('').tolist() == expected['column'].fillna('').tolist()
@@ -0,0 +1,49 @@
+import copy
+import time
+import pytest
+from app_context import AppContext
+from conftest import make_reference_table
+
+
+def wait_until(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def context(tmp_path):
+    context = AppContext(reference_ttl=0.2)
+    config = copy.deepcopy(context.get_config())
+    config['reference'].update(snapshot_dir=str(tmp_path / 'reference'), watermark_column=None,
+                               max_age=0.6)
+    config['query_cache']['directory'] = None
+    context._config = config
+    yield context
+    context.reset()
+
+
+def test_data_older_than_max_age_is_reloaded_on_the_request_path(context, make_service):
+    service, snowflake = make_service(make_reference_table())
+    index = context.get_reference_index(service)
+    refresher = context.start_reference_refresher(service, interval=0.05)
+
+    def fail(*args, **kwargs):
+        raise Exception('Snowflake is down')
+    snowflake.execute_query = fail
+
+    # Older than reference_ttl: the refresher keeps trying in the background
+    assert wait_until(lambda: refresher.failures >= 2)
+    assert context.get_reference_index(service) is index
+    status = context.get_reference_status()
+    assert not status['stale']
+    assert status['refresher']['failures'] >= 2
+    assert 'Snowflake is down' in status['refresher']['last_error']
+
+    # Older than max_age: the request loads it again itself
+    assert wait_until(lambda: context.get_reference_status()['stale'])
+    with pytest.raises(Exception, match='Snowflake is down'):
+        context.get_reference_index(service)
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+KEY_COLUMNS = {'CLIENT_NAME': 'ClientName', 'PAYOR': 'Payor', 'STATE': 'State',
+               'SUBSCRIBER': 'Subscriber', 'GROUP_NUMBER': 'GroupID',
+               'FUNDED_STATUS': 'FundingType', 'POLICY_TYPE': 'PolicyType'}
+
+
+def make_reference(rows: list) -> pd.DataFrame:
+    columns = ['CLIENT_NAME', 'ALLOWED', 'PAYOR', 'PAYOR_$']
+    reference = pd.DataFrame(rows, columns=columns)
+    for column in ['PREFIX', 'STATE', 'SUBSCRIBER', 'GROUP_NUMBER', 'FUNDED_STATUS', 'POLICY_TYPE']:
+        reference[column] = 'UNUSED'
+    return reference
+
+
+def make_body(**values) -> pd.DataFrame:
+    body = {'ClientName': 'Nobody', 'PolicyID': 'ZZZ000', 'Payor': 'Nobody', 'State': 'ZZ',
+            'Subscriber': 'Nobody', 'GroupID': 'Z0', 'FundingType': 'Nobody',
+            'PolicyType': 'Nobody'}
+    body.update(values)
+    return pd.DataFrame([body])
+
+
+def test_pushdown_keeps_the_duplicate_the_full_load_keeps(make_service):
+    # (Alice, 5) is kept as its Cigna row by the full load, so payor Aetna
+    # is only found in Bob's row
+    service, _ = make_service(make_reference([('Alice', 5, 'Cigna', 0.1),
+                                              ('Alice', 5, 'Aetna', 0.2),
+                                              ('Bob', 7, 'Aetna', 0.3)]))
+    body = make_body(Payor='Aetna')
+
+    full = service.load_data_from_snowflake()
+    rows = service.load_reference_rows(body)
+
+    assert full.loc[full['PAYOR'] == 'Aetna', 'PAYOR_$'].tolist() == [0.3]
+    assert rows.loc[rows['PAYOR'] == 'Aetna', 'PAYOR_$'].tolist() == [0.3]
+
+
+def test_pushdown_matches_the_full_load(make_service):
+    rng = np.random.default_rng(0)
+    size = 300
+    reference = pd.DataFrame({
+        'CLIENT_NAME': rng.choice(['Alice', 'Bob', 'Carol', 'Dan'], size),
+        'ALLOWED': rng.choice([1, 2, 3, None], size),
+        'PREFIX': rng.choice(['ABC', 'XYZ'], size),
+        'PAYOR': rng.choice(['Aetna', 'Cigna', 'BCBS'], size),
+        'STATE': rng.choice(['FL', 'NJ', 'MA'], size),
+        'SUBSCRIBER': rng.choice(['ALICE', 'BOB'], size),
+        'GROUP_NUMBER': rng.choice(['G1', 'G2', 'G3'], size),
+        'FUNDED_STATUS': rng.choice(['Self funded', 'Fully Funded'], size),
+        'POLICY_TYPE': rng.choice(['PPO', 'HMO'], size),
+        'PAYOR_$': rng.random(size).round(3)})
+    service, _ = make_service(reference)
+    body = make_body(ClientName='Carol', Payor='cigna', State='NJ', GroupID='G3')
+
+    full = service.load_data_from_snowflake()
+    rows = service.load_reference_rows(body)
+
+    # Every row a lookup of the batch can find, in the same order
+    for column, field in KEY_COLUMNS.items():
+        value = body[field].iloc[0].upper()
+        expected = full[full[column].str.upper() == value].drop(columns='VOB_ID')
+        found = rows[rows[column].str.upper() == value].drop(columns='VOB_ID')
+        pd.testing.assert_frame_equal(found.reset_index(drop=True), expected.reset_index(drop=True))
@@ -0,0 +1,83 @@
+import pandas as pd
+from conftest import RecordingPostgreSQL
+from repository.eiv_repository import PREDICTION_COLUMNS, EIVRepository
+from services.eiv_services import EIVService
+
+SCA_COLUMNS = [column for column in PREDICTION_COLUMNS if column.startswith('SCA_')]
+NSCA_COLUMNS = [column for column in PREDICTION_COLUMNS if column.startswith('NSCA_')]
+
+
+def make_predictions(vob_ids: list = ('V1',), **columns) -> pd.DataFrame:
+    predictions = pd.DataFrame({'VOB_ID': list(vob_ids), 'CLIENT_NAME': 'Alice'})
+    for column in PREDICTION_COLUMNS:
+        predictions[column] = 0.5
+    for column, values in columns.items():
+        predictions[column] = values
+    return predictions
+
+
+def staged_columns(query: str) -> list:
+    return query.split('(', 1)[1].split(')', 1)[0].split(', ')
+
+
+def test_snapshot_version_is_saved_when_the_predictions_have_it():
+    rds = RecordingPostgreSQL()
+
+    EIVRepository([rds]).save_data(make_predictions(snapshot_version=['v7']), 'eiv')
+
+    columns = staged_columns(rds.calls[0]['query'])
+    assert 'snapshot_version' in columns
+    assert rds.calls[0]['rows'][0][columns.index('snapshot_version')] == 'v7'
+
+
+def test_predictions_without_snapshot_version_are_saved_without_it():
+    # e.g. spilled to disk by a version that didn't score them with it
+    rds = RecordingPostgreSQL()
+
+    EIVRepository([rds]).save_data(make_predictions(), 'eiv')
+
+    call = rds.calls[0]
+    assert 'snapshot_version' not in call['query']
+    assert not any('snapshot_version' in statement for statement in call['before'] + call['after'])
+    assert len(call['rows'][0]) == len(staged_columns(call['query']))
+
+
+def test_repeated_vobs_keep_their_last_prediction_of_every_branch():
+    rds = RecordingPostgreSQL()
+    predictions = make_predictions(['V1', 'V1', 'V2'], CLIENT_NAME=['Alice', 'Alice', 'Bob'],
+                                   prediction_date=[pd.Timestamp('2024-01-02').date()] * 3)
+    # The second V1 didn't score the NSCA branch, nor V2 the SCA one
+    predictions.loc[1, NSCA_COLUMNS] = None
+    predictions.loc[2, SCA_COLUMNS] = None
+
+    timings = EIVService([rds]).save_data_with_cashrepository(predictions, 'eiv')
+
+    assert timings == [{'batch': 0, 'rows': 3, 'seconds': 0.0}]
+    call = rds.calls[0]
+    columns = staged_columns(call['query'])
+    assert call['query'].startswith('INSERT INTO eiv_staging (')
+    assert columns[-1] == 'staging_position'
+    # Every row is staged, in order, with the branch it lacks as NULL
+    rows = [dict(zip(columns, row)) for row in call['rows']]
+    assert [(row['vob_id'], row['staging_position']) for row in rows] == [('V1', 0), ('V1', 1), ('V2', 2)]
+    assert all(rows[1][column] is None for column in NSCA_COLUMNS)
+    assert all(rows[2][column] is None for column in SCA_COLUMNS)
+    assert all(rows[1][column] == 0.5 for column in SCA_COLUMNS)
+
+    assert len(call['before']) == 1
+    assert 'CREATE TEMPORARY TABLE eiv_staging ON COMMIT DROP' in call['before'][0]
+    assert 'FROM eiv WITH NO DATA' in call['before'][0]
+
+    merge = ' '.join(call['after'][0].split())
+    assert merge.startswith(f"INSERT INTO eiv AS saved ({', '.join(columns[:-1])}) SELECT ")
+    # The last row of a key, and its last value of every prediction column
+    for column in PREDICTION_COLUMNS:
+        assert (f'(array_agg({column} ORDER BY staging_position DESC) '
+                f'FILTER (WHERE {column} IS NOT NULL))[1] AS {column}') in merge
+        assert f'{column} = COALESCE(excluded.{column}, saved.{column})' in merge
+    for column in ['CLIENT_NAME', 'timestamp']:
+        assert f'(array_agg({column} ORDER BY staging_position DESC))[1] AS {column}' in merge
+        assert f'{column} = excluded.{column}' in merge
+    assert 'FROM eiv_staging GROUP BY vob_id, prediction_date' in merge
+    assert 'ON CONFLICT (vob_id, prediction_date) DO UPDATE SET' in merge
+    assert 'vob_id =' not in merge and 'prediction_date =' not in merge
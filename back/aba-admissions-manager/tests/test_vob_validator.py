@@ -0,0 +1,30 @@
+import pytest
+from services.vob_validator import VOB_VALIDATOR
+
+VOB = {"ClientTrackingID": "T1", "ClientName": "John Smith", "VOBID": "V1", "SCA": True,
+       "OONBenefits": True, "Subscriber": "John Smith", "Payor": "Aetna", "GroupID": "G1",
+       "PolicyID": "ABC123", "FundingType": "Self funded", "PolicyType": "PPO", "Copay": 10.0,
+       "CoinsuranceOON": 20.0, "Deductible": 1000.0, "OutOfBucket": 2000.0, "State": "FL",
+       "Multiplan": False}
+
+
+@pytest.mark.parametrize('name', ["José García", "Zoë O'Neil-Brontë", "Łukasz, Żółw", "Mary Smith"])
+def test_names_of_any_alphabet_are_valid(name):
+    body, errors = VOB_VALIDATOR.validate([dict(VOB, ClientName=name)])
+
+    assert errors == {}
+    assert body.loc[0, 'ClientName'] == name
+
+
+@pytest.mark.parametrize('name, error', [
+    (None, "Provide a valid name and lastname"),
+    ("J0hn Smith", "Invalid username, contains numbers: J0hn Smith"),
+    ("Smith", "Provide user name and lastname"),
+    ("Joooohn Smith", "Invalid Name or Lastname: Joooohn"),
+    ("John_Smith Doe", "Invalid name. The name should contain only letters and not be empty."),
+    ("John @Smith", "Invalid name. The name should contain only letters and not be empty.")])
+def test_invalid_names_are_reported(name, error):
+    body, errors = VOB_VALIDATOR.validate([dict(VOB, ClientName=name)])
+
+    assert body.empty
+    assert [failure['error'] for failure in errors[0]] == [error]
@@ -1,40 +1,63 @@
+import base64
+import gzip
 import json
+import numpy as np
 
 
-def serialize_dataframe_to_json(dataframe):
-    json_data = dataframe.to_json(orient='records')
-    return json_data
+def json_default(value):
+    # Values json can not serialize natively (numpy scalars and arrays)
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return None if np.isnan(value) else float(value)
+    if isinstance(value, np.bool_):
+        return bool(value)
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
 
 
-def pretty_json(json_data):
-    parsed_data = json.dumps(json.loads(json_data), indent=4)
-    return parsed_data
+def compact_json(data):
+    return json.dumps(data, separators=(',', ':'), default=json_default)
 
 
 def response_error_json(code, error_message):  # we can make this function a class that inherits from BaseException
-    if code == 400:
-        json_data = '''{
-                "statusCode": 400,
-                "body": '''+json.dumps({'error': f'{error_message}'})+'''
-            }'''''
-    elif code == 500:
-        json_data = '''{
-                "statusCode": 500,
-                "body": '''+json.dumps({'error': f'{error_message}'})+'''
-            }'''
-    return pretty_json(json_data)
-
-
-def response_json(data):
-    json_data = '''{
-        "statusCode": 200,
-        "body": "Data published successfully",
-        "data": '''+json.dumps(str(data))+''',
-        "length": '''+str(len(data))+'''
-    }'''
-
-    return pretty_json(json_data)
+    if code not in (400, 500):
+        raise ValueError(f"Unsupported error code: {code}")
+    return compact_json({"statusCode": code,
+                         "body": {'error': f'{error_message}'}})
+
+
+def response_json(data, compress_min_bytes=None, snapshot_version=None):
+    """
+    Build the response of a successful request in a single pass.
+
+    Args:
+        data (list): Items of the response, already made of json types.
+        compress_min_bytes (int, optional): When the serialized data is at
+        least this size it is sent gzip compressed and base64 encoded, with
+        "dataEncoding": "gzip+base64". None never compresses.
+        snapshot_version (str, optional): Version of the reference data the
+        data was computed with, sent as "snapshotVersion".
+
+    Returns:
+        str: The compact json response.
+    """
+    data_json = compact_json(data)
+    response = {"statusCode": 200,
+                "body": "Data published successfully",
+                "length": len(data)}
+    if snapshot_version is not None:
+        response["snapshotVersion"] = snapshot_version
+
+    if compress_min_bytes is not None and len(data_json) >= compress_min_bytes:
+        compressed = gzip.compress(data_json.encode('utf-8'))
+        response["dataEncoding"] = "gzip+base64"
+        data_json = json.dumps(base64.b64encode(compressed).decode('ascii'))
+
+    # The data is serialized only once and placed as the last member
+    return compact_json(response)[:-1] + ',"data":' + data_json + '}'
 
 
 def receive_json(data):
-    return json.loads(data)
\ No newline at end of file
+    return json.loads(data)